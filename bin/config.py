@@ -1,4 +1,3 @@
-import bloop
 import boto3.session
 import redis
 import rq
@@ -6,7 +5,7 @@ import urllib.parse
 
 import moldyboot.config
 from moldyboot.controllers import KeyManager, UserManager
-from moldyboot.models import BaseModel
+from moldyboot.models import BaseModel, FastEngine
 from moldyboot.tasks import AsyncTasks
 
 api_endpoint = urllib.parse.urlsplit("http://127.0.0.1:8010")
@@ -17,13 +16,13 @@ redis_connection = redis.StrictRedis(port=redis_port)
 queue = rq.Queue(connection=redis_connection)
 
 session = boto3.session.Session(profile_name="moldyboot-crossj@ubuntu-16")
-engine = bloop.Engine(
+engine = FastEngine(
     dynamodb=session.client("dynamodb"),
     dynamodbstreams=session.client("dynamodbstreams"),
     table_name_template=moldyboot.config.table_name_template
 )
 engine.bind(BaseModel)
 
-key_manager = KeyManager(engine)
+key_manager = KeyManager(engine, max_keys=moldyboot.config.max_keys_per_user)
 user_manager = UserManager(engine)
 async_tasks = AsyncTasks(queue)
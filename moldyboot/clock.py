@@ -0,0 +1,33 @@
+import threading
+import time
+from typing import Callable
+
+__all__ = ["Clock", "default_clock"]
+
+
+class Clock:
+    """The current time in whole seconds since the epoch, for comparing against stored times (eg. Key.until).
+
+    Between begin() and end() every call to now() on that thread returns the same time, so a request reads the
+    system clock once and every check in it agrees; middleware.UnitOfWork scopes this to a single request.
+    Other threads (and code outside a request) read the source each time.
+
+    Tests replace `source` (or pass their own Clock) to fix the time."""
+    def __init__(self, source: Callable[[], float]=time.time):
+        self.source = source
+        self._local = threading.local()
+
+    def now(self) -> int:
+        frozen = getattr(self._local, "frozen", None)
+        if frozen is not None:
+            return frozen
+        return int(self.source())
+
+    def begin(self):
+        self._local.frozen = int(self.source())
+
+    def end(self):
+        self._local.frozen = None
+
+
+default_clock = Clock()
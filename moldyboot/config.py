@@ -1 +1,3 @@
 table_name_template = "mb.{table_name}"
+# Registering another key past this evicts the user's least recently used key
+max_keys_per_user = 100
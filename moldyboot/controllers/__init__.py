@@ -2,14 +2,29 @@ from .common import (
     AlreadyExists,
     NotFound,
     NotSaved,
+    batch_delete,
+    batch_save,
+    cancellation_reasons,
+    compact_uuids,
     if_not_exist,
+    key_projection,
     persist_unique,
+    save_changes,
+    snapshot,
 )
+from .deadline import Deadline, DeadlineExceeded, default_deadline
+from .hedging import HedgePolicy
+from .identity import IdentityMap, default_identity_map
 from .key import KeyManager
+from .singleflight import SingleFlight
+from .throttling import Guard, GuardedClient, Unavailable
 from .user import UserManager
 from .validation import InvalidParameter, validate
 
 
 __all__ = [
-    "AlreadyExists", "InvalidParameter", "KeyManager", "NotFound", "NotSaved", "UserManager",
-    "if_not_exist", "persist_unique", "validate"]
+    "AlreadyExists", "Deadline", "DeadlineExceeded", "Guard", "GuardedClient", "HedgePolicy", "IdentityMap",
+    "InvalidParameter", "KeyManager", "NotFound", "NotSaved", "SingleFlight", "Unavailable", "UserManager",
+    "batch_delete", "batch_save", "cancellation_reasons", "compact_uuids", "default_deadline",
+    "default_identity_map", "if_not_exist", "key_projection", "persist_unique", "save_changes", "snapshot",
+    "validate"]
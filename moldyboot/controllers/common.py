@@ -1,4 +1,13 @@
+import time
+
 import bloop
+import botocore.exceptions
+from bloop.util import dump_key, extract_key, get_table_name, index_for
+
+# DynamoDB's limit on requests in a single BatchWriteItem call
+BATCH_WRITE_SIZE = 25
+# DynamoDB's limit on items in a single transaction
+TRANSACTION_SIZE = 10
 
 
 class AlreadyExists(Exception):
@@ -36,3 +45,146 @@ def if_not_exist(obj):
     if range_key:
         condition &= range_key.is_(None)
     return condition
+
+
+def key_projection(model, projection):
+    """Add the model's key columns to a projection of column names, so projected objects can still be saved.
+
+    "all" is passed through unchanged."""
+    if projection == "all":
+        return projection
+    names = [column.name for column in sorted(model.Meta.keys, key=lambda column: column.name)]
+    return names + [name for name in projection if name not in names]
+
+
+def snapshot(obj):
+    """Record obj's current column values, so save_changes can later write only what changed"""
+    return {column.name: getattr(obj, column.name, None) for column in obj.Meta.columns}
+
+
+def save_changes(obj, engine, since, condition=None):
+    """Save only the columns of obj that differ from the snapshot `since`, in a single UpdateItem.
+
+    Unlike engine.save(obj, atomic=True) neither the update nor the condition mentions unchanged columns;
+    pass a condition over just the fields that matter.  Returns the names of the changed columns.
+    Nothing is written when nothing changed."""
+    key_names = {column.name for column in obj.Meta.keys}
+    changed = sorted(
+        name for name, value in snapshot(obj).items()
+        if name not in key_names and value != since.get(name))
+    if not changed:
+        return changed
+    # A fresh instance only marks the columns set on it, so the update won't include anything else
+    delta = obj.__class__(**{name: getattr(obj, name) for name in key_names})
+    for name in changed:
+        setattr(delta, name, getattr(obj, name, None))
+    engine.save(delta, condition=condition)
+    return changed
+
+
+def compact_uuids(engine, column, page_size=100):
+    """Rewrite a CompactUUID column's values that are still stored as strings into their 16 byte form.
+
+    Each rewrite is conditioned on the old string value, so concurrent writes are never overwritten.
+    Returns (rewritten, skipped) counts."""
+    client = engine.session.dynamodb_client
+    model = column.model
+    table_name = get_table_name(engine, model())
+    key_names = [key.dynamo_name for key in model.Meta.keys]
+    names = {"#k{}".format(i): name for i, name in enumerate(key_names)}
+    names["#c"] = column.dynamo_name
+    request = {
+        "TableName": table_name,
+        "ProjectionExpression": ", ".join(sorted(names)),
+        "FilterExpression": "attribute_type(#c, :s)",
+        "ExpressionAttributeNames": names,
+        "ExpressionAttributeValues": {":s": {"S": "S"}},
+        "Limit": page_size
+    }
+    rewritten = skipped = 0
+    while True:
+        try:
+            response = client.scan(**request)
+        except botocore.exceptions.ClientError as error:
+            raise bloop.exceptions.BloopException("Unexpected error while scanning for string uuids.") from error
+        for item in response.get("Items", []):
+            old = item[column.dynamo_name]
+            new = column.typedef._dump(column.typedef._load(old), context={"engine": engine})
+            try:
+                client.update_item(
+                    TableName=table_name,
+                    Key={name: item[name] for name in key_names},
+                    UpdateExpression="SET #c = :new",
+                    ConditionExpression="#c = :old",
+                    ExpressionAttributeNames={"#c": column.dynamo_name},
+                    ExpressionAttributeValues={":new": new, ":old": old})
+                rewritten += 1
+            except botocore.exceptions.ClientError as error:
+                if error.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise bloop.exceptions.BloopException("Unexpected error while rewriting a uuid.") from error
+                skipped += 1
+        if "LastEvaluatedKey" not in response:
+            return rewritten, skipped
+        request["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def cancellation_reasons(error):
+    """The per-item CancellationReasons codes for a canceled transaction, in the order items were added.
+
+    Items that didn't cause the cancellation have the code "None".  Returns an empty list when
+    the service didn't include reasons."""
+    response = getattr(error.__cause__, "response", None) or {}
+    return [reason.get("Code", "None") for reason in response.get("CancellationReasons", [])]
+
+
+def batch_save(objs, engine, max_tries=5):
+    """Unconditionally write objs with BatchWriteItem, 25 at a time.
+
+    Unprocessed items are retried with backoff up to max_tries times per chunk.
+    Returns the list of objects that couldn't be written."""
+    def to_request(obj):
+        return {"PutRequest": {"Item": engine._dump(obj.__class__, obj)}}
+    return _batch_write(objs, engine, to_request, max_tries)
+
+
+def batch_delete(objs, engine, max_tries=5):
+    """Unconditionally delete objs with BatchWriteItem, 25 at a time.
+
+    Unprocessed items are retried with backoff up to max_tries times per chunk.
+    Returns the list of objects that couldn't be deleted."""
+    def to_request(obj):
+        return {"DeleteRequest": {"Key": dump_key(engine, obj)}}
+    return _batch_write(objs, engine, to_request, max_tries)
+
+
+def _batch_write(objs, engine, to_request, max_tries):
+    client = engine.session.dynamodb_client
+    objs = list(objs)
+    failed = []
+    for start in range(0, len(objs), BATCH_WRITE_SIZE):
+        # Unprocessed requests come back as-is, so index each object by table and key to find it again
+        request, pending, key_shapes = {}, {}, {}
+        for obj in objs[start:start + BATCH_WRITE_SIZE]:
+            table_name = get_table_name(engine, obj)
+            key = dump_key(engine, obj)
+            key_shapes[table_name] = sorted(key.keys())
+            pending[(table_name, index_for(key))] = obj
+            request.setdefault(table_name, []).append(to_request(obj))
+
+        tries = max(max_tries, 0)
+        while request and tries:
+            try:
+                response = client.batch_write_item(RequestItems=request)
+            except botocore.exceptions.ClientError as error:
+                raise bloop.exceptions.BloopException("Unexpected error while writing items.") from error
+            request = response.get("UnprocessedItems") or {}
+            tries -= 1
+            if request and tries:
+                time.sleep(0.05 * 2 ** (max_tries - tries))
+
+        for table_name, item_requests in request.items():
+            for item_request in item_requests:
+                attrs = item_request.get("PutRequest", {}).get("Item") or item_request["DeleteRequest"]["Key"]
+                key = extract_key(key_shapes[table_name], attrs)
+                failed.append(pending[(table_name, index_for(key))])
+    return failed
@@ -0,0 +1,56 @@
+import functools
+import threading
+import time
+from typing import Any, Callable, Optional
+
+__all__ = ["Deadline", "DeadlineExceeded", "default_deadline"]
+
+
+class DeadlineExceeded(Exception):
+    """The request ran out of time before this call; the client has already given up"""
+    def __init__(self, operation: str):
+        super().__init__("Deadline exceeded before {}".format(operation))
+        self.operation = operation
+
+
+class Deadline(threading.local):
+    """When the current request has to be finished by.
+
+    Unset (no limit) until begin() is called, so managers used outside of a request (tasks, scripts) never run out
+    of time.  Each thread has its own deadline; middleware.RequestDeadline scopes it to a single request."""
+    def __init__(self):
+        self.at = None
+
+    def begin(self, timeout: float):
+        self.at = time.monotonic() + timeout
+
+    def end(self):
+        self.at = None
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left, or None when there's no deadline"""
+        if self.at is None:
+            return None
+        return self.at - time.monotonic()
+
+    def check(self, operation: str):
+        """Raise DeadlineExceeded if there's no time left to start operation"""
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded(operation)
+
+    def carry(self, fn: Callable[[], Any]) -> Callable[[], Any]:
+        """Wrap fn to run under this thread's deadline, for handing work to another thread"""
+        at = self.at
+
+        @functools.wraps(fn)
+        def wrapped():
+            previous, self.at = self.at, at
+            try:
+                return fn()
+            finally:
+                self.at = previous
+        return wrapped
+
+
+default_deadline = Deadline()
@@ -0,0 +1,118 @@
+import collections
+import concurrent.futures
+import math
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from .deadline import default_deadline
+
+__all__ = ["HedgePolicy", "hedged"]
+
+
+class HedgePolicy:
+    """Issues a duplicate read when the first one is slower than usual, and returns whichever finishes first.
+
+    The delay before hedging is the given percentile of recent read latencies (default_delay until there are
+    min_samples of them).  Every read earns `budget` of a hedge, up to `burst` saved; a hedge spends one.  With
+    the default budget of 0.05 hedges add at most ~5% to read capacity, even when Dynamo is slow across the board.
+
+    The function passed to call() runs on a worker thread, possibly twice at once: it must build its own
+    objects rather than filling in a shared one, and can't rely on thread locals (eg. the identity map)."""
+    def __init__(
+            self, *,
+            percentile: float=95, budget: float=0.05, burst: float=10,
+            default_delay: float=0.05, min_samples: int=50, window: int=1000, max_workers: int=16):
+        self.percentile = percentile
+        self.budget = budget
+        self.burst = burst
+        self.default_delay = default_delay
+        self.min_samples = min_samples
+        self._latencies = collections.deque(maxlen=window)
+        self._delay = default_delay
+        # Latencies recorded since the delay was last computed
+        self._stale = 0
+        self._tokens = burst
+        self._lock = threading.Lock()
+        self._counts = collections.Counter()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    @property
+    def delay(self) -> float:
+        """Seconds to wait on the first read before hedging"""
+        return self._delay
+
+    def metrics(self) -> Dict[str, int]:
+        """Counts since startup:
+
+        reads -- calls to call()
+        hedged -- duplicate reads issued
+        won -- hedges that returned before the original read
+        over_budget -- reads that were slow enough to hedge, but the budget was spent
+        """
+        with self._lock:
+            return {name: self._counts[name] for name in ("reads", "hedged", "won", "over_budget")}
+
+    def call(self, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            self._counts["reads"] += 1
+            self._tokens = min(self.burst, self._tokens + self.budget)
+        start = time.monotonic()
+        first = self._executor.submit(fn)
+        try:
+            result = first.result(timeout=self._delay)
+        except concurrent.futures.TimeoutError:
+            pass
+        else:
+            self._record(time.monotonic() - start)
+            return result
+
+        if not self._spend():
+            result = first.result()
+            self._record(time.monotonic() - start)
+            return result
+
+        second = self._executor.submit(fn)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            # When both finish together prefer the original, so it isn't counted as a win
+            for future in sorted(done, key=lambda f: f is second):
+                if future.exception() is None:
+                    if future is second:
+                        with self._lock:
+                            self._counts["won"] += 1
+                    self._record(time.monotonic() - start)
+                    return future.result()
+                error = error or future.exception()
+        # Both reads failed; raise the error from whichever failed first
+        raise error
+
+    def _spend(self) -> bool:
+        with self._lock:
+            if self._tokens < 1:
+                self._counts["over_budget"] += 1
+                return False
+            self._tokens -= 1
+            self._counts["hedged"] += 1
+            return True
+
+    def _record(self, latency: float):
+        with self._lock:
+            self._latencies.append(latency)
+            self._stale += 1
+            # Sorting the window on every read is wasteful; the percentile moves slowly
+            if len(self._latencies) >= self.min_samples and self._stale >= min(50, self.min_samples):
+                self._stale = 0
+                ordered = sorted(self._latencies)
+                index = min(len(ordered) - 1, math.ceil(len(ordered) * self.percentile / 100) - 1)
+                self._delay = ordered[index]
+
+
+def hedged(policy: Optional[HedgePolicy], fn: Callable[..., Any], *args) -> Any:
+    """fn(*args) through policy, or called directly when there's no policy"""
+    if policy is None:
+        return fn(*args)
+    # Worker threads don't have the request's deadline unless it's carried over
+    return policy.call(default_deadline.carry(lambda: fn(*args)))
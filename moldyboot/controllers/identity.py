@@ -0,0 +1,56 @@
+import threading
+from typing import Optional, Sequence, Union
+
+__all__ = ["IdentityMap", "default_identity_map"]
+
+
+class IdentityMap(threading.local):
+    """Objects loaded during the current request, by model and key.
+
+    Inactive (every lookup misses, nothing is stored) until begin() is called, so managers used outside of a
+    request (tasks, scripts) always go to Dynamo.  Each thread has its own map; middleware.UnitOfWork scopes
+    it to a single request."""
+    def __init__(self):
+        self._objects = None
+
+    @property
+    def active(self) -> bool:
+        return self._objects is not None
+
+    def begin(self):
+        self._objects = {}
+
+    def end(self):
+        self._objects = None
+
+    def get(self, model, projection: Union[str, Sequence[str]]="all", **key) -> Optional[object]:
+        """The object with this key, if one was loaded with at least the columns in projection.
+
+        Pass the key columns by name, eg. get(Key, user_id=..., key_id=...)"""
+        if self._objects is None:
+            return None
+        obj, loaded = self._objects.get((model, _key(key)), (None, None))
+        if obj is None:
+            return None
+        if loaded == "all" or (projection != "all" and set(projection) <= loaded):
+            return obj
+        return None
+
+    def put(self, obj, projection: Union[str, Sequence[str]]="all"):
+        if self._objects is None:
+            return
+        loaded = projection if projection == "all" else set(projection)
+        key = {column.name: getattr(obj, column.name) for column in obj.Meta.keys}
+        self._objects[(obj.__class__, _key(key))] = (obj, loaded)
+
+    def discard(self, model, **key):
+        if self._objects is None:
+            return
+        self._objects.pop((model, _key(key)), None)
+
+
+def _key(key: dict) -> tuple:
+    return tuple(sorted(key.items()))
+
+
+default_identity_map = IdentityMap()
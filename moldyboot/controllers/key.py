@@ -1,65 +1,424 @@
+import base64
+import concurrent.futures
+import itertools
 import uuid
-from typing import Optional, Sequence, Union
+from typing import Any, Iterable, List, Optional, Sequence, Tuple, Union
 
 import bloop
-import pendulum
+import botocore.exceptions
+from bloop.models import unpack_from_dynamodb
+from bloop.util import get_table_name
 
-from ..models import Key
-from .common import NotFound, NotSaved, persist_unique
-from .validation import validate
+from ..clock import Clock, default_clock
+from ..models import Key, User
+from .common import (
+    BATCH_WRITE_SIZE,
+    TRANSACTION_SIZE,
+    NotFound,
+    NotSaved,
+    batch_delete,
+    batch_save,
+    if_not_exist,
+    key_projection,
+    persist_unique,
+    save_changes,
+    snapshot,
+)
+from .hedging import HedgePolicy, hedged
+from .identity import IdentityMap, default_identity_map
+from .singleflight import SingleFlight
+from .validation import InvalidParameter, validate
+
+# Seconds a key is valid for after it's created or last used
+# TODO should be loaded from config
+KEY_LIFETIME = 60 * 60
+
+# Most keys evicted by a single call to new: the rest of its transaction is the key and User.key_count.
+# Users further over max_keys (from before the cap) shrink by this many each time
+MAX_EVICTIONS = TRANSACTION_SIZE - 2
+
+# Columns returned by list_keys_page; everything but the public key
+PAGE_COLUMNS = [Key.user_id, Key.key_id, Key.until, Key.fingerprint]
+
+
+def _counted(stored: Optional[int]) -> bloop.conditions.BaseCondition:
+    """Condition for writing User.key_count when it was read as stored (None: unset, but the user exists)"""
+    if stored is None:
+        return User.key_count.is_(None) & User.user_id.is_not(None)
+    return User.key_count == stored
 
 
 class KeyManager:
-    def __init__(self, engine: bloop.Engine):
+    def __init__(
+            self,
+            engine: bloop.Engine,
+            consistent_reads: bool=False,
+            stale_margin: int=60,
+            identity_map: IdentityMap=default_identity_map,
+            hedging: Optional[HedgePolicy]=None,
+            clock: Clock=default_clock,
+            max_keys: Optional[int]=None):
         self.engine = engine
+        self.clock = clock
+        # When set, new() and renew() keep each user to at most max_keys by evicting their least recently used
+        # keys, and new_many() refuses keys that would take the user over
+        self.max_keys = max_keys
+        # Serves repeat loads within a request; see middleware.UnitOfWork
+        self.identity_map = identity_map
+        # Coalesces concurrent loads of the same key across threads
+        self.loads = SingleFlight()
+        # When set, a slow load in get_key is raced against a second one
+        self.hedging = hedging
+        # When False, get_key reads eventually consistent and only re-reads with a consistent read
+        # if the key is missing (it may have just been created) or within stale_margin seconds of
+        # expiring (a refresh may not have replicated yet)
+        self.consistent_reads = consistent_reads
+        self.stale_margin = stale_margin
 
     def new(self, user_id: Union[str, uuid.UUID], public: Union[str, bytes]) -> Key:
         # 1) Validate user_id, public
         user_id = validate("user_id", user_id)
         public = validate("public_key", public)
         # 2) Store key
-        key = Key(user_id=user_id, public=public, until=pendulum.now().add(hours=1))
-        persist_unique(key, self.engine, "key_id", uuid.uuid4)
+        key = Key(user_id=user_id, public=public, until=self.clock.now() + KEY_LIFETIME)
+        key.fingerprint = key.compute_fingerprint()
+        if self.max_keys is None:
+            persist_unique(key, self.engine, "key_id", uuid.uuid4)
+        else:
+            self._persist_capped(key)
+        self.loads.forget(Key, key.user_id, key.key_id)
+        self.identity_map.put(key)
         return key
 
+    def _persist_capped(self, key: Key, max_tries: int=10):
+        """Store a new key and count it in User.key_count, in one transaction.
+
+        key_count is read and written with a condition on its old value, so below the cap the cost is one
+        single-attribute read.  Keys that expire, are swept or revoked aren't subtracted, so the count can run
+        high but never low.  When it's unset or reaches max_keys the user's keys are recounted, and if they really
+        are at the cap the least recently used are evicted in the same transaction, just enough to make room.
+        The recount is written back, so it's only repeated once the user is at the cap again."""
+        condition = if_not_exist(key)
+        tries = max_tries
+        while tries:
+            key.key_id = uuid.uuid4()
+            stored = self._key_count(key.user_id)
+            count, evicted = stored, []
+            if stored is None or stored >= self.max_keys:
+                keys = self._least_recently_used(key.user_id)
+                count = len(keys)
+                if count >= self.max_keys:
+                    evicted = keys[:min(MAX_EVICTIONS, count - self.max_keys + 1)]
+
+            tx = self.engine.transaction()
+            tx.save(key, condition=condition)
+            tx.save(User(user_id=key.user_id, key_count=count - len(evicted) + 1), condition=_counted(stored))
+            for old in evicted:
+                # Skip (and retry with the next oldest) a key that was used since it was read
+                tx.delete(old, condition=Key.until == old.until)
+            try:
+                tx.prepare().commit()
+            except bloop.TransactionCanceled:
+                # key_id collision, a concurrent write to this user's count, or an evicted key was used
+                tries -= 1
+                continue
+            for old in evicted:
+                self.loads.forget(Key, old.user_id, old.key_id)
+                self.identity_map.discard(Key, user_id=old.user_id, key_id=old.key_id)
+            return
+        raise NotSaved(key)
+
+    def _reserve(self, keys: List[Key], max_tries: int=10):
+        """Count keys in User.key_count before they're stored, or raise InvalidParameter if that would take their
+        user over max_keys.  Nothing is evicted to make room.
+
+        The keys are written after the count, so a failed write leaves it high rather than low."""
+        user_id = keys[0].user_id
+        tries = max_tries
+        while tries:
+            stored = self._key_count(user_id)
+            count = stored
+            if stored is None or stored + len(keys) > self.max_keys:
+                count = len(self._least_recently_used(user_id))
+            if count + len(keys) > self.max_keys:
+                raise InvalidParameter("public_keys", len(keys), "Would exceed the limit of {} keys".format(
+                    self.max_keys))
+            try:
+                self.engine.save(User(user_id=user_id, key_count=count + len(keys)), condition=_counted(stored))
+            except bloop.ConstraintViolation:
+                tries -= 1
+                continue
+            return
+        raise NotSaved(keys)
+
+    def _key_count(self, user_id: uuid.UUID) -> Optional[int]:
+        """The stored User.key_count, or None if it hasn't been set"""
+        try:
+            user = self.engine.query(
+                User, key=User.user_id == user_id, projection=key_projection(User, ["key_count"]), consistent=True
+            ).first()
+        except bloop.ConstraintViolation:
+            raise NotFound
+        return getattr(user, "key_count", None)
+
+    def _least_recently_used(self, user_id: uuid.UUID) -> List[Key]:
+        """Every key the user has (key columns and until), least recently used first.
+
+        Sorted here rather than read from an index on until, which would add an index write to every refresh."""
+        keys = self.engine.query(
+            Key, key=Key.user_id == user_id, projection=key_projection(Key, ["until"]), consistent=True)
+        return sorted(keys, key=lambda key: key.until)
+
+    def new_many(self, user_id: Union[str, uuid.UUID], publics: Union[dict, Sequence[Any]]) -> List[Key]:
+        """Register a JWK Set or list of public keys.  Every key is validated before any are stored.
+
+        BatchWriteItem can't take a condition, so candidate key_ids are checked with a consistent batch
+        load first; the (vanishingly rare) ids that are already taken fall back to persist_unique.
+
+        With max_keys set the keys are counted first, and none are stored if they'd take the user over."""
+        user_id = validate("user_id", user_id)
+        publics = validate("public_keys", publics)
+        until = self.clock.now() + KEY_LIFETIME
+        keys = [Key(user_id=user_id, key_id=uuid.uuid4(), public=public, until=until) for public in publics]
+        for key in keys:
+            key.fingerprint = key.compute_fingerprint()
+        if self.max_keys is not None:
+            self._reserve(keys)
+
+        # Load into probes so that a collision doesn't overwrite the key we're trying to store
+        probes = {key.key_id: Key(user_id=user_id, key_id=key.key_id) for key in keys}
+        try:
+            self.engine.load(*probes.values(), consistent=True)
+            available = set()
+        except bloop.MissingObjects as exception:
+            available = {probe.key_id for probe in exception.objects}
+        unique = [key for key in keys if key.key_id in available]
+        taken = [key for key in keys if key.key_id not in available]
+
+        failed = batch_save(unique, self.engine)
+        for key in taken:
+            try:
+                persist_unique(key, self.engine, "key_id", uuid.uuid4)
+            except NotSaved:
+                failed.append(key)
+        if failed:
+            raise NotSaved(failed)
+        return keys
+
+    def renew(self, key: Key, public: Union[str, bytes], revoke: Optional[bool]=False) -> Key:
+        """Register another public key for the owner of an existing key, optionally revoking the existing key.
+
+        The new key and the revoke are written in a single transaction.  With max_keys set, a renew that doesn't
+        revoke adds a key and is counted (and evicts) like new()."""
+        public = validate("public_key", public)
+        new_key = Key(user_id=key.user_id, public=public, until=self.clock.now() + KEY_LIFETIME)
+        new_key.fingerprint = new_key.compute_fingerprint()
+        if self.max_keys is not None and not revoke:
+            self._persist_capped(new_key)
+            self.loads.forget(Key, new_key.user_id, new_key.key_id)
+            self.identity_map.put(new_key)
+            return new_key
+        condition = if_not_exist(new_key)
+        tries = 10
+        while tries:
+            new_key.key_id = uuid.uuid4()
+            tx = self.engine.transaction()
+            tx.save(new_key, condition=condition)
+            if revoke:
+                # The caller just proved they hold this key, so there's no need for an atomic delete
+                tx.delete(key)
+            try:
+                tx.prepare().commit()
+                self.loads.forget(Key, new_key.user_id, new_key.key_id)
+                self.identity_map.put(new_key)
+                if revoke:
+                    self.loads.forget(Key, key.user_id, key.key_id)
+                    self.identity_map.discard(Key, user_id=key.user_id, key_id=key.key_id)
+                return new_key
+            except bloop.TransactionCanceled:
+                tries -= 1
+        raise NotSaved(new_key)
+
     def get_key(self, user_id: Union[str, uuid.UUID], key_id: Union[str, uuid.UUID]) -> Key:
         user_id = validate("user_id", user_id)
         key_id = validate("key_id", key_id)
 
+        # Already loaded (and refreshed) earlier in this request
+        key = self.identity_map.get(Key, user_id=user_id, key_id=key_id)
+        if key is not None:
+            return key
+
+        # Read on this thread: hedged loads run on workers, which don't see the request's frozen clock
+        now = self.clock.now()
+        key = self.loads.do(
+            (Key, user_id, key_id), lambda: hedged(self.hedging, self._load_key, user_id, key_id, now))
+        if key.is_expired_at(now):
+            # Don't delete here; the table's ttl and sweep_expired clean up without adding writes to the request path
+            raise NotFound
+        else:
+            self.refresh(key)
+            self.identity_map.put(key)
+            return key
+
+    def _load_key(self, user_id: uuid.UUID, key_id: uuid.UUID, now: int) -> Key:
         key = Key(user_id=user_id, key_id=key_id)
+        consistent = self.consistent_reads
+        try:
+            self.engine.load(key, consistent=consistent)
+        except bloop.MissingObjects:
+            if consistent:
+                raise NotFound
+        else:
+            if consistent or key.until > now + self.stale_margin:
+                return key
         try:
             self.engine.load(key, consistent=True)
         except bloop.MissingObjects:
             raise NotFound
-        if key.is_expired:
-            self.revoke(key)
-            raise NotFound
-        else:
-            self.refresh(key)
-            return key
+        return key
 
-    def list_keys(self, user_id: Union[str, uuid.UUID]) -> Sequence[Key]:
+    def list_keys(self, user_id: Union[str, uuid.UUID], projection: Union[str, Sequence[str]]="all") -> Sequence[Key]:
+        """Pass a list of column names as projection to skip reading and decoding the others, especially der.
+        The key columns are always included."""
         user_id = validate("user_id", user_id)
         return self.engine.query(
             Key,
             key=Key.user_id == user_id,
+            projection=key_projection(Key, projection)
         )
 
+    def keys_with_fingerprint(self, fingerprint: str) -> Sequence[Key]:
+        """Every key (user_id, key_id, fingerprint) registered with the public key that has this fingerprint.
+
+        Reads the by_fingerprint index, so a key created in the last moment may not be included yet."""
+        return self.engine.query(Key.by_fingerprint, key=Key.fingerprint == fingerprint)
+
+    def backfill_fingerprints(self) -> Tuple[int, int]:
+        """Store the fingerprint of every key created before fingerprints were stored.
+
+        Only the fingerprint is written, conditioned on the key still having the same public key and no
+        fingerprint; keys deleted or replaced since the scan are skipped rather than recreated.
+        Returns (written, skipped) counts."""
+        keys = self.engine.scan(
+            Key, filter=Key.fingerprint.is_(None), projection=key_projection(Key, ["der"]), consistent=True)
+        written = skipped = 0
+        for key in keys:
+            update = Key(user_id=key.user_id, key_id=key.key_id, fingerprint=key.compute_fingerprint())
+            try:
+                self.engine.save(update, condition=Key.fingerprint.is_(None) & (Key.der == key.der))
+                written += 1
+            except bloop.ConstraintViolation:
+                skipped += 1
+            finally:
+                self.loads.forget(Key, key.user_id, key.key_id)
+        return written, skipped
+
+    def list_keys_page(
+            self, user_id: Union[str, uuid.UUID],
+            cursor: Optional[str]=None, limit: int=100) -> Tuple[List[Key], Optional[str]]:
+        """Up to limit of a user's keys, with every column but der, from a single Query.
+
+        Returns (keys, cursor); pass cursor back to get the keys after these, until it's None.  A cursor only
+        holds the last key_id, and is always resumed under user_id, so it can't be used to read another user's keys.
+        A page can come back empty with a cursor when the previous page ended exactly on the last key."""
+        user_id = validate("user_id", user_id)
+        context = {"engine": self.engine}
+        user_key = Key.user_id.typedef._dump(user_id, context=context)
+        names = {"#{}".format(column.dynamo_name): column.dynamo_name for column in PAGE_COLUMNS}
+        request = {
+            "TableName": get_table_name(self.engine, Key()),
+            "KeyConditionExpression": "#{} = :u".format(Key.user_id.dynamo_name),
+            "ProjectionExpression": ", ".join(sorted(names)),
+            "ExpressionAttributeNames": names,
+            "ExpressionAttributeValues": {":u": user_key},
+            "ConsistentRead": self.consistent_reads,
+            "Limit": limit
+        }
+        if cursor is not None:
+            after = validate("key_cursor", cursor)
+            request["ExclusiveStartKey"] = {
+                Key.user_id.dynamo_name: user_key,
+                Key.key_id.dynamo_name: Key.key_id.typedef._dump(after, context=context)}
+        try:
+            response = self.engine.session.dynamodb_client.query(**request)
+        except botocore.exceptions.ClientError as error:
+            raise bloop.exceptions.BloopException("Unexpected error while listing keys.") from error
+        keys = [
+            unpack_from_dynamodb(attrs=item, expected=PAGE_COLUMNS, model=Key, engine=self.engine)
+            for item in response.get("Items", [])]
+        last = response.get("LastEvaluatedKey")
+        if not last:
+            return keys, None
+        last_key_id = Key.key_id.typedef._load(last[Key.key_id.dynamo_name], context=context)
+        return keys, base64.urlsafe_b64encode(last_key_id.bytes).rstrip(b"=").decode("utf-8")
+
     def revoke(self, key: Key, force: Optional[bool]=False) -> Key:
-        # By default revokes are atomic, so that we don't accidentally blow away a key
-        # just after someone uses it.
+        # By default revokes are conditional on until, so that we don't accidentally blow away a key
+        # just after someone uses it (and refreshes it).
         # However, there are cases where we need to unconditionally delete a key.
+        condition = None if force else Key.until == getattr(key, "until", None)
+        self.identity_map.discard(Key, user_id=key.user_id, key_id=key.key_id)
         try:
-            self.engine.delete(key, atomic=not force)
+            self.engine.delete(key, condition=condition)
         except bloop.ConstraintViolation:
             raise NotSaved(key)
+        finally:
+            self.loads.forget(Key, key.user_id, key.key_id)
         return key
 
+    def revoke_all(self, user_id: Union[str, uuid.UUID], max_workers: int=4) -> List[Key]:
+        """Unconditionally delete every key for a user.  Returns the keys that couldn't be deleted."""
+        return self._delete_all(self.list_keys(user_id, projection=[]), max_workers)
+
+    def sweep_expired(self, max_workers: int=4) -> List[Key]:
+        """Delete every expired key, ahead of the table's ttl.
+
+        The scan is consistent so a key refreshed just before it expired can't be deleted from a stale read;
+        expired keys can't be refreshed, so the deletes themselves don't need a condition.
+        Returns the keys that couldn't be deleted."""
+        keys = self.engine.scan(
+            Key, filter=Key.until < self.clock.now(), projection=key_projection(Key, []), consistent=True)
+        return self._delete_all(keys, max_workers)
+
+    def _delete_all(self, keys: Iterable[Key], max_workers: int) -> List[Key]:
+        # Keys are deleted in batches of 25 as the search pages in.  At most max_workers batches are in flight,
+        # and the search isn't read further until one of them finishes, so only that many batches are in memory
+        failed = []
+        pending = {}
+
+        def collect(done):
+            for future in done:
+                batch = pending.pop(future)
+                try:
+                    failed.extend(future.result())
+                except bloop.exceptions.BloopException:
+                    failed.extend(batch)
+
+        keys = iter(keys)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                batch = list(itertools.islice(keys, BATCH_WRITE_SIZE))
+                if not batch:
+                    break
+                if len(pending) >= max_workers:
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    collect(done)
+                pending[executor.submit(batch_delete, batch, self.engine)] = batch
+            collect(concurrent.futures.as_completed(list(pending)))
+        return failed
+
     def refresh(self, key: Key):
+        """Extend the key's lifetime.  Raises NotFound if it expired or was revoked since it was read, which an
+        eventually consistent read in get_key can miss."""
         # TODO should push to an async task queue, not blocking
-        # TODO offset should be loaded from config
-        # TODO handle bloop.ConstraintViolation
-        now = pendulum.now()
-        key.until = now.add(hours=1)
+        now = self.clock.now()
+        before = snapshot(key)
+        key.until = now + KEY_LIFETIME
+        # Only until is written; the condition also keeps a deleted key from being recreated
         not_expired = Key.until >= now
-        self.engine.save(key, condition=not_expired, atomic=True)
+        try:
+            save_changes(key, self.engine, before, condition=not_expired)
+        except bloop.ConstraintViolation:
+            raise NotFound
+        finally:
+            self.loads.forget(Key, key.user_id, key.key_id)
@@ -0,0 +1,61 @@
+import copy
+import threading
+from typing import Any, Callable, Hashable, Tuple
+
+from .deadline import Deadline, DeadlineExceeded, default_deadline
+__all__ = ["SingleFlight"]
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key into one.
+
+    The first caller for a key runs the function; callers that arrive while it's running wait and get its result,
+    or raise its exception.  Waiters get a shallow copy of the result so no two callers share a mutable object.
+    A waiter gives up with DeadlineExceeded when its own request's deadline passes; the call carries on for the
+    others.
+
+    After a write, call forget() so that later callers start a fresh load instead of joining one that may have
+    read the item before the write."""
+    def __init__(self, deadline: Deadline=default_deadline):
+        self.deadline = deadline
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key: Tuple[Hashable, ...], fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            if not call.done.wait(self.deadline.remaining()):
+                raise DeadlineExceeded("shared load")
+            if call.error is not None:
+                raise call.error
+            return copy.copy(call.result)
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+
+    def forget(self, *prefix: Hashable):
+        """Stop sharing any in-flight call whose key starts with prefix"""
+        size = len(prefix)
+        with self._lock:
+            for key in [key for key in self._calls if key[:size] == prefix]:
+                del self._calls[key]
@@ -0,0 +1,178 @@
+import functools
+import math
+import threading
+import time
+from typing import Any, Callable, Optional
+
+import botocore.exceptions
+
+from .deadline import Deadline, default_deadline
+
+__all__ = ["Guard", "GuardedClient", "Unavailable"]
+
+THROTTLING_ERRORS = {
+    "ProvisionedThroughputExceededException",
+    "RequestLimitExceeded",
+    "ThrottlingException",
+}
+
+# DynamoDB client operations that go through the guard.  Everything else (eg. waiters, meta) passes straight through
+GUARDED_OPERATIONS = {
+    "batch_get_item", "batch_write_item", "delete_item", "get_item", "put_item", "query", "scan",
+    "transact_get_items", "transact_write_items", "update_item",
+}
+
+
+class Unavailable(Exception):
+    """DynamoDB is throttling or failing, and the call was not attempted.  Retry after `retry_after` seconds."""
+    def __init__(self, retry_after: int):
+        super().__init__("DynamoDB unavailable, retry after {} seconds".format(retry_after))
+        self.retry_after = retry_after
+
+
+class Guard:
+    """
+    Client-side rate limit and circuit breaker for DynamoDB calls, shared by every thread in a worker.
+
+    The rate limit adapts to throttling: each throttled call multiplies the allowed rate by `decrease`, and each
+    successful call adds `increase` requests per second back, between min_rate and max_rate.  A call that would wait
+    more than `max_wait` seconds for its turn raises Unavailable instead of stacking up behind the others.
+
+    After `failure_threshold` consecutive throttled or failed calls the circuit opens and every call raises
+    Unavailable for `reset_timeout` seconds.  Then one call is let through: the circuit closes if it succeeds
+    and stays open for another reset_timeout if it doesn't.  Client errors such as a failed condition mean the
+    service is healthy, and count as successes.
+    """
+    def __init__(
+            self, *,
+            rate: float=100, min_rate: float=1, max_rate: float=1000, increase: float=1, decrease: float=0.5,
+            max_wait: float=0.5, failure_threshold: int=10, reset_timeout: float=5):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.max_wait = max_wait
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._rate = rate
+        # Allows a burst of up to one second's worth of calls
+        self._tokens = rate
+        self._last = time.monotonic()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    @property
+    def state(self) -> str:
+        """closed, open, or half-open (the reset timeout passed and the next call is a trial)"""
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if self._trial or time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def call(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        self._acquire()
+        try:
+            response = fn(*args, **kwargs)
+        except botocore.exceptions.ClientError as error:
+            self._record(_classify(error))
+            raise
+        except botocore.exceptions.ParamValidationError:
+            # Never sent, says nothing about the service
+            self._record(None)
+            raise
+        except botocore.exceptions.BotoCoreError:
+            # Connection errors, timeouts
+            self._record("failed")
+            raise
+        except BaseException:
+            self._record(None)
+            raise
+        # Batch calls are throttled per item; the caller retries the unprocessed ones
+        if response.get("UnprocessedKeys") or response.get("UnprocessedItems"):
+            self._record("throttled")
+        else:
+            self._record("ok")
+        return response
+
+    def _acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._opened_at is not None:
+                remaining = self.reset_timeout - (now - self._opened_at)
+                if remaining > 0 or self._trial:
+                    raise Unavailable(max(1, math.ceil(remaining)))
+                self._trial = True
+            self._tokens = min(self._rate, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            wait = (1 - self._tokens) / self._rate if self._tokens < 1 else 0
+            if wait > self.max_wait:
+                self._trial = False
+                raise Unavailable(max(1, math.ceil(wait)))
+            # Reserve the token now, so concurrent callers queue up behind this one
+            self._tokens -= 1
+        if wait:
+            time.sleep(wait)
+
+    def _record(self, outcome: Optional[str]):
+        with self._lock:
+            trial, self._trial = self._trial, False
+            if outcome is None:
+                return
+            if outcome == "ok":
+                self._failures = 0
+                self._opened_at = None
+                self._rate = min(self.max_rate, self._rate + self.increase)
+                return
+            if outcome == "throttled":
+                self._rate = max(self.min_rate, self._rate * self.decrease)
+            self._failures += 1
+            if trial or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+class GuardedClient:
+    """Wraps a DynamoDB client so that every request goes through a Guard.
+
+    Pass as the engine's client, so loads, saves, each page of a query or scan, and transactions are all covered:
+
+        client = boto3.client("dynamodb", config=botocore.config.Config(retries={"max_attempts": 0}))
+        engine = bloop.Engine(dynamodb=GuardedClient(client, Guard()))
+
+    Turn off botocore's own retries as above; otherwise they sleep inside the call while holding up the worker.
+    Calls aren't started once the current request's deadline has passed."""
+    def __init__(self, client, guard: Guard, deadline: Deadline=default_deadline):
+        self._client = client
+        self.guard = guard
+        self.deadline = deadline
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._client, name)
+        if name in GUARDED_OPERATIONS:
+            return functools.partial(self._call, name, attr)
+        return attr
+
+    def _call(self, name: str, operation: Callable[..., Any], **request) -> Any:
+        self.deadline.check(name)
+        return self.guard.call(operation, **request)
+
+
+def _classify(error: botocore.exceptions.ClientError) -> str:
+    response = error.response
+    code = response.get("Error", {}).get("Code")
+    if code in THROTTLING_ERRORS:
+        return "throttled"
+    if code == "TransactionCanceledException":
+        reasons = response.get("CancellationReasons") or []
+        if any(reason.get("Code") in {"ThrottlingError", "ProvisionedThroughputExceeded"} for reason in reasons):
+            return "throttled"
+    if response.get("ResponseMetadata", {}).get("HTTPStatusCode", 400) >= 500:
+        return "failed"
+    return "ok"
@@ -1,45 +1,87 @@
 import uuid
-from typing import Union
+from typing import Optional, Sequence, Union
 
 import bloop
 import pendulum
 
 from ..models import User, UserName
-from .common import AlreadyExists, NotFound, NotSaved, persist_unique
+from .common import AlreadyExists, NotFound, NotSaved, cancellation_reasons, if_not_exist, key_projection
+from .hedging import HedgePolicy, hedged
+from .identity import IdentityMap, default_identity_map
+from .singleflight import SingleFlight
 from .validation import validate
 
 
 class UserManager:
-    def __init__(self, engine: bloop.Engine):
+    def __init__(
+            self,
+            engine: bloop.Engine,
+            identity_map: IdentityMap=default_identity_map,
+            hedging: Optional[HedgePolicy]=None):
         self.engine = engine
+        # Serves repeat loads within a request; see middleware.UnitOfWork
+        self.identity_map = identity_map
+        # Coalesces concurrent loads of the same item across threads
+        self.loads = SingleFlight()
+        # When set, a slow load in get_user is raced against a second one
+        self.hedging = hedging
 
     def new(self, username: str, email: str, password_hash: Union[str, bytes]) -> User:
         # 1) Validate username, email, password_hash
         username = validate("username", username)
         email = validate("email", email)
         password_hash = validate("password_hash", password_hash)
-        # 2) Try to reserve username
-        username = UserName(username=username, created=pendulum.now())
-        try:
-            self.engine.save(username, condition=UserName.username.is_(None))
-        except bloop.ConstraintViolation:
-            raise AlreadyExists
-        # 3) Try to create unique user_id
+        # 2) Reserve the username and create a unique user_id in a single transaction
         user = User(password_hash=password_hash, email=email, verification_code=uuid.uuid4())
-        persist_unique(user, self.engine, "user_id", uuid.uuid4)
+        username = UserName(
+            username=username, created=pendulum.now(),
+            password_hash=password_hash, verified=False, deleted=False)
+        username_condition = UserName.username.is_(None)
+        user_condition = if_not_exist(user)
+        tries = 10
+        while tries:
+            user.user_id = username.user_id = uuid.uuid4()
+            tx = self.engine.transaction()
+            tx.save(username, condition=username_condition)
+            tx.save(user, condition=user_condition)
+            try:
+                tx.prepare().commit()
+                self.loads.forget(User, user.user_id)
+                self.loads.forget(UserName, username.username)
+                self.identity_map.put(user)
+                self.identity_map.put(username)
+                return user
+            except bloop.TransactionCanceled as error:
+                reasons = cancellation_reasons(error)
+                if reasons and reasons[0] == "ConditionalCheckFailed":
+                    raise AlreadyExists
+                # user_id collision (or a transient conflict); try again with a new user_id
+                tries -= 1
+        raise NotSaved(user)
 
-        # 4) Store user_id on username
-        try:
-            username.user_id = user.user_id
-            self.engine.save(username, atomic=True)
-        except bloop.ConstraintViolation:
-            # XXX username was modified during creation of user id.
-            # XXX username and user_id may not sync, making login impossible.
-            raise NotSaved(user)
+    def get_user(self, user_id: Union[str, uuid.UUID], projection: Union[str, Sequence[str]]="all") -> User:
+        """Load a user.  Pass a list of column names as projection to read and decode only those columns
+        (user_id is always included)."""
+        user_id = validate("user_id", user_id)
+        user = self.identity_map.get(User, projection, user_id=user_id)
+        if user is not None:
+            return user
+        variant = projection if projection == "all" else tuple(projection)
+        user = self.loads.do(
+            (User, user_id, variant), lambda: hedged(self.hedging, self._load_user, user_id, projection))
+        self.identity_map.put(user, projection)
         return user
 
-    def get_user(self, user_id: Union[str, uuid.UUID]) -> User:
-        user_id = validate("user_id", user_id)
+    def _load_user(self, user_id: uuid.UUID, projection: Union[str, Sequence[str]]) -> User:
+        if projection != "all":
+            try:
+                return self.engine.query(
+                    User,
+                    key=User.user_id == user_id,
+                    projection=key_projection(User, projection)
+                ).first()
+            except bloop.ConstraintViolation:
+                raise NotFound
         user = User(user_id=user_id)
         try:
             self.engine.load(user)
@@ -49,6 +91,14 @@ class UserManager:
 
     def get_username(self, username: str) -> UserName:
         username = validate("username", username)
+        loaded = self.identity_map.get(UserName, username=username)
+        if loaded is not None:
+            return loaded
+        loaded = self.loads.do((UserName, username), lambda: self._load_username(username))
+        self.identity_map.put(loaded)
+        return loaded
+
+    def _load_username(self, username: str) -> UserName:
         username = UserName(username=username)
         try:
             self.engine.load(username)
@@ -66,28 +116,116 @@ class UserManager:
         except bloop.ConstraintViolation:
             raise NotFound
 
-    def delete_user(self, user_id: Union[str, uuid.UUID]) -> User:
+    def get_login(self, username: str) -> User:
+        """username -> User with the fields needed for password login.
+
+        One read when the UserName's copies of the login fields are current.  UserNames written before those
+        fields existed, or not marked verified, fall back to loading the User; nothing is written here, so pass
+        the User to sync_login once the password has been checked."""
+        username = self.get_username(username)
+        if getattr(username, "verified", False) and getattr(username, "password_hash", None) is not None:
+            return User(
+                user_id=username.user_id,
+                password_hash=username.password_hash,
+                deleted=getattr(username, "deleted", False))
+        return self.get_user(username.user_id)
+
+    def sync_login(self, username: str, user: User):
+        """Copy any of the User's login fields that differ to its UserName, after a successful password login.
+
+        The UserName was loaded by get_login earlier in the request, so when nothing differs (always, after a
+        single-read login) this doesn't read or write anything."""
+        stored = self.get_username(username)
+        changes = {}
+        if getattr(stored, "password_hash", None) != user.password_hash:
+            changes["password_hash"] = user.password_hash
+        # Only ever set: verification is one-way, and a UserName tombstoned concurrently is never un-deleted
+        if user.is_verified and not getattr(stored, "verified", False):
+            changes["verified"] = True
+        if user.is_deleted and not getattr(stored, "deleted", False):
+            changes["deleted"] = True
+        if not changes:
+            return
+        self.identity_map.discard(UserName, username=stored.username)
+        try:
+            self.engine.save(UserName(username=stored.username, **changes), condition=UserName.user_id == user.user_id)
+        except bloop.ConstraintViolation:
+            # The UserName no longer points at this user; leave it alone
+            pass
+        finally:
+            self.loads.forget(UserName, stored.username)
+
+    def delete_user(self, user_id: Union[str, uuid.UUID], username: Optional[str]=None) -> User:
+        """Tombstone the User and its UserName together.
+
+        Pass username when it's already known to skip the by_user_id lookup."""
         user_id = validate("user_id", user_id)
+        self.identity_map.discard(User, user_id=user_id)
         user = User(user_id=user_id, deleted=True)
+        if username is None:
+            try:
+                username = self.get_username_by_user_id(user_id).username
+            except NotFound:
+                raise NotSaved(user)
+        tx = self.engine.transaction()
+        tx.save(user, condition=User.user_id.is_not(None))
+        tx.save(UserName(username=username, deleted=True), condition=UserName.user_id == user_id)
+        self.identity_map.discard(UserName, username=username)
         try:
-            self.engine.save(user, condition=User.user_id.is_not(None))
-        except bloop.ConstraintViolation:
+            tx.prepare().commit()
+        except bloop.TransactionCanceled:
             raise NotSaved(user)
+        finally:
+            # Loads that started before the commit may have read the live user
+            self.loads.forget(User, user_id)
+            self.loads.forget(UserName, username)
         return user
 
-    def verify(self, user: User, verification_code: str):
+    def verify(
+            self, user_id: Union[str, uuid.UUID], verification_code: Union[str, uuid.UUID],
+            username: Optional[str]=None) -> None:
+        """Clear the user's verification code and mark its UserName verified, in one conditional transaction.
+
+        Only when that fails is the user loaded, to tell an already-verified user (success) apart from a
+        missing user (NotFound) or the wrong code (NotSaved).  Pass username when it's already known to skip the
+        by_user_id lookup."""
+        user_id = validate("user_id", user_id)
         code = validate("verification_code", verification_code)
-        current_code = getattr(user, "verification_code", None)
-        # User already verified, nothing to do
-        if current_code is None:
+        if username is None:
+            username = self.get_username_by_user_id(user_id).username
+        self.identity_map.discard(User, user_id=user_id)
+        self.identity_map.discard(UserName, username=username)
+        try:
+            self._verify(user_id, code, username)
+        finally:
+            # Loads that started before the update may have read the old code
+            self.loads.forget(User, user_id)
+            self.loads.forget(UserName, username)
+
+    def _verify(self, user_id: uuid.UUID, code: uuid.UUID, username: str):
+        if self._mark_verified(user_id, username, User.verification_code == code):
+            return
+        user = self.get_user(user_id)
+        # User already verified (possibly by a concurrent request), nothing to do.  A UserName that missed the
+        # copy is repaired by the next login, through sync_login
+        if user.is_verified:
+            return
+        # The code matches but is still stored in the old string form, which the binary condition can't match.
+        # Codes are never reissued, so any code still present is this one.  If this fails it was cleared
+        # concurrently.
+        if user.verification_code == code:
+            self._mark_verified(user_id, username, User.verification_code.is_not(None))
             return
-        # Try to clear the verification code
-        elif code == current_code:
-            try:
-                user.verification_code = None
-                self.engine.save(user, atomic=True)
-            except bloop.ConstraintViolation:
-                raise NotSaved(user)
         # User has verification code, doesn't match the one we're trying to use
-        else:
-            raise NotSaved(user)
+        raise NotSaved(user)
+
+    def _mark_verified(self, user_id: uuid.UUID, username: str, condition) -> bool:
+        """False when the transaction was canceled, usually because condition on the User failed"""
+        tx = self.engine.transaction()
+        tx.save(User(user_id=user_id, verification_code=None), condition=condition)
+        tx.save(UserName(username=username, verified=True), condition=UserName.user_id == user_id)
+        try:
+            tx.prepare().commit()
+        except bloop.TransactionCanceled:
+            return False
+        return True
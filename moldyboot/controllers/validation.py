@@ -1,3 +1,4 @@
+import base64
 import re
 import uuid
 
@@ -31,6 +32,8 @@ SIGNATURE_PATTERN_HUMAN = """^Signature headers="([^"]*)" id="([^@"]*)@([^"]*)"
 USERNAME_PATTERN = re.compile("^[a-zA-Z][a-zA-Z0-9]{2,15}$")
 # $2b$\d\d$[53 non-standard base64]
 BCRYPT_HASH_PATTERN = re.compile(b"^\$2b\$\d\d\$[a-zA-Z0-9/.]{53}$")
+# most public keys accepted in one request; each one is parsed before any are stored
+MAX_PUBLIC_KEYS = 25
 
 
 class Result:
@@ -76,6 +79,17 @@ validators["key_id"] = _validate_uuid
 validators["verification_code"] = _validate_uuid
 
 
+def _validate_key_cursor(cursor):
+    # KeyManager.list_keys_page: the last key_id of the previous page, urlsafe base64 without padding
+    try:
+        return Result.of(uuid.UUID(bytes=base64.urlsafe_b64decode(cursor + "==")))
+    except (ValueError, TypeError):
+        return Result.error("must be a cursor returned with a previous page")
+
+
+validators["key_cursor"] = _validate_key_cursor
+
+
 def _validate_authorization_header(signature):
     match = SIGNATURE_PATTERN.match(signature)
     if not match:
@@ -120,7 +134,8 @@ def _validate_public_key(public):
                 data=public,
                 backend=default_backend()
             ))
-        except (TypeError, ValueError, AttributeError, UnsupportedAlgorithm):
+        # KeyError: a JWK without "e" or "n" (eg. an EC key)
+        except (TypeError, ValueError, AttributeError, KeyError, UnsupportedAlgorithm):
             continue
     return Result.error("Malformed public key")
 
@@ -128,6 +143,26 @@ def _validate_public_key(public):
 validators["public_key"] = _validate_public_key
 
 
+def _validate_public_keys(publics):
+    # JWK Set: {"keys": [{"kty": "RSA", "e": ..., "n": ...}, ...]}
+    if isinstance(publics, dict) and "keys" in publics:
+        publics = publics["keys"]
+    if not isinstance(publics, list) or not publics:
+        return Result.error("Must be a JWK Set or a non-empty list of public keys")
+    if len(publics) > MAX_PUBLIC_KEYS:
+        return Result.error("Must contain at most {} public keys".format(MAX_PUBLIC_KEYS))
+    loaded = []
+    for index, public in enumerate(publics):
+        result = _validate_public_key(public)
+        if result.error:
+            return Result.error("Malformed public key at index {}".format(index))
+        loaded.append(result.value)
+    return Result.of(loaded)
+
+
+validators["public_keys"] = _validate_public_keys
+
+
 def _validate_password_hash(password_hash):
     if isinstance(password_hash, str):
         password_hash = password_hash.encode("utf-8")
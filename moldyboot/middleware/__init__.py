@@ -1,5 +1,7 @@
 from .authentication import Authentication
+from .deadline import RequestDeadline
 from .translate_json import BodyWrapper, TranslateJSON
+from .unit_of_work import UnitOfWork
 
 
-__all__ = ["Authentication", "BodyWrapper", "TranslateJSON"]
+__all__ = ["Authentication", "BodyWrapper", "RequestDeadline", "TranslateJSON", "UnitOfWork"]
@@ -1,4 +1,5 @@
 import functools
+from typing import Optional
 
 import falcon
 
@@ -11,6 +12,7 @@ from ..controllers import (
 )
 from ..resources import get_metadata, has_tag
 from ..security import passwords, signatures
+from ..security.principals import KeyPrincipal, UserPrincipal
 
 
 failure = functools.partial(falcon.HTTPUnauthorized, title="Authentication failed", challenges=None)
@@ -57,32 +59,44 @@ def authenticate_signature(method, path, headers, body, headers_to_sign, key_man
     return key
 
 
-def authenticate_password(username, password, user_manager: UserManager):
-    # 0) username -> UserName
+def authenticate_password(
+        username, password, user_manager: UserManager, cache: Optional[passwords.CheckCache]=None):
+    # 1) username -> User (login fields only)
     try:
-        username = user_manager.get_username(username)
-    except (InvalidParameter, NotFound):
-        raise failure(description="Invalid username/password")
-    # 1) UserName -> User
-    try:
-        user = user_manager.get_user(username.user_id)
+        user = user_manager.get_login(username)
     except (InvalidParameter, NotFound):
         raise failure(description="Invalid username/password")
 
     # 2) Compare passwords
     try:
-        passwords.check(password=password, expected_hash=user.password_hash)
+        if cache is None:
+            passwords.check(password=password, expected_hash=user.password_hash)
+        elif user.is_deleted:
+            # Tombstoned users never log in again; don't keep their entries around
+            cache.invalidate(user.user_id)
+            passwords.check(password=password, expected_hash=user.password_hash)
+        else:
+            cache.check(user_id=user.user_id, password=password, expected_hash=user.password_hash)
     except passwords.BadPassword:
         raise failure(description="Invalid username/password")
 
+    # 3) Only now that the caller is known to hold the password, repair the UserName's copy of the login fields
+    user_manager.sync_login(username, user)
+
     # Success! Return user_id of the user that just authenticated
     return user
 
 
 class Authentication:
-    def __init__(self, key_manager: KeyManager, user_manager: UserManager):
+    def __init__(
+            self,
+            key_manager: KeyManager,
+            user_manager: UserManager,
+            login_cache: Optional[passwords.CheckCache]=None):
         self.key_manager = key_manager
         self.user_manager = user_manager
+        # Opt-in: skip bcrypt for repeated basic auth within a few seconds
+        self.login_cache = login_cache
 
     def process_resource(self, req: falcon.Request, resp: falcon.Response, resource, params):
         if req.method.lower() == "options":
@@ -99,7 +113,8 @@ class Authentication:
         else:
             self._signature_auth(req, resource)
 
-        # Both basic auth and signature auth populate the auth context with a user.
+        # Both basic auth and signature auth populate the auth context with a user (a UserPrincipal, and for
+        # signature auth a KeyPrincipal; resources load the models if they need them).
         user = req.context["authentication"]["user"]
 
         # Unverified users always fail authentication
@@ -120,8 +135,8 @@ class Authentication:
             password = body["password"]
         except KeyError:
             raise failure(description="password is missing")
-        user = authenticate_password(username, password, self.user_manager)
-        req.context["authentication"] = {"user": user}
+        user = authenticate_password(username, password, self.user_manager, self.login_cache)
+        req.context["authentication"] = {"user": UserPrincipal.from_user(user)}
 
     def _signature_auth(self, req: falcon.Request, resource):
         method = req.method
@@ -140,7 +155,8 @@ class Authentication:
             additional_headers_to_sign = []
         key = authenticate_signature(method, path, headers, body, additional_headers_to_sign, self.key_manager)
         try:
-            user = self.user_manager.get_user(key.user_id)
+            # Only the flags checked in process_resource; skip reading and decoding the password hash and email
+            user = self.user_manager.get_user(key.user_id, projection=["verification_code", "deleted"])
         except NotFound:
             raise failure(description="Unknown user")
-        req.context["authentication"] = {"key": key, "user": user}
+        req.context["authentication"] = {"key": KeyPrincipal.from_key(key), "user": UserPrincipal.from_user(user)}
@@ -0,0 +1,19 @@
+import falcon
+
+from ..controllers import Deadline, default_deadline
+
+
+class RequestDeadline:
+    """Gives each request `timeout` seconds, after which storage and queue calls raise DeadlineExceeded.
+
+    Keep timeout under the proxy's read timeout, so work stops once the client has been given an error.
+    Put it first, so the time spent in the rest of the middleware counts."""
+    def __init__(self, timeout: float, deadline: Deadline=default_deadline):
+        self.timeout = timeout
+        self.deadline = deadline
+
+    def process_request(self, req: falcon.Request, resp: falcon.Response):
+        self.deadline.begin(self.timeout)
+
+    def process_response(self, req: falcon.Request, resp: falcon.Response, resource):
+        self.deadline.end()
@@ -0,0 +1,23 @@
+import falcon
+
+from ..clock import Clock, default_clock
+from ..controllers import IdentityMap, default_identity_map
+
+
+class UnitOfWork:
+    """Scopes the managers' identity map and the clock to a single request.
+
+    Must come before Authentication, so the User and Key it loads can be reused by resources, and the signature
+    date, key expiry and refresh are all checked against the same time."""
+    def __init__(self, identity_map: IdentityMap=default_identity_map, clock: Clock=default_clock):
+        self.identity_map = identity_map
+        self.clock = clock
+
+    def process_request(self, req: falcon.Request, resp: falcon.Response):
+        # Also drops anything left behind if a previous request on this thread didn't reach process_response
+        self.identity_map.begin()
+        self.clock.begin()
+
+    def process_response(self, req: falcon.Request, resp: falcon.Response, resource):
+        self.identity_map.end()
+        self.clock.end()
@@ -2,5 +2,6 @@ from .common import BaseModel
 from .key import Key
 from .user import User, UserName
 from .game import Game, UserGame
+from .codecs import Codec, FastEngine, compile_codec
 
-__all__ = ["BaseModel", "Game", "Key", "User", "UserGame", "UserName"]
+__all__ = ["BaseModel", "Codec", "FastEngine", "Game", "Key", "User", "UserGame", "UserName", "compile_codec"]
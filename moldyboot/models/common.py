@@ -1,3 +1,5 @@
+import uuid
+
 import bloop
 
 __all__ = ["BaseModel"]
@@ -52,3 +54,28 @@ class S3Location(bloop.String):
             "Bucket": bucket,
             "Key": key
         }
+
+
+class CompactUUID(bloop.Binary):
+    """Stored in Dynamo as the UUID's 16 raw bytes instead of bloop.UUID's 36 character string.
+
+    Also loads the string form, so items written with bloop.UUID keep working until they're rewritten
+    (see controllers.compact_uuids).  DynamoDB fixes the type of hash, range, and index key attributes
+    when a table is created, so this can only replace bloop.UUID on columns that aren't part of a key."""
+    python_type = uuid.UUID
+
+    def _load(self, value, **kwargs):
+        if value is not None and bloop.String.backing_type in value:
+            return uuid.UUID(value[bloop.String.backing_type])
+        return super()._load(value, **kwargs)
+
+    def dynamo_load(self, value, *, context, **kwargs):
+        if value is None:
+            return None
+        value = super().dynamo_load(value, context=context, **kwargs)
+        return uuid.UUID(bytes=value)
+
+    def dynamo_dump(self, value, *, context, **kwargs):
+        if value is None:
+            return None
+        return super().dynamo_dump(value.bytes, context=context, **kwargs)
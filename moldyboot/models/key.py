@@ -1,8 +1,7 @@
 import base64
+from typing import Optional
 
-import pendulum
-from bloop import UUID, Binary, Column
-from bloop.ext.pendulum import Timestamp
+from bloop import UUID, Binary, Column, GlobalSecondaryIndex, Integer, String
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey
@@ -17,20 +16,13 @@ def as_bytes(public: RSAPublicKey, encoding: serialization.Encoding):
     )
 
 
-class PublicKeyType(Binary):
-    """Stored in Dynamo in DER.  Locally, an RSAPublicKey"""
-    python_type = RSAPublicKey
+def der_to_pem(der: bytes) -> bytes:
+    """The PEM (SubjectPublicKeyInfo) encoding of a DER public key, without parsing it.
 
-    def dynamo_load(self, value: str, *, context=None, **kwargs) -> RSAPublicKey:
-        value = super().dynamo_load(value, context=context, **kwargs)
-        return serialization.load_der_public_key(
-            data=value,
-            backend=default_backend()
-        )
-
-    def dynamo_dump(self, value: RSAPublicKey, *, context=None, **kwargs) -> str:
-        value = as_bytes(value, serialization.Encoding.DER)
-        return super().dynamo_dump(value, context=context, **kwargs)
+    Byte for byte what cryptography's public_bytes(Encoding.PEM, ...) returns for the same key."""
+    encoded = base64.b64encode(der)
+    lines = [encoded[i:i + 64] for i in range(0, len(encoded), 64)]
+    return b"-----BEGIN PUBLIC KEY-----\n" + b"\n".join(lines) + b"\n-----END PUBLIC KEY-----\n"
 
 
 class Key(BaseModel):
@@ -41,39 +33,56 @@ class Key(BaseModel):
         }
     user_id = Column(UUID, hash_key=True, dynamo_name='u')
     key_id = Column(UUID, range_key=True, dynamo_name='k')
-    public = Column(PublicKeyType, dynamo_name='p')
-    until = Column(Timestamp, dynamo_name='e')
+    # The public key as stored (DER).  Use public for the RSAPublicKey; it's only parsed when first used
+    der = Column(Binary, dynamo_name='p')
+    # Seconds since the epoch; convert with pendulum.from_timestamp only where it's shown to a client
+    until = Column(Integer, dynamo_name='e')
+    # compute_fingerprint(), stored when the key is created.  Empty for keys the backfill hasn't reached yet
+    fingerprint = Column(String, dynamo_name='f')
+
+    by_fingerprint = GlobalSecondaryIndex(
+        projection="keys", hash_key="fingerprint", dynamo_name="by_f")
+
+    def __init__(self, *, public: Optional[RSAPublicKey]=None, **attrs):
+        super().__init__(**attrs)
+        if public is not None:
+            self.public = public
 
     @property
-    def is_expired(self):
-        return pendulum.now() > self.until
+    def public(self) -> RSAPublicKey:
+        der = self.der
+        cached = self.__dict__.get("_public")
+        # der can be replaced (or loaded into this object) after public was parsed
+        if cached is None or cached[0] is not der:
+            cached = self.__dict__["_public"] = (der, serialization.load_der_public_key(
+                data=der,
+                backend=default_backend()
+            ))
+        return cached[1]
+
+    @public.setter
+    def public(self, public: RSAPublicKey):
+        self.der = as_bytes(public, serialization.Encoding.DER)
+        self.__dict__["_public"] = (self.der, public)
+
+    def is_expired_at(self, now: int) -> bool:
+        """Whether the key had expired by now (epoch seconds, eg. from the manager's clock)"""
+        return now > self.until
 
     def compute_fingerprint(self) -> str:
         """Base64 of the SHA256 of public key in PEM format"""
-        public_bytes = as_bytes(self.public, serialization.Encoding.PEM)
         digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
-        digest.update(public_bytes)
+        digest.update(der_to_pem(self.der))
         return base64.b64encode(digest.finalize()).decode("utf-8")
 
     def __eq__(self, other):
         if not isinstance(other, Key):
             return False
         missing = object()
-        for attr in ["user_id", "key_id", "until"]:
+        for attr in ["user_id", "key_id", "der", "until"]:
             self_value = getattr(self, attr, missing)
             other_value = getattr(other, attr, missing)
             if self_value != other_value:
                 return False
-        # Can't do a simple == comparison here because we need to compare the bytes
-        self_public = getattr(self, "public", missing)
-        other_public = getattr(other, "public", missing)
-        if (self_public is missing) != (other_public is missing):
-            # Only 1 is missing
-            return False
-        if self_public is missing:
-            # Both missing, they're equal
-            return True
-        # Both exist, compare byte values
-        enc = serialization.Encoding.DER
-        return as_bytes(self_public, enc) == as_bytes(other_public, enc)
+        return True
     __hash__ = BaseModel.__hash__
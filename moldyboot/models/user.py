@@ -1,7 +1,7 @@
-from bloop import UUID, Binary, Boolean, Column, GlobalSecondaryIndex, String
+from bloop import UUID, Binary, Boolean, Column, GlobalSecondaryIndex, Integer, String
 from bloop.ext.pendulum import DateTime
 
-from .common import BaseModel
+from .common import BaseModel, CompactUUID
 
 
 class UserName(BaseModel):
@@ -11,6 +11,12 @@ class UserName(BaseModel):
     user_id = Column(UUID, dynamo_name="u")
     created = Column(DateTime, dynamo_name="c")
 
+    # Copies of the User's login fields, so password login is a single read.
+    # Anything that writes these on the User must write them here too.
+    password_hash = Column(Binary, dynamo_name="p")
+    verified = Column(Boolean, dynamo_name="v")
+    deleted = Column(Boolean, dynamo_name="d")
+
     by_user_id = GlobalSecondaryIndex(
         projection="keys", hash_key="user_id", dynamo_name="by_u")
 
@@ -21,8 +27,10 @@ class User(BaseModel):
     user_id = Column(UUID, hash_key=True, dynamo_name="u")
     password_hash = Column(Binary, dynamo_name="p")
     email = Column(String, dynamo_name="e")
-    verification_code = Column(UUID, dynamo_name="v")
+    verification_code = Column(CompactUUID, dynamo_name="v")
     deleted = Column(Boolean, dynamo_name="d")
+    # At least the number of keys the user has; see KeyManager.new
+    key_count = Column(Integer, dynamo_name="n")
 
     @property
     def is_verified(self):
@@ -1,4 +1,5 @@
-from .keys import Keys
+from .errors import handle_deadline_exceeded, handle_unavailable
+from .keys import KeyList, Keys
 from .meta import (
     get_metadata,
     has_tag,
@@ -11,6 +12,7 @@ from .verifications import Verifications
 
 
 __all__ = [
-    "Keys", "Signup", "Verifications",
-    "get_metadata", "has_tag", "require_signed_header", "store_metadata", "tag"
+    "KeyList", "Keys", "Signup", "Verifications",
+    "get_metadata", "handle_deadline_exceeded", "handle_unavailable", "has_tag", "require_signed_header",
+    "store_metadata", "tag"
 ]
@@ -0,0 +1,14 @@
+import falcon
+
+from ..controllers import DeadlineExceeded, Unavailable
+
+
+def handle_unavailable(ex: Unavailable, req: falcon.Request, resp: falcon.Response, params):
+    """Register with api.add_error_handler(Unavailable, handle_unavailable) to fail fast with a 503"""
+    raise falcon.HTTPServiceUnavailable(
+        "Service Unavailable", "Storage is overloaded, try again later.", ex.retry_after)
+
+
+def handle_deadline_exceeded(ex: DeadlineExceeded, req: falcon.Request, resp: falcon.Response, params):
+    """Register with api.add_error_handler(DeadlineExceeded, handle_deadline_exceeded)"""
+    raise falcon.HTTPError(falcon.HTTP_504, "Gateway Timeout", "The request took too long and was abandoned.")
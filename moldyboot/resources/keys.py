@@ -1,17 +1,29 @@
+from typing import Optional, Union
+
 import falcon
+import pendulum
 
-from ..controllers import InvalidParameter, KeyManager, NotSaved
-from ..models import Key, User
+from ..controllers import InvalidParameter, KeyManager, NotFound, NotSaved
+from ..models import Key
+from ..security.principals import KeyPrincipal, UserPrincipal
+from .limits import RateLimit
 from .meta import tag
 
 
-def key_id(user: User, key: Key):
+def isoformat(epoch: int) -> str:
+    """Key times are kept as seconds since the epoch, and only turned into dates for the response"""
+    return pendulum.from_timestamp(epoch, "UTC").isoformat()
+
+
+def key_id(user: UserPrincipal, key: Union[Key, KeyPrincipal]):
     return "{}@{}".format(user.user_id, key.key_id)
 
 
 class Keys:
-    def __init__(self, key_manager: KeyManager):
+    def __init__(self, key_manager: KeyManager, renew_limit: Optional[RateLimit]=None):
         self.key_manager = key_manager
+        # TODO limits should be loaded from config
+        self.renew_limit = renew_limit or RateLimit(rate=1 / 60, burst=10)
 
     def on_get(self, req: falcon.Request, resp: falcon.Response):
         """Caller passed authentication, return the key_id and expiration that their signature passed with"""
@@ -20,23 +32,28 @@ class Keys:
 
         req.context["response"] = {
             "key_id": key_id(user, key),
-            "until": key.until.in_timezone("utc").isoformat(),
-            "fingerprint": key.compute_fingerprint()
+            "until": isoformat(key.until),
+            "fingerprint": key.fingerprint
         }
         resp.status = falcon.HTTP_200
 
     def on_delete(self, req: falcon.Request, resp: falcon.Response):
         """Manually revoke a key"""
-        key = req.context["authentication"]["key"]
+        key = self._signing_key(req)
         self.key_manager.revoke(key)
         resp.status = falcon.HTTP_200
 
     @tag("authentication-basic")
     def on_post(self, req: falcon.Request, resp: falcon.Response):
-        """User logged in with username/password, persist the provided public key and return its id"""
+        """User logged in with username/password, persist the provided public key and return its id.
+
+        To register many keys with one login, pass "public_keys" as a JWK Set or a list of public keys instead."""
         user = req.context["authentication"]["user"]
         body = req.context["body"].json
 
+        if "public_keys" in body:
+            self._post_many(req, resp, user, body["public_keys"])
+            return
         try:
             public_key = body["public_key"]
         except KeyError:
@@ -51,6 +68,89 @@ class Keys:
 
         req.context["response"] = {
             "key_id": key_id(user, key),
-            "until": key.until.in_timezone("utc").isoformat(),
+            "until": isoformat(key.until),
+        }
+        resp.status = falcon.HTTP_200
+
+    def _post_many(self, req: falcon.Request, resp: falcon.Response, user: UserPrincipal, public_keys):
+        try:
+            keys = self.key_manager.new_many(user.user_id, public_keys)
+        except InvalidParameter as exception:
+            raise falcon.HTTPBadRequest("Invalid parameter", exception.message)
+        except NotSaved as exception:
+            raise falcon.HTTPInternalServerError(
+                "Internal Server Error", "Failed to store {} public keys".format(len(exception.obj)))
+
+        req.context["response"] = {
+            "key_ids": [key_id(user, key) for key in keys],
+            # All keys in a batch share the same expiration
+            "until": isoformat(keys[0].until),
+        }
+        resp.status = falcon.HTTP_200
+
+    def on_put(self, req: falcon.Request, resp: falcon.Response):
+        """Caller signed with an existing key, persist the provided public key and return its id.
+
+        If "revoke" is true, the signing key is revoked in the same write."""
+        user = req.context["authentication"]["user"]
+        body = req.context["body"].json
+
+        if not self.renew_limit.allow(user.user_id):
+            raise falcon.HTTPTooManyRequests("Too many requests", "Key renewal is rate limited, try again later.")
+        try:
+            public_key = body["public_key"]
+        except KeyError:
+            raise falcon.HTTPBadRequest("Missing required parameter", "Must provide a public key.")
+        revoke = body.get("revoke", False) is True
+        key = self._signing_key(req)
+        try:
+            new_key = self.key_manager.renew(key, public_key, revoke=revoke)
+        except InvalidParameter:
+            raise falcon.HTTPBadRequest("Invalid parameter", "Expected public key in PEM format.")
+        except NotSaved:
+            raise falcon.HTTPInternalServerError("Internal Server Error", "Failed to store public key")
+
+        req.context["response"] = {
+            "key_id": key_id(user, new_key),
+            "until": isoformat(new_key.until),
+        }
+        resp.status = falcon.HTTP_200
+
+    def _signing_key(self, req: falcon.Request) -> Key:
+        """The Key model for the key the request was signed with; authentication already loaded it this request"""
+        principal = req.context["authentication"]["key"]
+        try:
+            return self.key_manager.get_key(principal.user_id, principal.key_id)
+        except NotFound:
+            # Revoked or expired since authentication
+            raise falcon.HTTPUnauthorized("Authentication failed", "Unknown USER, KEYID ({}, {})".format(
+                principal.user_id, principal.key_id), challenges=None)
+
+
+class KeyList:
+    """Pages through the caller's keys.  GET /keys/list?limit=25&cursor=..."""
+    def __init__(self, key_manager: KeyManager, max_limit: int=100):
+        self.key_manager = key_manager
+        self.max_limit = max_limit
+
+    def on_get(self, req: falcon.Request, resp: falcon.Response):
+        """One page of keys, and the cursor for the next page (null after the last page)"""
+        user = req.context["authentication"]["user"]
+        limit = req.get_param_as_int("limit", min=1, max=self.max_limit) or self.max_limit
+        cursor = req.get_param("cursor")
+        try:
+            keys, cursor = self.key_manager.list_keys_page(user.user_id, cursor=cursor, limit=limit)
+        # Can only be the cursor, since user_id came from authentication
+        except InvalidParameter as exception:
+            raise falcon.HTTPBadRequest("Invalid parameter", "cursor {}".format(exception.message))
+
+        req.context["response"] = {
+            "keys": [{
+                "key_id": key_id(user, key),
+                "until": isoformat(key.until),
+                # Keys created before fingerprints were stored don't have one until the backfill reaches them
+                "fingerprint": key.fingerprint or None
+            } for key in keys],
+            "cursor": cursor
         }
         resp.status = falcon.HTTP_200
@@ -0,0 +1,33 @@
+import collections
+import threading
+import time
+
+
+class RateLimit:
+    """
+    Token bucket per key (usually a user_id), tracked per worker.
+
+    Each key can spend up to `burst` requests at once, refilling at `rate` requests per second.
+    Safe to share between threads.
+    """
+    def __init__(self, *, rate: float, burst: int, max_keys: int=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        # key -> (tokens, last update)
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            tokens, last = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            # Least recently seen keys are the closest to a full bucket anyway
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return allowed
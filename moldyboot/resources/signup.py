@@ -1,15 +1,40 @@
+from typing import Optional
+
 import falcon
 
 from ..controllers import AlreadyExists, UserManager
-from ..security import passwords
+from ..security import challenges, passwords
 from ..tasks import AsyncTasks
 from .meta import tag
 
 
 class Signup:
-    def __init__(self, user_manager: UserManager, async_tasks: AsyncTasks):
+    def __init__(
+            self,
+            user_manager: UserManager,
+            async_tasks: AsyncTasks,
+            challenge_secret: Optional[bytes]=None,
+            difficulty: Optional[challenges.Difficulty]=None,
+            spent: Optional[challenges.SpentChallenges]=None):
         self.user_manager = user_manager
         self.async_tasks = async_tasks
+        # Without a secret, signups don't require a proof-of-work challenge
+        self.challenge_secret = challenge_secret
+        self.difficulty = difficulty or challenges.Difficulty()
+        # Each solved challenge signs up once
+        self.spent = spent or challenges.SpentChallenges()
+
+    @tag("authentication-skip")
+    def on_get(self, req: falcon.Request, resp: falcon.Response):
+        """Issue a proof-of-work challenge that must be solved before calling POST /signup"""
+        if not self.challenge_secret:
+            raise falcon.HTTPNotFound()
+        difficulty = self.difficulty.current
+        req.context["response"] = {
+            "challenge": challenges.issue(secret=self.challenge_secret, difficulty=difficulty),
+            "difficulty": difficulty
+        }
+        resp.status = falcon.HTTP_200
 
     @tag("authentication-skip")
     def on_post(self, req: falcon.Request, resp: falcon.Response):
@@ -19,6 +44,9 @@ class Signup:
             username = body["username"]
         except KeyError:
             raise falcon.HTTPBadRequest("Missing required parameter", "Must provide a username")
+        # Checking the challenge is a few hashes; do it before any bcrypt or dynamo calls
+        if self.challenge_secret:
+            self._check_challenge(body, username)
         try:
             password = body["password"]
         except KeyError:
@@ -39,3 +67,18 @@ class Signup:
 
         req.context["response"] = {"user_id": str(user.user_id)}
         resp.status = falcon.HTTP_200
+
+    def _check_challenge(self, body, username: str):
+        try:
+            challenge = body["challenge"]
+            solution = body["solution"]
+        except KeyError:
+            raise falcon.HTTPBadRequest("Missing required parameter", "Must provide a challenge and solution")
+        try:
+            challenges.verify(
+                secret=self.challenge_secret, challenge=challenge, solution=solution, username=username,
+                spent=self.spent)
+        except challenges.BadChallenge as exception:
+            raise falcon.HTTPBadRequest("Invalid parameter", "Challenge failed: {}".format(exception.args[0]))
+        # Only count signups that did the work; unsolved requests are already cheap to reject
+        self.difficulty.record()
@@ -21,16 +21,11 @@ class Verifications:
         400 if the user_id or verification_code is malformed, doesn't match, or user doesn't exist"""
 
         try:
-            user = self.user_manager.get_user(user_id)
+            self.user_manager.verify(user_id, verification_code)
         except InvalidParameter as exception:
-            fail("user_id must be a uuid but was '{}'".format(exception.value))
+            fail("{} must be a uuid but was '{}'".format(exception.parameter_name, exception.value))
         except NotFound:
             fail("unknown user_id '{}'".format(user_id))
-
-        try:
-            self.user_manager.verify(user, verification_code)
-        except InvalidParameter as exception:
-            fail("verification_code must be a uuid but was '{}'".format(exception.value))
         except NotSaved:
             fail("verification code doesn't match")
 
@@ -1,4 +1,4 @@
-from . import passwords, signatures
+from . import challenges, passwords, principals, signatures
 
 
-__all__ = ["passwords", "signatures"]
+__all__ = ["challenges", "passwords", "principals", "signatures"]
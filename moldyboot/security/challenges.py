@@ -0,0 +1,142 @@
+import collections
+import hashlib
+import hmac
+import math
+import os
+import threading
+from typing import Optional
+
+import pendulum
+
+
+__all__ = ["BadChallenge", "Difficulty", "RedisSpentChallenges", "SpentChallenges", "issue", "solve", "verify"]
+
+# Seconds a client has to solve and submit a challenge
+DEFAULT_TTL = 300
+
+
+class BadChallenge(Exception):
+    pass
+
+
+def issue(*, secret: bytes, difficulty: int, ttl: int=DEFAULT_TTL) -> str:
+    """
+    Returns a signed challenge of the form "{difficulty}.{expires}.{nonce}.{mac}".
+
+    The server doesn't need to remember issued challenges; the mac proves the
+    difficulty and expiration weren't modified by the client.
+    """
+    expires = pendulum.now().int_timestamp + ttl
+    payload = "{}.{}.{}".format(difficulty, expires, os.urandom(16).hex())
+    return "{}.{}".format(payload, _mac(secret, payload))
+
+
+def solve(challenge: str, username: str) -> str:
+    """Brute force a solution for signing up as username.  Clients are expected to do this before calling /signup"""
+    difficulty = int(challenge.split(".", 1)[0])
+    counter = 0
+    while not _is_solution(challenge, username, str(counter), difficulty):
+        counter += 1
+    return str(counter)
+
+
+def verify(*, secret: bytes, challenge: str, solution: str, username: str, spent: Optional["SpentChallenges"]=None):
+    """
+    Throws BadChallenge if the challenge wasn't issued with this secret,
+    has expired, the solution doesn't meet the challenge's difficulty for this username,
+    or (when spent is given) the challenge was already used.
+
+    A solution only holds for the username it was solved for, so it can't be reused to sign up
+    anyone else; spent stops it being resubmitted for the same username.
+    """
+    try:
+        difficulty, expires, nonce, mac = challenge.split(".")
+        difficulty, expires = int(difficulty), int(expires)
+    except (AttributeError, ValueError):
+        raise BadChallenge("Malformed challenge")
+    payload = "{}.{}.{}".format(difficulty, expires, nonce)
+    if not hmac.compare_digest(_mac(secret, payload), mac):
+        raise BadChallenge("Challenge was not issued by this server")
+    if expires < pendulum.now().int_timestamp:
+        raise BadChallenge("Challenge expired")
+    if not (isinstance(solution, str) and isinstance(username, str)) or \
+            not _is_solution(challenge, username, solution, difficulty):
+        raise BadChallenge("Solution does not satisfy the challenge")
+    # Last, so that failed attempts don't use up the challenge
+    if spent is not None and not spent.spend(nonce, expires):
+        raise BadChallenge("Challenge was already used")
+
+
+class SpentChallenges:
+    """
+    Remembers the nonces of challenges that were used, until the challenges expire.
+
+    Per worker; with several workers use RedisSpentChallenges, or a replay can be accepted once per worker.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # nonce -> expires
+        self._spent = collections.OrderedDict()
+
+    def spend(self, nonce: str, expires: int) -> bool:
+        """False if the nonce was already spent"""
+        now = pendulum.now().int_timestamp
+        with self._lock:
+            # Challenges are issued with the same ttl, so the oldest entries expire first
+            while self._spent and next(iter(self._spent.values())) < now:
+                self._spent.popitem(last=False)
+            if nonce in self._spent:
+                return False
+            self._spent[nonce] = expires
+            return True
+
+
+class RedisSpentChallenges(SpentChallenges):
+    """SpentChallenges shared by every worker, with keys that expire along with the challenge"""
+    def __init__(self, connection, prefix: str="challenge:"):
+        self.connection = connection
+        self.prefix = prefix
+
+    def spend(self, nonce: str, expires: int) -> bool:
+        ttl = max(1, expires - pendulum.now().int_timestamp)
+        return bool(self.connection.set(self.prefix + nonce, 1, nx=True, ex=ttl))
+
+
+class Difficulty:
+    """
+    Scales challenge difficulty with recent signup load.
+
+    Each doubling of signups over the threshold (within the trailing window) adds one bit,
+    which doubles the expected work for a client.  Tracked per worker, since every worker
+    sees a roughly even share of the load.
+    """
+    def __init__(self, *, minimum: int=16, maximum: int=24, threshold: int=10, window: int=60):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.threshold = threshold
+        self.window = window
+        # Past this many events the difficulty is pinned at maximum, so there's no sense tracking more
+        self._events = collections.deque(maxlen=threshold * 2 ** (maximum - minimum))
+
+    def record(self):
+        self._events.append(pendulum.now().timestamp())
+
+    @property
+    def current(self) -> int:
+        cutoff = pendulum.now().timestamp() - self.window
+        while self._events and self._events[0] < cutoff:
+            self._events.popleft()
+        load = len(self._events)
+        if load <= self.threshold:
+            return self.minimum
+        return min(self.maximum, self.minimum + math.ceil(math.log2(load / self.threshold)))
+
+
+def _mac(secret: bytes, payload: str) -> str:
+    return hmac.new(secret, payload.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def _is_solution(challenge: str, username: str, solution: str, difficulty: int) -> bool:
+    """True if sha256("{challenge}:{username}:{solution}") has at least `difficulty` leading zero bits"""
+    digest = hashlib.sha256("{}:{}:{}".format(challenge, username, solution).encode("utf-8")).digest()
+    return int.from_bytes(digest, "big") >> (256 - difficulty) == 0
@@ -1,3 +1,9 @@
+import collections
+import hashlib
+import hmac
+import os
+import threading
+import time
 from typing import Union
 
 import bcrypt
@@ -27,3 +33,50 @@ def check(*, password: Union[str, bytes], expected_hash: Union[str, bytes]):
     matches = bcrypt.hashpw(password, expected_hash) == expected_hash
     if not matches:
         raise BadPassword("Password does not match expected_hash")
+
+
+class CheckCache:
+    """
+    Remembers successful checks for a few seconds so that immediate repeats skip bcrypt.
+
+    Entries are keyed by user id and an HMAC of the password under a secret that never leaves this
+    process; the plaintext is never stored.  An entry only matches while the user's stored hash is
+    unchanged, so a password change invalidates it without any coordination.
+
+    Safe to share between threads; bcrypt runs outside the lock.
+    """
+    def __init__(self, *, ttl: float=30, max_size: int=1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._secret = os.urandom(32)
+        # (user_id, mac) -> (expected_hash, expires)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, *, user_id, password: Union[str, bytes], expected_hash: Union[str, bytes]):
+        """Same as passwords.check, except a recent identical success doesn't call bcrypt"""
+        if isinstance(password, str):
+            password = password.encode("utf-8")
+        if isinstance(expected_hash, str):
+            expected_hash = expected_hash.encode("utf-8")
+        key = (user_id, hmac.new(self._secret, password, hashlib.sha256).digest())
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                cached_hash, expires = entry
+                if now <= expires and hmac.compare_digest(cached_hash, expected_hash):
+                    self._entries[key] = entry
+                    return
+
+        check(password=password, expected_hash=expected_hash)
+        with self._lock:
+            self._entries[key] = (expected_hash, now + self.ttl)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == user_id]:
+                del self._entries[key]
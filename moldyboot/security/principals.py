@@ -0,0 +1,73 @@
+"""Who a request was authenticated as.
+
+The auth path hands resources these instead of the bloop models it loaded: a handful of immutable fields in
+__slots__, with no column tracking or per-instance dict, so they're cheap to keep around (eg. in a cache).
+Resources that need the full model load it by id through the managers; within a request that's served from
+the identity map."""
+import uuid
+
+from ..models import Key, User
+
+__all__ = ["KeyPrincipal", "UserPrincipal"]
+
+
+class _Principal:
+    __slots__ = ()
+
+    def __init__(self, **attrs):
+        for name in self.__slots__:
+            object.__setattr__(self, name, attrs[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{} is immutable".format(self.__class__.__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError("{} is immutable".format(self.__class__.__name__))
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self._values() == other._values()
+
+    def __hash__(self):
+        return hash(self._values())
+
+    def __repr__(self):
+        return "{}({})".format(
+            self.__class__.__name__,
+            ", ".join("{}={!r}".format(name, getattr(self, name)) for name in self.__slots__))
+
+
+class KeyPrincipal(_Principal):
+    """The key a request was signed with"""
+    __slots__ = ("user_id", "key_id", "der", "fingerprint", "until")
+
+    def __init__(
+            self, *,
+            user_id: uuid.UUID, key_id: uuid.UUID, der: bytes, fingerprint: str, until: int):
+        super().__init__(user_id=user_id, key_id=key_id, der=der, fingerprint=fingerprint, until=until)
+
+    @classmethod
+    def from_key(cls, key: Key) -> "KeyPrincipal":
+        return cls(
+            user_id=key.user_id,
+            key_id=key.key_id,
+            der=key.der,
+            # Keys created before fingerprints were stored don't have one until the backfill reaches them
+            fingerprint=getattr(key, "fingerprint", None) or key.compute_fingerprint(),
+            until=key.until)
+
+
+class UserPrincipal(_Principal):
+    """The user a request was authenticated as, by signature or password"""
+    __slots__ = ("user_id", "is_verified", "is_deleted")
+
+    def __init__(self, *, user_id: uuid.UUID, is_verified: bool, is_deleted: bool):
+        super().__init__(user_id=user_id, is_verified=is_verified, is_deleted=is_deleted)
+
+    @classmethod
+    def from_user(cls, user: User) -> "UserPrincipal":
+        return cls(user_id=user.user_id, is_verified=user.is_verified, is_deleted=user.is_deleted)
@@ -13,6 +13,8 @@ from cryptography.hazmat.primitives.asymmetric.rsa import (
     RSAPublicKey,
 )
 
+from ..clock import Clock, default_clock
+
 
 __all__ = ["sign", "verify"]
 
@@ -67,12 +69,13 @@ def verify(*,
            public_key: RSAPublicKey,
            signature: str,
            signed_headers: Sequence[str],
-           headers_to_sign: Optional[Sequence[str]]=None):
+           headers_to_sign: Optional[Sequence[str]]=None,
+           clock: Clock=default_clock):
     """
     Throws BadSignature with detailed info if any part of the signature
     verification fails.
     """
-    now = pendulum.now().in_timezone("utc")
+    now = clock.now()
     method = method.lower()
     headers_to_sign = (headers_to_sign or [])[:]
 
@@ -173,14 +176,14 @@ def _insert_authorization_header(headers: Dict[str, str], headers_to_sign: Seque
     headers["authorization"] = auth_format.format(" ".join(headers_to_sign), id, signature)
 
 
-def _verify_date(headers: Dict[str, str], now: pendulum.Pendulum):
+def _verify_date(headers: Dict[str, str], now: int):
     iso8601_date = headers["x-date"]
     try:
         date = pendulum.parse(iso8601_date)
     except pendulum.parsing.exceptions.ParserError:
         raise BadSignature("x-date must be ISO8601 UTC")
     # TODO offset should be loaded from config
-    within_range = now.subtract(minutes=5) <= date <= now.add(minutes=5)
+    within_range = now - 5 * 60 <= date.timestamp() <= now + 5 * 60
     if not within_range:
         raise BadSignature("x-date not within 5 minutes of current time")
 
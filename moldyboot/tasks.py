@@ -5,11 +5,13 @@ import rq
 
 from . import templates
 from .controllers import (
+    Deadline,
     InvalidParameter,
     KeyManager,
     NotFound,
     NotSaved,
     UserManager,
+    default_deadline,
 )
 
 
@@ -42,14 +44,26 @@ Result.empty = Result.of(None)
 
 
 class AsyncTasks:
-    def __init__(self, queue: rq.Queue):
+    def __init__(self, queue: rq.Queue, deadline: Deadline=default_deadline):
         self.queue = queue
+        # Tasks aren't enqueued for a request that's already out of time
+        self.deadline = deadline
 
     def send_verification(self, username: str):
-        return self.queue.enqueue(_send_verification, username)
+        return self._enqueue(_send_verification, username)
 
     def delete_user(self, username: str):
-        return self.queue.enqueue(_delete_user, username)
+        return self._enqueue(_delete_user, username)
+
+    def sweep_expired_keys(self):
+        return self._enqueue(_sweep_expired_keys)
+
+    def backfill_fingerprints(self):
+        return self._enqueue(_backfill_fingerprints)
+
+    def _enqueue(self, func, *args):
+        self.deadline.check("enqueue")
+        return self.queue.enqueue(func, *args)
 
 
 class RedisContext:
@@ -152,7 +166,7 @@ def _delete_user(username: str):
 
     # 1) Tombstone the User, preventing system-side actions
     try:
-        users.delete_user(user_id)
+        users.delete_user(user_id, username)
     except NotSaved:
         # TODO log failure
         # Don't keep going, something's wrong.
@@ -160,11 +174,26 @@ def _delete_user(username: str):
 
     # 2) Revoke all user Keys, preventing api access.
     #    Ignore errors and delete as many as we can.
-    for key in keys.list_keys(user_id):
-        try:
-            keys.revoke(key, force=True)
-        except NotSaved:
-            # TODO log failure
-            continue
-
-    return Result.of({"username": username, "user_id": user_id})
+    # TODO log failures
+    failed = keys.revoke_all(user_id)
+
+    return Result.of({
+        "username": username,
+        "user_id": user_id,
+        "failed_key_ids": [str(key.key_id) for key in failed]
+    })
+
+
+def _sweep_expired_keys():
+    ctx = _get_context()
+    # Expired keys are already rejected by get_key and eventually removed by the table's ttl;
+    # this just reclaims them sooner, in batches, off the request path.
+    # TODO log failures
+    failed = ctx.key_manager.sweep_expired()
+    return Result.of({"failed_key_ids": ["{}@{}".format(key.user_id, key.key_id) for key in failed]})
+
+
+def _backfill_fingerprints():
+    ctx = _get_context()
+    written, skipped = ctx.key_manager.backfill_fingerprints()
+    return Result.of({"written": written, "skipped": skipped})
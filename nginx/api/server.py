@@ -15,8 +15,8 @@
 # source /services/api/.venv/bin/activate
 # pip install path/to/moldyboot/project
 
-import bloop
 import boto3
+import botocore.config
 import falcon
 import falcon_cors
 import json
@@ -24,30 +24,45 @@ import redis
 import rq
 
 from moldyboot import config
-from moldyboot.middleware import Authentication, TranslateJSON
-from moldyboot.controllers import KeyManager, UserManager
-from moldyboot.models import BaseModel
-from moldyboot.resources import Keys, Signup, Verifications
+from moldyboot.middleware import Authentication, RequestDeadline, TranslateJSON, UnitOfWork
+from moldyboot.controllers import (
+    DeadlineExceeded,
+    Guard,
+    GuardedClient,
+    HedgePolicy,
+    KeyManager,
+    Unavailable,
+    UserManager,
+)
+from moldyboot.models import BaseModel, FastEngine
+from moldyboot.resources import KeyList, Keys, Signup, Verifications, handle_deadline_exceeded, handle_unavailable
 from moldyboot.tasks import AsyncTasks
 
 ROOT = "/services/api"
+# Seconds a request has to finish; just under uwsgi_read_timeout in api.moldyboot.com.nginx
+REQUEST_TIMEOUT = 9
 
-redis_connection = redis.StrictRedis(host="127.0.0.1", port=6379)
+redis_connection = redis.StrictRedis(host="127.0.0.1", port=6379, socket_connect_timeout=1, socket_timeout=2)
 queue = rq.Queue(connection=redis_connection)
 
 with open(ROOT + "/.credentials/aws") as f:
     credentials = json.load(f)
 session = boto3.session.Session(**credentials)
-engine = bloop.Engine(
-    dynamodb=session.client("dynamodb"),
+# Throttling is handled by the guard, instead of botocore retries sleeping inside the worker
+dynamodb = session.client("dynamodb", config=botocore.config.Config(
+    retries={"max_attempts": 0}, connect_timeout=1, read_timeout=REQUEST_TIMEOUT))
+engine = FastEngine(
+    dynamodb=GuardedClient(dynamodb, Guard()),
     dynamodbstreams=session.client("dynamodbstreams"),
     table_name_template=config.table_name_template
 )
 engine.bind(BaseModel)
 
 async_tasks = AsyncTasks(queue)
-key_manager = KeyManager(engine)
-user_manager = UserManager(engine)
+# One policy for both managers, so they share a single budget for duplicate reads
+hedging = HedgePolicy()
+key_manager = KeyManager(engine, hedging=hedging, max_keys=config.max_keys_per_user)
+user_manager = UserManager(engine, hedging=hedging)
 
 cors = falcon_cors.CORS(
     allow_origins_list=[
@@ -59,11 +74,16 @@ cors = falcon_cors.CORS(
     max_age="600")
 api = application = falcon.API(
     middleware=[
+        RequestDeadline(REQUEST_TIMEOUT),
         cors.middleware,
         TranslateJSON(),
+        UnitOfWork(),
         Authentication(key_manager, user_manager)
     ]
 )
+api.add_error_handler(Unavailable, handle_unavailable)
+api.add_error_handler(DeadlineExceeded, handle_deadline_exceeded)
 api.add_route("/keys", Keys(key_manager))
+api.add_route("/keys/list", KeyList(key_manager))
 api.add_route("/signup", Signup(user_manager, async_tasks))
 api.add_route("/verify/{user_id}/{verification_code}", Verifications(user_manager))
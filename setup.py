@@ -11,7 +11,7 @@ def get_version():
 
 requirements = [
     "bcrypt==3.1.1",
-    "bloop>=2.0",
+    "bloop>=2.3,<2.4",
     "boto3>=1.4",
     "click==6.6",
     "cryptography==42.0.8",
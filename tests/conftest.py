@@ -1,3 +1,4 @@
+import time
 import uuid
 from unittest.mock import Mock, patch
 
@@ -7,6 +8,7 @@ import pytest
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.asymmetric import rsa
 
+import moldyboot.clock
 import moldyboot.controllers.key
 import moldyboot.controllers.user
 import moldyboot.middleware
@@ -50,11 +52,30 @@ def fixed_now():
     return now
 
 
+@pytest.fixture
+def fixed_clock():
+    """Freezes moldyboot.clock.default_clock, returning the time in seconds since the epoch it's frozen at"""
+    now = int(time.time())
+    with patch.object(moldyboot.clock.default_clock, "source", lambda: now):
+        yield now
+
+
 @pytest.fixture
 def mock_engine():
     return Mock(spec=bloop.Engine)
 
 
+@pytest.fixture
+def dynamodb():
+    """Mock boto3 DynamoDB client, for tests that need a real engine to render requests"""
+    return Mock()
+
+
+@pytest.fixture
+def engine(dynamodb):
+    return bloop.Engine(dynamodb=dynamodb, dynamodbstreams=Mock(), table_name_template="mb.{table_name}")
+
+
 @pytest.fixture
 def mock_async_tasks():
     return Mock(spec=moldyboot.tasks.AsyncTasks)
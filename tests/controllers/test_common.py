@@ -1,3 +1,8 @@
+import base64
+import time
+import uuid
+
+import botocore.exceptions
 import pytest
 from bloop import (
     BaseModel,
@@ -5,9 +10,23 @@ from bloop import (
     ConstraintViolation,
     GlobalSecondaryIndex,
     Integer,
+    TransactionCanceled,
 )
+from bloop.conditions import get_marked
 
-from moldyboot.controllers import NotSaved, if_not_exist, persist_unique
+from moldyboot.controllers import (
+    NotSaved,
+    batch_delete,
+    batch_save,
+    cancellation_reasons,
+    compact_uuids,
+    if_not_exist,
+    key_projection,
+    persist_unique,
+    save_changes,
+    snapshot,
+)
+from moldyboot.models.common import CompactUUID
 
 
 @pytest.fixture
@@ -81,3 +100,163 @@ def test_persist_calls_rnd(mock_engine, model):
         persist_unique(obj, mock_engine, "data", rnd, 2)
     assert mock_engine.save.call_count == 2
     assert calls == [0, 1]
+
+
+# key_projection ====================================================================================== key_projection
+
+def test_key_projection(model):
+    assert key_projection(model, "all") == "all"
+    assert key_projection(model, []) == ["id"]
+    assert key_projection(model, ["data", "id"]) == ["id", "data"]
+
+
+# save_changes ========================================================================================== save_changes
+
+def test_save_changes_only_changed(mock_engine, model):
+    obj = model(id=3, data=4)
+    before = snapshot(obj)
+    obj.data = 5
+
+    condition = model.data == 4
+    assert save_changes(obj, mock_engine, before, condition=condition) == ["data"]
+    (saved, ), kwargs = mock_engine.save.call_args
+    assert kwargs == {"condition": condition}
+    assert (saved.id, saved.data) == (3, 5)
+    # Only the key and changed columns are marked, so the update won't mention anything else
+    assert get_marked(saved) == {model.id, model.data}
+
+
+def test_save_changes_nothing_changed(mock_engine, model):
+    obj = model(id=3, data=4)
+    before = snapshot(obj)
+
+    assert save_changes(obj, mock_engine, before) == []
+    mock_engine.save.assert_not_called()
+
+
+def test_save_changes_removed(mock_engine, model):
+    obj = model(id=3, data=4)
+    before = snapshot(obj)
+    obj.data = None
+
+    assert save_changes(obj, mock_engine, before) == ["data"]
+    assert mock_engine.save.call_args[0][0].data is None
+
+
+# batch_save ============================================================================================== batch_save
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+    return sleeps
+
+
+def put(id, data):
+    return {"PutRequest": {"Item": {"id": {"N": str(id)}, "data": {"N": str(data)}}}}
+
+
+def test_batch_save_chunks(engine, dynamodb, model):
+    dynamodb.batch_write_item.return_value = {"UnprocessedItems": {}}
+    objs = [model(id=i, data=i * 2) for i in range(30)]
+
+    assert batch_save(objs, engine) == []
+    assert dynamodb.batch_write_item.call_count == 2
+    first, second = dynamodb.batch_write_item.call_args_list
+    assert first[1] == {"RequestItems": {"mb.Model": [put(i, i * 2) for i in range(25)]}}
+    assert second[1] == {"RequestItems": {"mb.Model": [put(i, i * 2) for i in range(25, 30)]}}
+
+
+def test_batch_save_retries_unprocessed(engine, dynamodb, model, no_sleep):
+    objs = [model(id=i, data=i) for i in range(3)]
+    dynamodb.batch_write_item.side_effect = [
+        {"UnprocessedItems": {"mb.Model": [put(1, 1)]}},
+        {"UnprocessedItems": {}}
+    ]
+
+    assert batch_save(objs, engine) == []
+    assert dynamodb.batch_write_item.call_args_list[1][1] == {"RequestItems": {"mb.Model": [put(1, 1)]}}
+    assert len(no_sleep) == 1
+
+
+def test_batch_save_returns_failed(engine, dynamodb, model, no_sleep):
+    objs = [model(id=i, data=i) for i in range(3)]
+    dynamodb.batch_write_item.return_value = {"UnprocessedItems": {"mb.Model": [put(2, 2)]}}
+
+    assert batch_save(objs, engine, max_tries=3) == [objs[2]]
+    assert dynamodb.batch_write_item.call_count == 3
+    # No sleep after the last try
+    assert len(no_sleep) == 2
+
+
+def test_batch_save_empty(engine, dynamodb):
+    assert batch_save([], engine) == []
+    dynamodb.batch_write_item.assert_not_called()
+
+
+# batch_delete ========================================================================================== batch_delete
+
+def delete(id):
+    return {"DeleteRequest": {"Key": {"id": {"N": str(id)}}}}
+
+
+def test_batch_delete(engine, dynamodb, model, no_sleep):
+    objs = [model(id=i) for i in range(27)]
+    dynamodb.batch_write_item.side_effect = [
+        {"UnprocessedItems": {"mb.Model": [delete(3)]}},
+        {"UnprocessedItems": {}},
+        {"UnprocessedItems": {}}
+    ]
+
+    assert batch_delete(objs, engine) == []
+    requests = [c[1]["RequestItems"]["mb.Model"] for c in dynamodb.batch_write_item.call_args_list]
+    assert requests == [[delete(i) for i in range(25)], [delete(3)], [delete(25), delete(26)]]
+
+
+def test_batch_delete_returns_failed(engine, dynamodb, model, no_sleep):
+    objs = [model(id=i) for i in range(3)]
+    dynamodb.batch_write_item.return_value = {"UnprocessedItems": {"mb.Model": [delete(0), delete(2)]}}
+
+    assert batch_delete(objs, engine, max_tries=2) == [objs[0], objs[2]]
+
+
+# compact_uuids ======================================================================================== compact_uuids
+
+def test_compact_uuids(engine, dynamodb):
+    class Thing(BaseModel):
+        id = Column(Integer, hash_key=True)
+        ref = Column(CompactUUID, dynamo_name="r")
+    first, second = uuid.uuid4(), uuid.uuid4()
+    dynamodb.scan.side_effect = [
+        {"Items": [{"id": {"N": "1"}, "r": {"S": str(first)}}], "LastEvaluatedKey": {"id": {"N": "1"}}},
+        {"Items": [{"id": {"N": "2"}, "r": {"S": str(second)}}]},
+    ]
+    conflict = botocore.exceptions.ClientError(
+        {"Error": {"Code": "ConditionalCheckFailedException", "Message": "failed"}}, "UpdateItem")
+    dynamodb.update_item.side_effect = [None, conflict]
+
+    assert compact_uuids(engine, Thing.ref) == (1, 1)
+    first_scan, second_scan = dynamodb.scan.call_args_list
+    assert first_scan[1]["FilterExpression"] == "attribute_type(#c, :s)"
+    assert second_scan[1]["ExclusiveStartKey"] == {"id": {"N": "1"}}
+    update = dynamodb.update_item.call_args_list[0][1]
+    assert update["Key"] == {"id": {"N": "1"}}
+    assert update["ExpressionAttributeValues"] == {
+        ":new": {"B": base64.b64encode(first.bytes).decode("utf-8")},
+        ":old": {"S": str(first)}}
+
+
+# cancellation_reasons ========================================================================== cancellation_reasons
+
+def test_cancellation_reasons():
+    cause = botocore.exceptions.ClientError({
+        "Error": {"Code": "TransactionCanceledException", "Message": "canceled"},
+        "CancellationReasons": [{"Code": "None"}, {"Code": "ConditionalCheckFailed", "Message": "failed"}]
+    }, "TransactWriteItems")
+    error = TransactionCanceled()
+    error.__cause__ = cause
+    assert cancellation_reasons(error) == ["None", "ConditionalCheckFailed"]
+
+
+def test_cancellation_reasons_missing():
+    assert cancellation_reasons(TransactionCanceled()) == []
@@ -0,0 +1,52 @@
+import threading
+
+import pytest
+
+from moldyboot.controllers import Deadline, DeadlineExceeded
+
+
+def test_no_deadline():
+    deadline = Deadline()
+    assert deadline.remaining() is None
+    deadline.check("get_item")
+
+
+def test_check():
+    deadline = Deadline()
+    deadline.begin(60)
+    assert 59 < deadline.remaining() <= 60
+    deadline.check("get_item")
+
+    deadline.begin(0)
+    with pytest.raises(DeadlineExceeded) as excinfo:
+        deadline.check("get_item")
+    assert excinfo.value.operation == "get_item"
+
+    deadline.end()
+    deadline.check("get_item")
+
+
+def test_per_thread():
+    deadline = Deadline()
+    deadline.begin(0)
+    seen = []
+    thread = threading.Thread(target=lambda: seen.append(deadline.remaining()))
+    thread.start()
+    thread.join()
+    assert seen == [None]
+
+
+def test_carry():
+    deadline = Deadline()
+    deadline.begin(0)
+    errors = []
+
+    def work():
+        try:
+            deadline.check("query")
+        except DeadlineExceeded as error:
+            errors.append(error)
+    thread = threading.Thread(target=deadline.carry(work))
+    thread.start()
+    thread.join()
+    assert len(errors) == 1
@@ -0,0 +1,133 @@
+import itertools
+import threading
+
+import pytest
+
+from moldyboot.controllers import HedgePolicy, default_deadline
+from moldyboot.controllers.hedging import hedged
+
+
+def test_fast_read_not_hedged():
+    policy = HedgePolicy(default_delay=5)
+    assert policy.call(lambda: "result") == "result"
+    assert policy.metrics() == {"reads": 1, "hedged": 0, "won": 0, "over_budget": 0}
+
+
+def test_slow_read_hedged():
+    """The duplicate read returns first and wins"""
+    policy = HedgePolicy(default_delay=0.01)
+    release = threading.Event()
+    calls = itertools.count()
+
+    def read():
+        if next(calls) == 0:
+            release.wait(5)
+            return "slow"
+        return "fast"
+
+    try:
+        assert policy.call(read) == "fast"
+    finally:
+        release.set()
+    assert policy.metrics() == {"reads": 1, "hedged": 1, "won": 1, "over_budget": 0}
+
+
+def test_original_read_wins():
+    policy = HedgePolicy(default_delay=0.01)
+    original_done, hedge_started = threading.Event(), threading.Event()
+    calls = itertools.count()
+
+    def read():
+        if next(calls) == 0:
+            hedge_started.wait(5)
+            return "original"
+        hedge_started.set()
+        original_done.wait(5)
+        return "hedge"
+
+    try:
+        assert policy.call(read) == "original"
+    finally:
+        original_done.set()
+    assert policy.metrics() == {"reads": 1, "hedged": 1, "won": 0, "over_budget": 0}
+
+
+def test_over_budget():
+    """With no budget left, a slow read is waited out"""
+    policy = HedgePolicy(default_delay=0.01, budget=0, burst=0)
+    calls = []
+
+    def read():
+        calls.append(1)
+        threading.Event().wait(0.05)
+        return "slow"
+
+    assert policy.call(read) == "slow"
+    assert len(calls) == 1
+    assert policy.metrics() == {"reads": 1, "hedged": 0, "won": 0, "over_budget": 1}
+
+
+def test_budget_refills():
+    policy = HedgePolicy(budget=0.5, burst=1)
+    policy._tokens = 0
+    assert not policy._spend()
+    policy.call(lambda: None)
+    assert not policy._spend()
+    policy.call(lambda: None)
+    assert policy._spend()
+    # Capped at burst
+    for _ in range(10):
+        policy.call(lambda: None)
+    assert policy._spend()
+    assert not policy._spend()
+
+
+def test_both_reads_fail():
+    policy = HedgePolicy(default_delay=0.01)
+    calls = itertools.count()
+
+    def read():
+        if next(calls) == 0:
+            threading.Event().wait(0.05)
+            raise KeyError("original")
+        raise ValueError("hedge")
+
+    with pytest.raises(ValueError):
+        policy.call(read)
+
+
+def test_failed_hedge_falls_back_to_original():
+    policy = HedgePolicy(default_delay=0.01)
+    calls = itertools.count()
+
+    def read():
+        if next(calls) == 0:
+            threading.Event().wait(0.05)
+            return "original"
+        raise ValueError("hedge")
+
+    assert policy.call(read) == "original"
+
+
+def test_delay_tracks_percentile():
+    policy = HedgePolicy(percentile=90, default_delay=1, min_samples=10)
+    for latency in range(1, 10):
+        policy._record(latency / 100)
+    assert policy.delay == 1
+    policy._record(0.1)
+    assert policy.delay == 0.09
+
+
+def test_hedged_without_policy():
+    assert hedged(None, lambda x, y: x + y, 1, 2) == 3
+    assert hedged(HedgePolicy(), lambda x, y: x + y, 1, 2) == 3
+
+
+def test_hedged_carries_deadline():
+    """Reads on the policy's worker threads run under the caller's deadline"""
+    default_deadline.begin(30)
+    try:
+        remaining = hedged(HedgePolicy(), default_deadline.remaining)
+    finally:
+        default_deadline.end()
+    assert 0 < remaining <= 30
@@ -0,0 +1,63 @@
+import threading
+import uuid
+
+from moldyboot.controllers import IdentityMap
+from moldyboot.models import Key, User
+
+
+def test_inactive():
+    """Outside of a request nothing is stored"""
+    identity_map = IdentityMap()
+    user = User(user_id=uuid.uuid4())
+    identity_map.put(user)
+    assert not identity_map.active
+    assert identity_map.get(User, user_id=user.user_id) is None
+
+
+def test_get_put_discard():
+    identity_map = IdentityMap()
+    identity_map.begin()
+    key = Key(user_id=uuid.uuid4(), key_id=uuid.uuid4())
+
+    identity_map.put(key)
+    assert identity_map.get(Key, key_id=key.key_id, user_id=key.user_id) is key
+    assert identity_map.get(Key, key_id=uuid.uuid4(), user_id=key.user_id) is None
+    assert identity_map.get(User, user_id=key.user_id) is None
+
+    identity_map.discard(Key, user_id=key.user_id, key_id=key.key_id)
+    assert identity_map.get(Key, key_id=key.key_id, user_id=key.user_id) is None
+
+
+def test_projection():
+    """A projected object only serves loads that need a subset of its columns"""
+    identity_map = IdentityMap()
+    identity_map.begin()
+    user = User(user_id=uuid.uuid4())
+    identity_map.put(user, ["verification_code", "deleted"])
+
+    assert identity_map.get(User, ["deleted"], user_id=user.user_id) is user
+    assert identity_map.get(User, ["email"], user_id=user.user_id) is None
+    assert identity_map.get(User, user_id=user.user_id) is None
+
+    identity_map.put(user)
+    assert identity_map.get(User, ["email"], user_id=user.user_id) is user
+
+
+def test_end_clears():
+    identity_map = IdentityMap()
+    identity_map.begin()
+    user = User(user_id=uuid.uuid4())
+    identity_map.put(user)
+    identity_map.end()
+    identity_map.begin()
+    assert identity_map.get(User, user_id=user.user_id) is None
+
+
+def test_per_thread():
+    identity_map = IdentityMap()
+    identity_map.begin()
+    seen = []
+    thread = threading.Thread(target=lambda: seen.append(identity_map.active))
+    thread.start()
+    thread.join()
+    assert seen == [False]
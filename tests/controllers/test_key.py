@@ -1,11 +1,15 @@
+import threading
 import uuid
+from unittest.mock import Mock, call
 
 import bloop
 import pytest
-from tests.helpers import as_der
+from tests.helpers import as_der, client_error
 
-from moldyboot.controllers import InvalidParameter, NotFound, NotSaved
-from moldyboot.models import Key
+import moldyboot.controllers.key
+from moldyboot.clock import Clock
+from moldyboot.controllers import HedgePolicy, IdentityMap, InvalidParameter, KeyManager, NotFound, NotSaved
+from moldyboot.models import Key, User
 
 
 def test_new_invalid_user_id(rsa_pub, key_manager):
@@ -26,10 +30,10 @@ def test_new_invalid_public_key(key_manager):
     key_manager.engine.assert_not_called()
 
 
-def test_new_unique_fails(rsa_pub, key_manager, fixed_now, fixed_uuid):
+def test_new_unique_fails(rsa_pub, key_manager, fixed_clock, fixed_uuid):
     public = as_der(rsa_pub)
 
-    expected_key = Key(user_id=fixed_uuid, public=rsa_pub, until=fixed_now.add(hours=1))
+    expected_key = Key(user_id=fixed_uuid, public=rsa_pub, until=fixed_clock + 3600)
     expected_condition = Key.user_id.is_(None) & Key.key_id.is_(None)
     key_manager.engine.save.side_effect = bloop.ConstraintViolation("save", expected_key)
 
@@ -44,50 +48,356 @@ def test_new_unique_fails(rsa_pub, key_manager, fixed_now, fixed_uuid):
     key_manager.engine.save.assert_any_call(actual_key, condition=expected_condition)
 
 
-def test_new_success(rsa_pub, key_manager, fixed_now, fixed_uuid):
+def test_new_success(rsa_pub, key_manager, fixed_clock, fixed_uuid):
     user_id = uuid.uuid4()
     public = as_der(rsa_pub)
 
-    key_manager.new(user_id, public)
+    key = key_manager.new(user_id, public)
 
-    expected_key = Key(user_id=user_id, public=rsa_pub, until=fixed_now.add(hours=1), key_id=fixed_uuid)
+    expected_key = Key(user_id=user_id, public=rsa_pub, until=fixed_clock + 3600, key_id=fixed_uuid)
     expected_condition = Key.user_id.is_(None) & Key.key_id.is_(None)
     key_manager.engine.save.assert_called_once_with(expected_key, condition=expected_condition)
+    assert key.fingerprint == expected_key.compute_fingerprint()
 
 
-def test_get_valid(key_manager, fixed_now):
+# max_keys ================================================================================================== max_keys
+
+@pytest.fixture
+def capped(mock_engine):
+    """KeyManager with max_keys=3; set .stored (User.key_count) and .keys (the user's keys) before calling new"""
+    key_manager = KeyManager(mock_engine, max_keys=3)
+    key_manager.stored, key_manager.keys = None, []
+
+    def query(model, key, projection, consistent=False):
+        assert consistent
+        if model is Key:
+            assert projection == ["key_id", "user_id", "until"]
+            # Unordered, like the table
+            return iter(reversed(key_manager.keys))
+        assert model is User
+        assert projection == ["user_id", "key_count"]
+        user = User(user_id=uuid.uuid4(), key_count=key_manager.stored)
+        return Mock(first=Mock(return_value=user))
+    mock_engine.query.side_effect = query
+    return key_manager
+
+
+def capped_writes(key_manager):
+    tx = key_manager.engine.transaction.return_value
+    (key, ), key_kwargs = tx.save.call_args_list[0]
+    (counter, ), counter_kwargs = tx.save.call_args_list[1]
+    return key, key_kwargs["condition"], counter, counter_kwargs["condition"], tx.delete.call_args_list
+
+
+def test_new_capped_first_key(rsa_pub, capped, fixed_clock):
+    user_id = uuid.uuid4()
+    key = capped.new(user_id, as_der(rsa_pub))
+
+    saved, condition, counter, counted, deletes = capped_writes(capped)
+    assert saved is key and condition == Key.user_id.is_(None) & Key.key_id.is_(None)
+    assert (counter.user_id, counter.key_count) == (user_id, 1)
+    # Never creates a User
+    assert counted == User.key_count.is_(None) & User.user_id.is_not(None)
+    assert deletes == []
+    capped.engine.save.assert_not_called()
+
+
+def test_new_capped_unset_count(rsa_pub, capped, fixed_clock):
+    """Users with keys from before the cap are counted the first time"""
+    user_id = uuid.uuid4()
+    capped.keys = [Key(user_id=user_id, key_id=uuid.uuid4(), until=fixed_clock + i) for i in range(2)]
+
+    capped.new(user_id, as_der(rsa_pub))
+
+    _, _, counter, counted, deletes = capped_writes(capped)
+    assert counter.key_count == 3
+    assert counted == User.key_count.is_(None) & User.user_id.is_not(None)
+    assert deletes == []
+
+
+def test_new_capped_under_cap(rsa_pub, capped, fixed_clock):
+    capped.stored = 2
+    capped.new(uuid.uuid4(), as_der(rsa_pub))
+
+    _, _, counter, counted, deletes = capped_writes(capped)
+    assert counter.key_count == 3
+    assert counted == (User.key_count == 2)
+    assert deletes == []
+    # No recount below the cap
+    assert capped.engine.query.call_count == 1
+
+
+def test_new_capped_evicts_least_recent(rsa_pub, capped, fixed_clock):
+    """Evicts just enough to make room for the new key"""
+    user_id = uuid.uuid4()
+    capped.stored = 3
+    capped.keys = [Key(user_id=user_id, key_id=uuid.uuid4(), until=fixed_clock + i) for i in range(3)]
+    capped.identity_map.put(capped.keys[0])
+
+    capped.new(user_id, as_der(rsa_pub))
+
+    _, _, counter, counted, deletes = capped_writes(capped)
+    assert counter.key_count == 3
+    assert counted == (User.key_count == 3)
+    assert deletes == [call(capped.keys[0], condition=Key.until == fixed_clock)]
+    assert capped.identity_map.get(Key, user_id=user_id, key_id=capped.keys[0].key_id) is None
+
+
+def test_new_capped_recount(rsa_pub, capped, fixed_clock):
+    """Keys that expired or were revoked aren't subtracted until the count reaches the cap"""
+    user_id = uuid.uuid4()
+    capped.stored = 3
+    capped.keys = [Key(user_id=user_id, key_id=uuid.uuid4(), until=fixed_clock)]
+
+    capped.new(user_id, as_der(rsa_pub))
+
+    _, _, counter, counted, deletes = capped_writes(capped)
+    assert counter.key_count == 2
+    assert counted == (User.key_count == 3)
+    assert deletes == []
+
+
+def test_new_capped_over_cap(rsa_pub, capped, fixed_clock):
+    """Users with more keys than the cap (from before it) shrink back to it"""
+    user_id = uuid.uuid4()
+    capped.stored = 3
+    capped.keys = [Key(user_id=user_id, key_id=uuid.uuid4(), until=fixed_clock + i) for i in range(5)]
+
+    capped.new(user_id, as_der(rsa_pub))
+
+    _, _, counter, _, deletes = capped_writes(capped)
+    assert counter.key_count == 3
+    assert [args[0] for args, _ in deletes] == capped.keys[:3]
+
+
+def test_new_capped_at_cap(rsa_pub, engine, dynamodb, fixed_clock):
+    """Through a real engine: a user at the cap loses only their least recently used key"""
+    user_id, key_ids = uuid.uuid4(), [uuid.uuid4() for _ in range(2)]
+    dynamodb.query.side_effect = [
+        {"Items": [{"u": {"S": str(user_id)}, "n": {"N": "2"}}], "Count": 1, "ScannedCount": 1},
+        # Most recently used first
+        {"Items": [{"u": {"S": str(user_id)}, "k": {"S": str(key_id)}, "e": {"N": str(fixed_clock - i)}}
+                   for i, key_id in enumerate(key_ids)], "Count": 2, "ScannedCount": 2},
+    ]
+    dynamodb.transact_write_items.return_value = {}
+
+    key = KeyManager(engine, max_keys=2).new(user_id, as_der(rsa_pub))
+
+    items = dynamodb.transact_write_items.call_args[1]["TransactItems"]
+    assert len(items) == 3
+    assert items[0]["Update"]["Key"]["k"] == {"S": str(key.key_id)}
+    assert sorted(value["N"] for value in items[1]["Update"]["ExpressionAttributeValues"].values()) == ["2", "2"]
+    assert items[2]["Delete"]["Key"]["k"] == {"S": str(key_ids[1])}
+
+
+def test_new_capped_far_over_cap(rsa_pub, engine, dynamodb, fixed_clock):
+    """Through a real engine: evictions are limited to what fits in one transaction with the key and count"""
+    user_id, key_ids = uuid.uuid4(), [uuid.uuid4() for _ in range(20)]
+    dynamodb.query.side_effect = [
+        {"Items": [{"u": {"S": str(user_id)}, "n": {"N": "20"}}], "Count": 1, "ScannedCount": 1},
+        {"Items": [{"u": {"S": str(user_id)}, "k": {"S": str(key_id)}, "e": {"N": str(fixed_clock + i)}}
+                   for i, key_id in enumerate(key_ids)], "Count": 20, "ScannedCount": 20},
+    ]
+    dynamodb.transact_write_items.return_value = {}
+
+    KeyManager(engine, max_keys=3).new(user_id, as_der(rsa_pub))
+
+    items = dynamodb.transact_write_items.call_args[1]["TransactItems"]
+    assert len(items) == 10
+    counter = items[1]["Update"]
+    assert counter["TableName"] == "mb.users"
+    assert sorted(value["N"] for value in counter["ExpressionAttributeValues"].values()) == ["13", "20"]
+    assert [item["Delete"]["Key"]["k"]["S"] for item in items[2:]] == [str(key_id) for key_id in key_ids[:8]]
+
+
+def test_new_capped_retries(rsa_pub, capped, fixed_clock):
+    commit = capped.engine.transaction.return_value.prepare.return_value.commit
+    commit.side_effect = [bloop.TransactionCanceled, None]
+
+    capped.new(uuid.uuid4(), as_der(rsa_pub))
+    assert commit.call_count == 2
+
+
+def test_new_capped_fails(rsa_pub, capped):
+    commit = capped.engine.transaction.return_value.prepare.return_value.commit
+    commit.side_effect = bloop.TransactionCanceled
+
+    with pytest.raises(NotSaved):
+        capped.new(uuid.uuid4(), as_der(rsa_pub))
+    assert commit.call_count == 10
+
+
+def test_new_capped_unknown_user(rsa_pub, mock_engine):
+    mock_engine.query.return_value.first.side_effect = bloop.ConstraintViolation("first", None)
+    with pytest.raises(NotFound):
+        KeyManager(mock_engine, max_keys=3).new(uuid.uuid4(), as_der(rsa_pub))
+    mock_engine.transaction.assert_not_called()
+
+
+def test_get_valid(key_manager, fixed_clock):
     user_id = uuid.uuid4()
     key_id = uuid.uuid4()
 
-    # Patch engine to return a key with expiry > now
+    # Patch engine to return a key that won't expire soon
     def load(item, *args, **kwargs):
-        item.until = fixed_now.add(seconds=5)
+        item.until = fixed_clock + 1800
     key_manager.engine.load.side_effect = load
 
     key = key_manager.get_key(user_id, key_id)
 
-    # Consistent load, followed by atomic save (refresh)
-    expected_condition = Key.until >= fixed_now
+    # Eventually consistent load, followed by a save of just the new until (refresh)
+    expected_condition = Key.until >= fixed_clock
+    key_manager.engine.load.assert_called_once_with(key, consistent=False)
+    key_manager.engine.save.assert_called_once_with(
+        Key(user_id=user_id, key_id=key_id, until=fixed_clock + 3600), condition=expected_condition)
+
+
+def test_get_identity_map(key_manager, fixed_clock):
+    """A key used twice in one request is loaded and refreshed once"""
+    key_manager.identity_map = IdentityMap()
+    key_manager.identity_map.begin()
+    user_id, key_id = uuid.uuid4(), uuid.uuid4()
+
+    def load(item, *args, **kwargs):
+        item.until = fixed_clock + 1800
+    key_manager.engine.load.side_effect = load
+
+    key = key_manager.get_key(user_id, key_id)
+    assert key_manager.get_key(user_id, key_id) is key
+    assert key_manager.engine.load.call_count == 1
+    assert key_manager.engine.save.call_count == 1
+
+    key_manager.revoke(key)
+    key_manager.get_key(user_id, key_id)
+    assert key_manager.engine.load.call_count == 2
+
+
+def test_get_coalesced(key_manager, fixed_clock):
+    """Concurrent requests for the same key share one load"""
+    started, release = threading.Event(), threading.Event()
+
+    def load(item, *args, **kwargs):
+        started.set()
+        release.wait(5)
+        item.until = fixed_clock + 1800
+    key_manager.engine.load.side_effect = load
+    user_id, key_id = uuid.uuid4(), uuid.uuid4()
+
+    keys = []
+    threads = [threading.Thread(target=lambda: keys.append(key_manager.get_key(user_id, key_id)), daemon=True)]
+    threads[0].start()
+    started.wait(5)
+    # Don't let the load finish until the second request is waiting on it
+    waiting = threading.Event()
+    in_flight = key_manager.loads._calls[(Key, user_id, key_id)]
+    done, in_flight.done = in_flight.done, Mock(set=in_flight.done.set)
+    in_flight.done.wait.side_effect = lambda timeout=None: waiting.set() or done.wait(timeout)
+    threads.append(threading.Thread(target=lambda: keys.append(key_manager.get_key(user_id, key_id)), daemon=True))
+    threads[1].start()
+    waiting.wait(5)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(keys) == 2
+    assert keys[0] is not keys[1]
+    assert key_manager.engine.load.call_count == 1
+
+
+def test_get_consistent_reads(key_manager, fixed_clock):
+    key_manager.consistent_reads = True
+
+    def load(item, *args, **kwargs):
+        item.until = fixed_clock + 5
+    key_manager.engine.load.side_effect = load
+
+    key = key_manager.get_key(uuid.uuid4(), uuid.uuid4())
     key_manager.engine.load.assert_called_once_with(key, consistent=True)
-    key_manager.engine.save.assert_called_once_with(key, atomic=True, condition=expected_condition)
 
 
-def test_get_expired(key_manager, fixed_now):
+def test_get_near_expiry(key_manager, fixed_clock):
+    """A key close to expiring is re-read consistently, in case a refresh hasn't replicated"""
+    untils = iter([fixed_clock + 5, fixed_clock + 3600])
+
+    def load(item, *args, **kwargs):
+        item.until = next(untils)
+    key_manager.engine.load.side_effect = load
+
+    key = key_manager.get_key(uuid.uuid4(), uuid.uuid4())
+    assert [c[1] for c in key_manager.engine.load.call_args_list] == [{"consistent": False}, {"consistent": True}]
+    assert not key.is_expired_at(fixed_clock)
+
+
+def test_get_expired(key_manager, fixed_clock):
     user_id = uuid.uuid4()
     key_id = uuid.uuid4()
 
     # Patch engine to return a key with expiry < now
     def load(item, *args, **kwargs):
-        item.until = fixed_now.subtract(seconds=2)
+        item.until = fixed_clock - 2
     key_manager.engine.load.side_effect = load
 
     with pytest.raises(NotFound):
         key_manager.get_key(user_id, key_id)
 
-    # Consistent load, followed by atomic delete (revoke)
-    expired_key = Key(user_id=user_id, key_id=key_id, until=fixed_now.subtract(seconds=2), seconds=3)
-    key_manager.engine.load.assert_called_once_with(expired_key, consistent=True)
-    key_manager.engine.delete.assert_called_once_with(expired_key, atomic=True)
+    # Confirmed with a consistent load, but not deleted (left to the ttl and sweeper)
+    expired_key = Key(user_id=user_id, key_id=key_id, until=fixed_clock - 2)
+    key_manager.engine.load.assert_called_with(expired_key, consistent=True)
+    assert key_manager.engine.load.call_count == 2
+    key_manager.engine.delete.assert_not_called()
+    key_manager.engine.save.assert_not_called()
+
+
+def test_get_revoked(engine, dynamodb, fixed_clock):
+    """Through a real engine: a key revoked after a stale read fails the refresh condition and isn't found"""
+    user_id, key_id = uuid.uuid4(), uuid.uuid4()
+    dynamodb.batch_get_item.return_value = {
+        "Responses": {"mb.users.keys": [
+            {"u": {"S": str(user_id)}, "k": {"S": str(key_id)}, "e": {"N": str(fixed_clock + 1800)}}]},
+        "UnprocessedKeys": {}}
+    dynamodb.update_item.side_effect = client_error("ConditionalCheckFailedException", operation="UpdateItem")
+    key_manager = KeyManager(engine, identity_map=IdentityMap())
+    key_manager.identity_map.begin()
+
+    with pytest.raises(NotFound):
+        key_manager.get_key(user_id, key_id)
+    dynamodb.update_item.assert_called_once()
+    assert key_manager.identity_map.get(Key, user_id=user_id, key_id=key_id) is None
+
+
+def test_get_injected_clock(mock_engine):
+    """Expiry is judged by the manager's clock, not the default one"""
+    now = 1500000000
+
+    def load(item, *args, **kwargs):
+        item.until = now + 1800
+    mock_engine.load.side_effect = load
+
+    key_manager = KeyManager(mock_engine, clock=Clock(source=lambda: now))
+    key = key_manager.get_key(uuid.uuid4(), uuid.uuid4())
+    assert key.until == now + 3600
+    mock_engine.load.assert_called_once_with(key, consistent=False)
+
+
+def test_get_hedged_frozen_clock(mock_engine):
+    """Hedged loads run on worker threads, but still see the time the request froze"""
+    now, later = 1500000000, 1500000000 + 10 ** 6
+    clock = Clock(source=lambda: now)
+
+    def load(item, *args, **kwargs):
+        item.until = now + 1800
+    mock_engine.load.side_effect = load
+
+    key_manager = KeyManager(mock_engine, clock=clock, hedging=HedgePolicy(default_delay=5))
+    clock.begin()
+    try:
+        # Anything reading the source instead of the frozen time would see the key as stale, then expired
+        clock.source = lambda: later
+        key = key_manager.get_key(uuid.uuid4(), uuid.uuid4())
+    finally:
+        clock.end()
+    mock_engine.load.assert_called_once_with(key, consistent=False)
+    assert key.until == now + 3600
 
 
 def test_get_missing(key_manager):
@@ -100,17 +410,34 @@ def test_get_missing(key_manager):
 
     with pytest.raises(NotFound):
         key_manager.get_key(user_id, key_id)
-    key_manager.engine.load.assert_called_once_with(Key(user_id=user_id, key_id=key_id), consistent=True)
+    # Missing from an eventually consistent read might be a brand new key, so check again
+    assert key_manager.engine.load.call_args_list == [
+        call(Key(user_id=user_id, key_id=key_id), consistent=False),
+        call(Key(user_id=user_id, key_id=key_id), consistent=True)]
+
+
+def test_get_new_key(key_manager, fixed_clock):
+    """A key that hasn't replicated yet is still found"""
+    def load(item, *, consistent):
+        if not consistent:
+            raise bloop.MissingObjects(objects=[item])
+        item.until = fixed_clock + 3600
+    key_manager.engine.load.side_effect = load
 
+    key = key_manager.get_key(uuid.uuid4(), uuid.uuid4())
+    assert key.until == fixed_clock + 3600
+    assert key_manager.engine.load.call_count == 2
 
-def test_revoke(key_manager):
-    key = Key(user_id=uuid.uuid4(), key_id=uuid.uuid4())
+
+def test_revoke(key_manager, fixed_clock):
+    key = Key(user_id=uuid.uuid4(), key_id=uuid.uuid4(), until=fixed_clock)
     key_manager.engine.delete.side_effect = bloop.ConstraintViolation("delete", key)
 
     with pytest.raises(NotSaved) as excinfo:
         key_manager.revoke(key)
     assert excinfo.value.obj is key
-    key_manager.engine.delete.assert_called_once_with(key, atomic=True)
+    # Condition only on until, not every column
+    key_manager.engine.delete.assert_called_once_with(key, condition=Key.until == fixed_clock)
 
 
 def test_revoke_force(key_manager):
@@ -120,4 +447,390 @@ def test_revoke_force(key_manager):
     with pytest.raises(NotSaved) as excinfo:
         key_manager.revoke(key, force=True)
     assert excinfo.value.obj is key
-    key_manager.engine.delete.assert_called_once_with(key, atomic=False)
+    key_manager.engine.delete.assert_called_once_with(key, condition=None)
+
+
+def test_renew_invalid_public_key(key_manager):
+    key = Key(user_id=uuid.uuid4(), key_id=uuid.uuid4())
+    with pytest.raises(InvalidParameter) as excinfo:
+        key_manager.renew(key, "not an rsa public key")
+    assert excinfo.value.parameter_name == "public_key"
+    key_manager.engine.transaction.assert_not_called()
+
+
+@pytest.mark.parametrize("revoke", [False, True])
+def test_renew_success(rsa_pub, key_manager, fixed_clock, fixed_uuid, revoke):
+    key = Key(user_id=uuid.uuid4(), key_id=uuid.uuid4())
+    tx = key_manager.engine.transaction.return_value
+
+    new_key = key_manager.renew(key, as_der(rsa_pub), revoke=revoke)
+
+    expected_key = Key(user_id=key.user_id, key_id=fixed_uuid, public=rsa_pub, until=fixed_clock + 3600)
+    expected_condition = Key.user_id.is_(None) & Key.key_id.is_(None)
+    assert new_key == expected_key
+    assert new_key.fingerprint == expected_key.compute_fingerprint()
+    tx.save.assert_called_once_with(expected_key, condition=expected_condition)
+    if revoke:
+        tx.delete.assert_called_once_with(key)
+    else:
+        tx.delete.assert_not_called()
+    tx.prepare.return_value.commit.assert_called_once_with()
+    # No per-item writes outside the transaction
+    key_manager.engine.save.assert_not_called()
+    key_manager.engine.delete.assert_not_called()
+
+
+def test_renew_unique_fails(rsa_pub, key_manager):
+    key = Key(user_id=uuid.uuid4(), key_id=uuid.uuid4())
+    commit = key_manager.engine.transaction.return_value.prepare.return_value.commit
+    commit.side_effect = bloop.TransactionCanceled
+
+    with pytest.raises(NotSaved) as excinfo:
+        key_manager.renew(key, as_der(rsa_pub), revoke=True)
+    assert excinfo.value.obj.user_id == key.user_id
+    assert commit.call_count == 10
+
+
+@pytest.mark.parametrize("revoke", [False, True])
+def test_renew_capped(rsa_pub, capped, fixed_clock, revoke):
+    """A renew that adds a key is counted and evicts like new(); one that revokes doesn't change the count"""
+    user_id = uuid.uuid4()
+    capped.stored = 3
+    capped.keys = [Key(user_id=user_id, key_id=uuid.uuid4(), until=fixed_clock + i) for i in range(3)]
+    tx = capped.engine.transaction.return_value
+
+    new_key = capped.renew(capped.keys[-1], as_der(rsa_pub), revoke=revoke)
+
+    if revoke:
+        tx.save.assert_called_once_with(new_key, condition=Key.user_id.is_(None) & Key.key_id.is_(None))
+        tx.delete.assert_called_once_with(capped.keys[-1])
+        capped.engine.query.assert_not_called()
+    else:
+        saved, _, counter, counted, deletes = capped_writes(capped)
+        assert saved is new_key
+        assert (counter.key_count, counted) == (3, User.key_count == 3)
+        assert [args[0] for args, _ in deletes] == capped.keys[:1]
+
+
+def test_new_many_invalid_public_key(rsa_pub, key_manager):
+    with pytest.raises(InvalidParameter) as excinfo:
+        key_manager.new_many(uuid.uuid4(), [as_der(rsa_pub), "not an rsa public key"])
+    assert excinfo.value.parameter_name == "public_keys"
+    assert excinfo.value.message == "Malformed public key at index 1"
+    key_manager.engine.assert_not_called()
+
+
+def test_new_many_success(generate_key, key_manager, monkeypatch, fixed_clock):
+    user_id = uuid.uuid4()
+    publics = [generate_key().public_key() for _ in range(3)]
+    saved = []
+
+    def load(*objs, consistent):
+        assert consistent
+        raise bloop.MissingObjects(objects=objs)
+    key_manager.engine.load.side_effect = load
+    monkeypatch.setattr(moldyboot.controllers.key, "batch_save", lambda objs, engine: saved.extend(objs) or [])
+
+    keys = key_manager.new_many(user_id, [as_der(public) for public in publics])
+
+    assert keys == saved
+    assert [as_der(key.public) for key in keys] == [as_der(public) for public in publics]
+    assert all(key.user_id == user_id and key.until == fixed_clock + 3600 for key in keys)
+    assert len({key.key_id for key in keys}) == 3
+    assert all(key.fingerprint == key.compute_fingerprint() for key in keys)
+    # Single uniqueness check, no per-key conditional writes
+    key_manager.engine.load.assert_called_once()
+    key_manager.engine.save.assert_not_called()
+
+
+def test_new_many_collision(generate_key, key_manager, monkeypatch):
+    """Keys whose id is already taken are stored with a conditional write instead"""
+    publics = [as_der(generate_key().public_key()) for _ in range(2)]
+
+    def load(*objs, consistent):
+        # First candidate id is taken
+        raise bloop.MissingObjects(objects=objs[1:])
+    key_manager.engine.load.side_effect = load
+    batched = []
+    monkeypatch.setattr(moldyboot.controllers.key, "batch_save", lambda objs, engine: batched.extend(objs) or [])
+
+    first, second = key_manager.new_many(uuid.uuid4(), publics)
+
+    assert batched == [second]
+    key_manager.engine.save.assert_called_once_with(first, condition=Key.user_id.is_(None) & Key.key_id.is_(None))
+
+
+def test_new_many_not_saved(generate_key, key_manager, monkeypatch):
+    publics = [as_der(generate_key().public_key()) for _ in range(2)]
+
+    def load(*objs, consistent):
+        raise bloop.MissingObjects(objects=objs)
+    key_manager.engine.load.side_effect = load
+    monkeypatch.setattr(moldyboot.controllers.key, "batch_save", lambda objs, engine: objs[:1])
+
+    with pytest.raises(NotSaved) as excinfo:
+        key_manager.new_many(uuid.uuid4(), publics)
+    assert len(excinfo.value.obj) == 1
+
+
+@pytest.fixture
+def batched(capped, monkeypatch):
+    """Keys stored by new_many on the capped manager"""
+    def load(*objs, consistent):
+        raise bloop.MissingObjects(objects=objs)
+    capped.engine.load.side_effect = load
+    saved = []
+    monkeypatch.setattr(moldyboot.controllers.key, "batch_save", lambda objs, engine: saved.extend(objs) or [])
+    return saved
+
+
+@pytest.mark.parametrize("stored, existing, counted", [
+    (1, 1, 1),
+    # Unset, or high from keys that expired: recounted
+    (None, 1, None),
+    (3, 1, 3),
+])
+def test_new_many_capped(generate_key, capped, batched, stored, existing, counted):
+    user_id = uuid.uuid4()
+    capped.stored = stored
+    capped.keys = [Key(user_id=user_id, key_id=uuid.uuid4(), until=i) for i in range(existing)]
+    publics = [as_der(generate_key().public_key()) for _ in range(2)]
+
+    keys = capped.new_many(user_id, publics)
+
+    assert batched == keys
+    (counter, ), kwargs = capped.engine.save.call_args
+    assert (counter.user_id, counter.key_count) == (user_id, 3)
+    if counted is None:
+        assert kwargs["condition"] == User.key_count.is_(None) & User.user_id.is_not(None)
+    else:
+        assert kwargs["condition"] == (User.key_count == counted)
+
+
+def test_new_many_over_cap(generate_key, capped, batched):
+    """Nothing is evicted to make room; the whole request is refused"""
+    user_id = uuid.uuid4()
+    capped.stored = 2
+    capped.keys = [Key(user_id=user_id, key_id=uuid.uuid4(), until=i) for i in range(2)]
+    publics = [as_der(generate_key().public_key()) for _ in range(2)]
+
+    with pytest.raises(InvalidParameter) as excinfo:
+        capped.new_many(user_id, publics)
+    assert excinfo.value.parameter_name == "public_keys"
+    assert excinfo.value.message == "Would exceed the limit of 3 keys"
+    assert batched == []
+    capped.engine.save.assert_not_called()
+    capped.engine.transaction.assert_not_called()
+
+
+def test_new_many_capped_retries(generate_key, capped, batched):
+    capped.stored = 0
+    capped.engine.save.side_effect = [bloop.ConstraintViolation("save", None), None]
+    capped.new_many(uuid.uuid4(), [as_der(generate_key().public_key())])
+    assert capped.engine.save.call_count == 2
+    assert len(batched) == 1
+
+# list_keys ================================================================================================ list_keys
+
+
+@pytest.mark.parametrize("projection, expected", [
+    ("all", "all"),
+    (["until"], ["key_id", "user_id", "until"]),
+])
+def test_list_keys_projection(key_manager, projection, expected):
+    user_id = uuid.uuid4()
+    key_manager.list_keys(user_id, projection=projection)
+    key_manager.engine.query.assert_called_once_with(Key, key=Key.user_id == user_id, projection=expected)
+
+
+# fingerprints ========================================================================================== fingerprints
+
+def test_keys_with_fingerprint(key_manager):
+    key_manager.keys_with_fingerprint("fingerprint")
+    (index, ), kwargs = key_manager.engine.query.call_args
+    assert index is Key.by_fingerprint
+    assert kwargs == {"key": Key.fingerprint == "fingerprint"}
+
+
+def test_backfill_fingerprints(key_manager, generate_key):
+    keys = [Key(user_id=uuid.uuid4(), key_id=uuid.uuid4(), public=generate_key().public_key()) for _ in range(3)]
+    key_manager.engine.scan.return_value = iter(keys)
+    saved = []
+
+    def save(obj, condition):
+        saved.append((obj, condition))
+        # The second key was deleted or already backfilled since the scan
+        if len(saved) == 2:
+            raise bloop.ConstraintViolation("save", obj)
+    key_manager.engine.save.side_effect = save
+
+    assert key_manager.backfill_fingerprints() == (2, 1)
+    key_manager.engine.scan.assert_called_once_with(
+        Key, filter=Key.fingerprint.is_(None), projection=["key_id", "user_id", "der"], consistent=True)
+    for key, (update, condition) in zip(keys, saved):
+        # Only the fingerprint is written
+        assert (update.user_id, update.key_id) == (key.user_id, key.key_id)
+        assert update.fingerprint == key.compute_fingerprint()
+        assert not hasattr(update, "der")
+        assert condition == Key.fingerprint.is_(None) & (Key.der == key.der)
+
+
+# list_keys_page ====================================================================================== list_keys_page
+
+def test_list_keys_page(engine, dynamodb):
+    key_manager = KeyManager(engine)
+    user_id, first, second = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    dynamodb.query.side_effect = [
+        {
+            "Items": [{"u": {"S": str(user_id)}, "k": {"S": str(first)}, "e": {"N": "1500000000"}, "f": {"S": "fp"}}],
+            "LastEvaluatedKey": {"u": {"S": str(user_id)}, "k": {"S": str(first)}}
+        },
+        {"Items": [{"u": {"S": str(user_id)}, "k": {"S": str(second)}, "e": {"N": "1500000001"}}]},
+    ]
+
+    keys, cursor = key_manager.list_keys_page(user_id, limit=1)
+    assert [(key.key_id, key.until, key.fingerprint) for key in keys] == [(first, 1500000000, "fp")]
+    assert cursor is not None and str(first) not in cursor
+
+    keys, cursor = key_manager.list_keys_page(user_id, cursor=cursor, limit=1)
+    # Not backfilled yet
+    assert [(key.key_id, key.fingerprint) for key in keys] == [(second, "")]
+    assert cursor is None
+
+    first_query, second_query = [kwargs for _, kwargs in dynamodb.query.call_args_list]
+    assert first_query["TableName"] == "mb.users.keys"
+    assert first_query["Limit"] == 1
+    assert first_query["ExpressionAttributeValues"] == {":u": {"S": str(user_id)}}
+    # Never reads the public key
+    assert sorted(first_query["ExpressionAttributeNames"].values()) == ["e", "f", "k", "u"]
+    assert "ExclusiveStartKey" not in first_query
+    assert second_query["ExclusiveStartKey"] == {"u": {"S": str(user_id)}, "k": {"S": str(first)}}
+
+
+def test_list_keys_page_invalid_cursor(engine, dynamodb):
+    with pytest.raises(InvalidParameter):
+        KeyManager(engine).list_keys_page(uuid.uuid4(), cursor="not a cursor")
+    dynamodb.query.assert_not_called()
+
+
+def test_list_keys_page_error(engine, dynamodb):
+    dynamodb.query.side_effect = client_error("InternalServerError", status=500, operation="Query")
+    with pytest.raises(bloop.exceptions.BloopException):
+        KeyManager(engine).list_keys_page(uuid.uuid4())
+
+
+# revoke_all ============================================================================================== revoke_all
+
+def test_revoke_all_invalid_user_id(key_manager):
+    with pytest.raises(InvalidParameter) as excinfo:
+        key_manager.revoke_all("not a uuid")
+    assert excinfo.value.parameter_name == "user_id"
+    key_manager.engine.query.assert_not_called()
+
+
+def test_revoke_all_batches(key_manager, monkeypatch):
+    user_id = uuid.uuid4()
+    keys = [Key(user_id=user_id, key_id=uuid.uuid4()) for _ in range(60)]
+    key_manager.engine.query.return_value = iter(keys)
+    batches = []
+
+    def batch_delete(objs, engine):
+        batches.append(list(objs))
+        # Unprocessed after retries
+        return objs[:1]
+    monkeypatch.setattr(moldyboot.controllers.key, "batch_delete", batch_delete)
+
+    failed = key_manager.revoke_all(user_id)
+    key_manager.engine.query.assert_called_once_with(Key, key=Key.user_id == user_id, projection=["key_id", "user_id"])
+    assert sorted(len(batch) for batch in batches) == [10, 25, 25]
+    assert sorted(key.key_id for batch in batches for key in batch) == sorted(key.key_id for key in keys)
+    assert sorted(key.key_id for key in failed) == sorted(batch[0].key_id for batch in batches)
+
+
+def test_revoke_all_batch_error(key_manager, monkeypatch):
+    """A batch that errors outright reports every key in it as failed"""
+    user_id = uuid.uuid4()
+    keys = [Key(user_id=user_id, key_id=uuid.uuid4()) for _ in range(3)]
+    key_manager.engine.query.return_value = iter(keys)
+
+    def batch_delete(objs, engine):
+        raise bloop.exceptions.BloopException("Unexpected error while writing items.")
+    monkeypatch.setattr(moldyboot.controllers.key, "batch_delete", batch_delete)
+
+    assert key_manager.revoke_all(user_id) == keys
+
+
+def test_revoke_all_backpressure(key_manager, monkeypatch):
+    """The search isn't read further while max_workers batches are in flight"""
+    user_id = uuid.uuid4()
+    consumed = []
+
+    def keys():
+        for _ in range(200):
+            consumed.append(None)
+            yield Key(user_id=user_id, key_id=uuid.uuid4())
+    key_manager.engine.query.return_value = keys()
+    started, release = threading.Semaphore(0), threading.Event()
+    deleted = []
+
+    def batch_delete(objs, engine):
+        started.release()
+        assert release.wait(5)
+        deleted.extend(objs)
+        return []
+    monkeypatch.setattr(moldyboot.controllers.key, "batch_delete", batch_delete)
+
+    thread = threading.Thread(target=lambda: key_manager.revoke_all(user_id, max_workers=2), daemon=True)
+    thread.start()
+    for _ in range(2):
+        assert started.acquire(timeout=5)
+    thread.join(0.1)
+    # Two batches in flight, and the third read and waiting for one of them
+    assert len(consumed) == 75
+    release.set()
+    thread.join(5)
+    assert len(deleted) == 200
+
+
+def test_revoke_all_renders(engine, dynamodb):
+    """Through a real engine, so a projection or key bloop won't render fails here"""
+    user_id, key_ids = uuid.uuid4(), [uuid.uuid4() for _ in range(3)]
+    dynamodb.query.return_value = {
+        "Items": [{"u": {"S": str(user_id)}, "k": {"S": str(key_id)}} for key_id in key_ids],
+        "Count": 3, "ScannedCount": 3}
+    dynamodb.batch_write_item.return_value = {}
+
+    assert KeyManager(engine).revoke_all(user_id) == []
+    request = dynamodb.query.call_args[1]
+    assert request["TableName"] == "mb.users.keys"
+    assert sorted(request["ExpressionAttributeNames"][name] for name in request["ProjectionExpression"].split(", ")) \
+        == ["k", "u"]
+    dynamodb.batch_write_item.assert_called_once_with(RequestItems={"mb.users.keys": [
+        {"DeleteRequest": {"Key": {"u": {"S": str(user_id)}, "k": {"S": str(key_id)}}}} for key_id in key_ids]})
+
+
+# sweep_expired ======================================================================================== sweep_expired
+
+def test_sweep_expired(engine, dynamodb, fixed_clock):
+    """Through a real engine, so a filter or projection bloop won't render fails here"""
+    keys = [(uuid.uuid4(), uuid.uuid4()) for _ in range(30)]
+    dynamodb.scan.return_value = {
+        "Items": [{"u": {"S": str(user_id)}, "k": {"S": str(key_id)}} for user_id, key_id in keys],
+        "Count": 30, "ScannedCount": 30}
+    dynamodb.batch_write_item.return_value = {}
+
+    assert KeyManager(engine).sweep_expired() == []
+    request = dynamodb.scan.call_args[1]
+    names = request["ExpressionAttributeNames"]
+    assert request["TableName"] == "mb.users.keys"
+    assert request["ConsistentRead"] is True
+    assert sorted(names[name] for name in request["ProjectionExpression"].split(", ")) == ["k", "u"]
+    (until, _), = [(name, column) for name, column in names.items() if column == "e"]
+    (value, dumped), = request["ExpressionAttributeValues"].items()
+    assert request["FilterExpression"] == "({} < {})".format(until, value)
+    assert dumped == {"N": str(fixed_clock)}
+
+    batches = [call[1]["RequestItems"]["mb.users.keys"] for call in dynamodb.batch_write_item.call_args_list]
+    assert sorted(len(batch) for batch in batches) == [5, 25]
+    assert sorted((request["DeleteRequest"]["Key"]["u"]["S"], request["DeleteRequest"]["Key"]["k"]["S"])
+                  for batch in batches for request in batch) == sorted((str(u), str(k)) for u, k in keys)
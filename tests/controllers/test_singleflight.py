@@ -0,0 +1,145 @@
+import threading
+from unittest.mock import Mock
+
+import pytest
+
+from moldyboot.controllers import Deadline, DeadlineExceeded, SingleFlight
+
+
+def start(target):
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    return thread
+
+
+def count_waiters(loads, key):
+    """Returns a semaphore released once per caller that joins the in-flight call for key"""
+    waiting = threading.Semaphore(0)
+    call = loads._calls[key]
+    done, call.done = call.done, Mock(set=call.done.set)
+    call.done.wait.side_effect = lambda timeout=None: waiting.release() or done.wait(timeout)
+    return waiting
+
+
+def test_concurrent_calls_share_one_load():
+    loads = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls, results = [], []
+
+    def load():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return {"value": 1}
+
+    leader = start(lambda: results.append(loads.do(("k",), load)))
+    started.wait(5)
+    waiting = count_waiters(loads, ("k",))
+    waiters = [start(lambda: results.append(loads.do(("k",), load))) for _ in range(3)]
+    for _ in waiters:
+        waiting.acquire(timeout=5)
+    release.set()
+    for thread in [leader] + waiters:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert results == [{"value": 1}] * 4
+    # Each caller gets its own object
+    assert len({id(result) for result in results}) == 4
+
+
+def test_errors_propagate_to_waiters():
+    loads = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    errors = []
+
+    def load():
+        started.set()
+        release.wait(5)
+        raise KeyError("missing")
+
+    def call():
+        try:
+            loads.do(("k",), load)
+        except KeyError as error:
+            errors.append(error)
+
+    leader = start(call)
+    started.wait(5)
+    waiting = count_waiters(loads, ("k",))
+    waiter = start(call)
+    waiting.acquire(timeout=5)
+    release.set()
+    leader.join(5)
+    waiter.join(5)
+    assert len(errors) == 2
+
+
+def test_waiter_deadline():
+    """A waiter whose request runs out of time stops waiting; the leader's load carries on"""
+    deadline = Deadline()
+    loads = SingleFlight(deadline=deadline)
+    started, release = threading.Event(), threading.Event()
+    results = []
+
+    def load():
+        started.set()
+        release.wait(5)
+        return "loaded"
+
+    leader = start(lambda: results.append(loads.do(("k",), load)))
+    started.wait(5)
+    deadline.begin(0.01)
+    try:
+        with pytest.raises(DeadlineExceeded):
+            loads.do(("k",), load)
+    finally:
+        deadline.end()
+    release.set()
+    leader.join(5)
+    assert results == ["loaded"]
+
+
+def test_sequential_calls_load_again():
+    loads = SingleFlight()
+    assert loads.do(("k",), lambda: 1) == 1
+    assert loads.do(("k",), lambda: 2) == 2
+    with pytest.raises(ValueError):
+        loads.do(("k",), lambda: int("x"))
+    assert loads.do(("k",), lambda: 3) == 3
+
+
+def test_forget_after_write():
+    """A caller after a write never joins a load that started before it"""
+    loads = SingleFlight()
+    store = {"value": "before"}
+    started, release = threading.Event(), threading.Event()
+    results = {}
+
+    def slow_load():
+        value = store["value"]
+        started.set()
+        release.wait(5)
+        return value
+
+    leader = start(lambda: results.update(leader=loads.do(("user", 1), slow_load)))
+    started.wait(5)
+
+    store["value"] = "after"
+    loads.forget("user")
+
+    assert loads.do(("user", 1), lambda: store["value"]) == "after"
+    release.set()
+    leader.join(5)
+    assert results["leader"] == "before"
+    # The stale leader didn't evict a newer call's entry, and doesn't linger
+    assert loads.do(("user", 1), lambda: "fresh") == "fresh"
+
+
+def test_forget_prefix():
+    loads = SingleFlight()
+    loads._calls = {("user", 1): object(), ("user", 2): object(), ("key", 1): object()}
+    loads.forget("user", 1)
+    assert set(loads._calls) == {("user", 2), ("key", 1)}
+    loads.forget("user")
+    assert set(loads._calls) == {("key", 1)}
@@ -0,0 +1,175 @@
+import bloop
+import botocore.exceptions
+import pytest
+from bloop import BaseModel, Column, Integer
+from tests.helpers import ThrottlingDynamoDB, client_error
+
+import moldyboot.controllers.throttling
+from moldyboot.controllers import Deadline, DeadlineExceeded, Guard, GuardedClient, Unavailable
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        # Doesn't advance the clock, as if every call arrived at once
+        self.slept.append(seconds)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(moldyboot.controllers.throttling, "time", clock)
+    return clock
+
+
+def guarded(clock, throttles=0, **kwargs):
+    dynamodb = ThrottlingDynamoDB(throttles)
+    return dynamodb, GuardedClient(dynamodb, Guard(**kwargs))
+
+
+def test_throttling_adjusts_rate(clock):
+    dynamodb, client = guarded(clock, throttles=2, rate=8, increase=1, decrease=0.5)
+    for _ in range(2):
+        with pytest.raises(botocore.exceptions.ClientError):
+            client.get_item(TableName="t")
+    assert client.guard.rate == 2
+    client.get_item(TableName="t")
+    assert client.guard.rate == 3
+
+
+def test_rate_limited(clock):
+    """Calls past the rate wait their turn, or fail fast if that would take more than max_wait"""
+    dynamodb, client = guarded(clock, rate=2, increase=0, max_wait=0.5)
+    client.get_item()
+    client.get_item()
+    assert clock.slept == []
+    client.get_item()
+    assert clock.slept == [0.5]
+    with pytest.raises(Unavailable):
+        client.get_item()
+    assert len(dynamodb.calls) == 3
+
+
+def test_circuit_opens(clock):
+    dynamodb, client = guarded(clock, throttles=3, failure_threshold=3, reset_timeout=5)
+    for _ in range(3):
+        with pytest.raises(botocore.exceptions.ClientError):
+            client.query()
+    assert client.guard.state == "open"
+
+    with pytest.raises(Unavailable) as excinfo:
+        client.query()
+    assert excinfo.value.retry_after == 5
+    assert len(dynamodb.calls) == 3
+
+
+def test_circuit_closes_after_trial(clock):
+    dynamodb, client = guarded(clock, throttles=2, failure_threshold=1, reset_timeout=5)
+    with pytest.raises(botocore.exceptions.ClientError):
+        client.query()
+
+    # The trial fails, so the circuit stays open for another reset_timeout
+    clock.now += 5
+    assert client.guard.state == "half-open"
+    with pytest.raises(botocore.exceptions.ClientError):
+        client.query()
+    assert client.guard.state == "open"
+
+    clock.now += 5
+    client.query()
+    assert client.guard.state == "closed"
+    assert len(dynamodb.calls) == 3
+
+
+def test_one_trial_at_a_time(clock):
+    guard = Guard(failure_threshold=1, reset_timeout=5)
+    guard._record("failed")
+    clock.now += 5
+
+    def trial():
+        # A second call while the trial is in flight doesn't reach DynamoDB
+        with pytest.raises(Unavailable):
+            guard.call(lambda: {})
+        return {}
+    guard.call(trial)
+    assert guard.state == "closed"
+
+
+@pytest.mark.parametrize("error, state", [
+    (client_error("ConditionalCheckFailedException"), "closed"),
+    (client_error("InternalServerError", status=500), "open"),
+    (client_error("ThrottlingException"), "open"),
+])
+def test_classify_errors(clock, error, state):
+    guard = Guard(failure_threshold=1)
+
+    def call():
+        raise error
+    with pytest.raises(botocore.exceptions.ClientError):
+        guard.call(call)
+    assert guard.state == state
+
+
+def test_transaction_throttled(clock):
+    error = client_error("TransactionCanceledException", operation="TransactWriteItems")
+    error.response["CancellationReasons"] = [{"Code": "None"}, {"Code": "ThrottlingError"}]
+    guard = Guard(rate=10, failure_threshold=2)
+
+    def call():
+        raise error
+    with pytest.raises(botocore.exceptions.ClientError):
+        guard.call(call)
+    assert guard.rate == 5
+
+
+def test_unprocessed_items_slow_down(clock):
+    guard = Guard(rate=10)
+    guard.call(lambda: {"UnprocessedItems": {"t": [{}]}})
+    assert guard.rate == 5
+    assert guard.state == "closed"
+
+
+def test_other_operations_not_guarded(clock):
+    dynamodb, client = guarded(clock, failure_threshold=1)
+    client.guard._record("failed")
+    client.describe_table(TableName="t")
+    with pytest.raises(Unavailable):
+        client.get_item(TableName="t")
+    assert dynamodb.calls == ["describe_table"]
+
+
+def test_engine_fails_fast(clock):
+    """Through a real engine, a throttled table is given up on once the circuit opens"""
+    class Model(BaseModel):
+        id = Column(Integer, hash_key=True)
+        data = Column(Integer)
+
+    dynamodb, client = guarded(clock, throttles=100, failure_threshold=2)
+    engine = bloop.Engine(dynamodb=client, dynamodbstreams=object(), table_name_template="mb.{table_name}")
+    for _ in range(2):
+        with pytest.raises(bloop.exceptions.BloopException):
+            engine.save(Model(id=1, data=2))
+    with pytest.raises(Unavailable):
+        engine.save(Model(id=1, data=2))
+    assert dynamodb.calls == ["update_item", "update_item"]
+
+
+def test_deadline_exceeded(clock):
+    deadline = Deadline()
+    dynamodb = ThrottlingDynamoDB()
+    client = GuardedClient(dynamodb, Guard(), deadline)
+    deadline.begin(0)
+    with pytest.raises(DeadlineExceeded) as excinfo:
+        client.update_item(TableName="t")
+    assert excinfo.value.operation == "update_item"
+    assert dynamodb.calls == []
+
+    deadline.end()
+    client.update_item(TableName="t")
+    assert dynamodb.calls == ["update_item"]
@@ -1,14 +1,19 @@
+import base64
 import uuid
+from unittest.mock import call
 
 import bcrypt
 import bloop
+import botocore.exceptions
 import pytest
 
 from moldyboot.controllers import (
     AlreadyExists,
+    IdentityMap,
     InvalidParameter,
     NotFound,
     NotSaved,
+    UserManager,
 )
 from moldyboot.models import User, UserName
 
@@ -27,7 +32,7 @@ def test_new_invalid_username(user_manager):
     with pytest.raises(InvalidParameter) as excinfo:
         user_manager.new(username, valid_email, valid_password_hash)
     assert excinfo.value.parameter_name == "username"
-    user_manager.engine.save.assert_not_called()
+    user_manager.engine.transaction.assert_not_called()
 
 
 def test_new_invalid_password_hash(user_manager):
@@ -36,7 +41,7 @@ def test_new_invalid_password_hash(user_manager):
     with pytest.raises(InvalidParameter) as excinfo:
         user_manager.new(valid_username, valid_email, password_hash)
     assert excinfo.value.parameter_name == "password_hash"
-    user_manager.engine.save.assert_not_called()
+    user_manager.engine.transaction.assert_not_called()
 
 
 def test_new_invalid_email(user_manager):
@@ -45,51 +50,76 @@ def test_new_invalid_email(user_manager):
     with pytest.raises(InvalidParameter) as excinfo:
         user_manager.new(valid_username, email, valid_password_hash)
     assert excinfo.value.parameter_name == "email"
-    user_manager.engine.save.assert_not_called()
+    user_manager.engine.transaction.assert_not_called()
 
 
-def test_new_username_exists(user_manager, fixed_now):
-    user_manager.engine.save.side_effect = bloop.ConstraintViolation("save", object())
+def canceled(*codes):
+    """TransactionCanceled with one CancellationReasons code per transaction item"""
+    error = botocore.exceptions.ClientError({
+        "Error": {"Code": "TransactionCanceledException", "Message": "canceled"},
+        "CancellationReasons": [{"Code": code} for code in codes]
+    }, "TransactWriteItems")
+    try:
+        raise bloop.TransactionCanceled from error
+    except bloop.TransactionCanceled as exception:
+        return exception
+
+
+def test_new_username_exists(user_manager, fixed_now, fixed_uuid):
+    tx = user_manager.engine.transaction.return_value
+    tx.prepare.return_value.commit.side_effect = canceled("ConditionalCheckFailed", "None")
 
     with pytest.raises(AlreadyExists):
         user_manager.new(valid_username, valid_email, valid_password_hash)
-    expected_username = UserName(username=valid_username, created=fixed_now)
-    expected_condition = UserName.username.is_(None)
-    user_manager.engine.save.assert_called_once_with(expected_username, condition=expected_condition)
+    expected_username = UserName(
+        username=valid_username, created=fixed_now, user_id=fixed_uuid,
+        password_hash=valid_password_hash, verified=False, deleted=False)
+    tx.save.assert_any_call(expected_username, condition=UserName.username.is_(None))
+    # Username is taken, so there's no point retrying with another user_id
+    assert tx.prepare.return_value.commit.call_count == 1
 
 
-def test_new_user_associate_fails(user_manager, fixed_uuid):
-    user_manager.engine.save.side_effect = [None, None, bloop.ConstraintViolation("save", None)]
+def test_new_user_id_collision_retries(user_manager):
+    commit = user_manager.engine.transaction.return_value.prepare.return_value.commit
+    commit.side_effect = [canceled("None", "ConditionalCheckFailed"), None]
+
+    returned_user = user_manager.new(valid_username, valid_email, valid_password_hash)
+    assert commit.call_count == 2
+    assert returned_user.user_id is not None
+
+
+def test_new_user_unique_fails(user_manager):
+    commit = user_manager.engine.transaction.return_value.prepare.return_value.commit
+    commit.side_effect = canceled("None", "ConditionalCheckFailed")
 
     with pytest.raises(NotSaved):
         user_manager.new(valid_username, valid_email, valid_password_hash)
-
-    assert user_manager.engine.save.call_count == 3
-    expected_user = User(
-        password_hash=valid_password_hash, email=valid_email,
-        verification_code=fixed_uuid, user_id=fixed_uuid)
-    user_manager.engine.save.assert_any_call(expected_user, condition=User.user_id.is_(None))
+    assert commit.call_count == 10
 
 
 def test_new_user_success(user_manager, fixed_now, fixed_uuid):
-    """after UserName is created, a new user is created with a random user_id."""
+    """UserName (with user_id) and User are created in one transaction"""
+    tx = user_manager.engine.transaction.return_value
     returned_user = user_manager.new(valid_username, valid_email, valid_password_hash)
 
     expected_username = UserName(
         username=valid_username,
         created=fixed_now,
-        user_id=fixed_uuid)
+        user_id=fixed_uuid,
+        password_hash=valid_password_hash,
+        verified=False,
+        deleted=False)
     expected_user = User(
         password_hash=valid_password_hash,
         email=valid_email,
         verification_code=fixed_uuid,
         user_id=fixed_uuid)
-    # username saved without user_id
-    user_manager.engine.save.assert_any_call(expected_username, condition=UserName.username.is_(None))
-    # intermediate call saves the User
-    user_manager.engine.save.assert_any_call(expected_user, condition=User.user_id.is_(None))
-    # last call updates the UserName with the User.user_id
-    user_manager.engine.save.assert_called_with(expected_username, atomic=True)
+    assert tx.save.call_args_list == [
+        call(expected_username, condition=UserName.username.is_(None)),
+        call(expected_user, condition=User.user_id.is_(None)),
+    ]
+    tx.prepare.return_value.commit.assert_called_once_with()
+    user_manager.engine.save.assert_not_called()
     assert returned_user == expected_user
 
 
@@ -120,6 +150,43 @@ def test_get_user_success(user_manager):
     assert user.user_id == user_id
 
 
+def test_get_user_identity_map(user_manager):
+    """Repeat loads within a request are served from memory"""
+    user_manager.identity_map = IdentityMap()
+    user_manager.identity_map.begin()
+    user_id = uuid.uuid4()
+
+    user = user_manager.get_user(user_id)
+    assert user_manager.get_user(user_id) is user
+    # A full load also serves projected loads
+    assert user_manager.get_user(user_id, projection=["deleted"]) is user
+    assert user_manager.engine.load.call_count == 1
+    user_manager.engine.query.assert_not_called()
+
+    # Writes drop the stale copy
+    user_manager.verify(user_id, uuid.uuid4())
+    assert user_manager.get_user(user_id) is not user
+
+
+def test_get_user_projection(user_manager):
+    user_id = uuid.uuid4()
+    projected = User(user_id=user_id, deleted=True)
+    user_manager.engine.query.return_value.first.return_value = projected
+
+    user = user_manager.get_user(user_id, projection=["verification_code", "deleted"])
+    assert user is projected
+    user_manager.engine.query.assert_called_once_with(
+        User, key=User.user_id == user_id, projection=["user_id", "verification_code", "deleted"])
+    user_manager.engine.load.assert_not_called()
+
+
+def test_get_unknown_user_projection(user_manager):
+    user_manager.engine.query.return_value.first.side_effect = bloop.ConstraintViolation("query", object())
+
+    with pytest.raises(NotFound):
+        user_manager.get_user(uuid.uuid4(), projection=["deleted"])
+
+
 # get_username ========================================================================================== get_username
 
 def test_get_invalid_username(user_manager):
@@ -170,6 +237,140 @@ def test_get_username_by_invalid_user_id(user_manager):
     user_manager.engine.query.assert_not_called()
 
 
+# get_login ================================================================================================ get_login
+
+def test_get_login_single_read(user_manager):
+    """A verified UserName has everything needed to log in"""
+    user_id = uuid.uuid4()
+
+    def load(username):
+        username.user_id = user_id
+        username.password_hash = valid_password_hash
+        username.verified = True
+        username.deleted = False
+    user_manager.engine.load.side_effect = load
+
+    user = user_manager.get_login(valid_username)
+    assert user == User(user_id=user_id, password_hash=valid_password_hash, deleted=False)
+    assert user.is_verified
+    assert user_manager.engine.load.call_count == 1
+    user_manager.engine.save.assert_not_called()
+
+
+def test_get_login_unknown_username(user_manager):
+    user_manager.engine.load.side_effect = bloop.MissingObjects("load", objects=[object()])
+
+    with pytest.raises(NotFound):
+        user_manager.get_login(valid_username)
+    assert user_manager.engine.load.call_count == 1
+
+
+@pytest.mark.parametrize("verification_code, deleted", [
+    (None, None), (uuid.uuid4(), None), (None, True)])
+def test_get_login_falls_back(user_manager, verification_code, deleted):
+    """Older or unverified UserNames fall back to the User, without writing anything"""
+    user_id = uuid.uuid4()
+    stored = User(user_id=user_id, password_hash=valid_password_hash, verification_code=verification_code)
+    if deleted:
+        stored.deleted = True
+
+    def load(obj):
+        if isinstance(obj, UserName):
+            obj.user_id = user_id
+        else:
+            obj.password_hash = stored.password_hash
+            obj.verification_code = stored.verification_code
+            if deleted:
+                obj.deleted = True
+    user_manager.engine.load.side_effect = load
+
+    user = user_manager.get_login(valid_username)
+    assert user == stored
+    assert user_manager.engine.load.call_count == 2
+    user_manager.engine.save.assert_not_called()
+    user_manager.engine.transaction.assert_not_called()
+
+
+def test_get_login_unverified_real_engine(engine, dynamodb):
+    """Repeated logins by an unverified user read, but never write"""
+    user_id = uuid.uuid4()
+    encoded_hash = base64.b64encode(valid_password_hash).decode("utf-8")
+    items = {
+        "mb.users.names": {"n": {"S": valid_username}, "u": {"S": str(user_id)}, "p": {"B": encoded_hash},
+                           "v": {"BOOL": False}, "d": {"BOOL": False}},
+        "mb.users": {"u": {"S": str(user_id)}, "p": {"B": encoded_hash}, "v": {"S": str(uuid.uuid4())}},
+    }
+
+    def batch_get_item(RequestItems):
+        return {"Responses": {table: [items[table]] for table in RequestItems}, "UnprocessedKeys": {}}
+    dynamodb.batch_get_item.side_effect = batch_get_item
+
+    user_manager = UserManager(engine, identity_map=IdentityMap())
+    for _ in range(3):
+        assert not user_manager.get_login(valid_username).is_verified
+    assert dynamodb.batch_get_item.call_count == 6
+    dynamodb.update_item.assert_not_called()
+    dynamodb.transact_write_items.assert_not_called()
+
+
+# sync_login ============================================================================================== sync_login
+
+def loaded_username(user_manager, **attrs):
+    """Have get_username load a UserName with attrs"""
+    def load(username):
+        for name, value in attrs.items():
+            setattr(username, name, value)
+    user_manager.engine.load.side_effect = load
+
+
+@pytest.mark.parametrize("user_attrs, expected", [
+    ({}, {"password_hash": valid_password_hash, "verified": True}),
+    ({"verification_code": uuid.uuid4()}, {"password_hash": valid_password_hash}),
+    ({"deleted": True}, {"password_hash": valid_password_hash, "verified": True, "deleted": True}),
+])
+def test_sync_login_copies(user_manager, user_attrs, expected):
+    """Fields missing from an older UserName are copied from the User"""
+    user_id = uuid.uuid4()
+    loaded_username(user_manager, user_id=user_id)
+    user = User(user_id=user_id, password_hash=valid_password_hash, **user_attrs)
+
+    user_manager.sync_login(valid_username, user)
+    user_manager.engine.save.assert_called_once_with(
+        UserName(username=valid_username, **expected), condition=UserName.user_id == user_id)
+
+
+def test_sync_login_only_differences(user_manager):
+    user_id = uuid.uuid4()
+    loaded_username(user_manager, user_id=user_id, password_hash=valid_password_hash, verified=False)
+
+    user_manager.sync_login(valid_username, User(user_id=user_id, password_hash=valid_password_hash))
+    user_manager.engine.save.assert_called_once_with(
+        UserName(username=valid_username, verified=True), condition=UserName.user_id == user_id)
+
+
+@pytest.mark.parametrize("verification_code", [None, uuid.uuid4()])
+def test_sync_login_nothing_differs(user_manager, verification_code):
+    """Current (or still unverified) UserNames aren't written"""
+    user_id = uuid.uuid4()
+    loaded_username(
+        user_manager, user_id=user_id, password_hash=valid_password_hash,
+        verified=verification_code is None, deleted=False)
+    user = User(user_id=user_id, password_hash=valid_password_hash, verification_code=verification_code)
+
+    user_manager.sync_login(valid_username, user)
+    user_manager.engine.save.assert_not_called()
+
+
+def test_sync_login_conflict(user_manager):
+    """A UserName that was re-pointed since the read isn't repaired"""
+    user_id = uuid.uuid4()
+    loaded_username(user_manager, user_id=user_id)
+    user_manager.engine.save.side_effect = bloop.ConstraintViolation("save", object())
+
+    user_manager.sync_login(valid_username, User(user_id=user_id, password_hash=valid_password_hash))
+    user_manager.engine.save.assert_called_once()
+
+
 # delete_user ============================================================================================ delete_user
 
 def test_delete_invalid_user(user_manager):
@@ -178,82 +379,145 @@ def test_delete_invalid_user(user_manager):
     with pytest.raises(InvalidParameter) as excinfo:
         user_manager.delete_user(invalid_user_id)
     assert excinfo.value.parameter_name == "user_id"
-    user_manager.engine.save.assert_not_called()
+    user_manager.engine.assert_not_called()
+
+
+def test_delete_unknown_username(user_manager):
+    """Can't find the UserName to tombstone alongside the User"""
+    user_manager.engine.query.return_value.one.side_effect = bloop.ConstraintViolation("query", object())
+
+    with pytest.raises(NotSaved):
+        user_manager.delete_user(uuid.uuid4())
+    user_manager.engine.transaction.assert_not_called()
 
 
 def test_delete_unknown_user(user_manager):
-    user_id = uuid.uuid4()
-    expected_user = User(user_id=user_id, deleted=True)
-    user_exists = User.user_id.is_not(None)
-    user_manager.engine.save.side_effect = bloop.ConstraintViolation("save", object())
+    commit = user_manager.engine.transaction.return_value.prepare.return_value.commit
+    commit.side_effect = bloop.TransactionCanceled
 
     with pytest.raises(NotSaved):
-        user_manager.delete_user(user_id)
-    user_manager.engine.save.assert_called_once_with(expected_user, condition=user_exists)
+        user_manager.delete_user(uuid.uuid4(), valid_username)
 
 
 def test_delete_user_success(user_manager):
+    """User and UserName are tombstoned together"""
     user_id = uuid.uuid4()
+    tx = user_manager.engine.transaction.return_value
     expected_user = User(user_id=user_id, deleted=True)
-    user_exists = User.user_id.is_not(None)
 
-    user = user_manager.delete_user(user_id)
-    user_manager.engine.save.assert_called_once_with(expected_user, condition=user_exists)
+    user = user_manager.delete_user(user_id, valid_username)
+    assert tx.save.call_args_list == [
+        call(expected_user, condition=User.user_id.is_not(None)),
+        call(UserName(username=valid_username, deleted=True), condition=UserName.user_id == user_id),
+    ]
+    tx.prepare.return_value.commit.assert_called_once_with()
+    user_manager.engine.query.assert_not_called()
     assert user == expected_user
 
 
 # verify ====================================================================================================== verify
 
+def test_verify_invalid_user_id(user_manager):
+    with pytest.raises(InvalidParameter) as excinfo:
+        user_manager.verify("not a uuid", uuid.uuid4())
+    assert excinfo.value.parameter_name == "user_id"
+    user_manager.engine.assert_not_called()
+
+
 def test_verify_invalid_code(user_manager):
     invalid_code = "not a uuid"
-    user = User(user_id=uuid.uuid4())
 
     with pytest.raises(InvalidParameter) as excinfo:
-        user_manager.verify(user, invalid_code)
+        user_manager.verify(uuid.uuid4(), invalid_code)
     assert excinfo.value.parameter_name == "verification_code"
     assert excinfo.value.value == invalid_code
     user_manager.engine.assert_not_called()
 
 
-def test_verify_already_verified(user_manager):
-    code = uuid.uuid4()
-    user = User(user_id=uuid.uuid4())
+def test_verify_success(user_manager):
+    """A single conditional transaction that also marks the UserName verified, no reads"""
+    user_id, code = uuid.uuid4(), uuid.uuid4()
+    tx = user_manager.engine.transaction.return_value
+
+    user_manager.verify(user_id, code, valid_username)
+    assert tx.save.call_args_list == [
+        call(User(user_id=user_id, verification_code=None), condition=User.verification_code == code),
+        call(UserName(username=valid_username, verified=True), condition=UserName.user_id == user_id),
+    ]
+    tx.prepare.return_value.commit.assert_called_once_with()
+    user_manager.engine.load.assert_not_called()
+    user_manager.engine.save.assert_not_called()
+
 
-    # user has no verification_code attr
-    user_manager.verify(user, code)
-    user_manager.engine.assert_not_called()
+def test_verify_looks_up_username(user_manager):
+    user_id, code = uuid.uuid4(), uuid.uuid4()
+    user_manager.engine.query.return_value.one.return_value = UserName(username=valid_username, user_id=user_id)
+    tx = user_manager.engine.transaction.return_value
 
-    # user has explicit verification_code None
-    user.verification_code = None
-    user_manager.verify(user, code)
-    user_manager.engine.assert_not_called()
+    user_manager.verify(user_id, code)
+    user_manager.engine.query.assert_called_once_with(UserName.by_user_id, key=UserName.user_id == user_id)
+    assert tx.save.call_args_list[1] == call(
+        UserName(username=valid_username, verified=True), condition=UserName.user_id == user_id)
 
 
-def test_verify_success(user_manager):
-    code = uuid.uuid4()
-    user = User(user_id=uuid.uuid4(), verification_code=code)
+def test_verify_unknown_username(user_manager):
+    user_manager.engine.query.return_value.one.side_effect = bloop.ConstraintViolation("one", None)
 
-    user_manager.verify(user, code)
-    user_manager.engine.save.assert_called_once_with(user, atomic=True)
-    assert user.verification_code is None
+    with pytest.raises(NotFound):
+        user_manager.verify(uuid.uuid4(), uuid.uuid4())
+    user_manager.engine.transaction.assert_not_called()
 
 
-def test_verify_constraint_violation(user_manager):
-    code = uuid.uuid4()
-    user = User(user_id=uuid.uuid4(), verification_code=code)
-    user_manager.engine.save.side_effect = bloop.ConstraintViolation("save", user)
+@pytest.fixture
+def first_canceled(user_manager):
+    """The first verify transaction is canceled"""
+    commit = user_manager.engine.transaction.return_value.prepare.return_value.commit
+    commit.side_effect = [bloop.TransactionCanceled, None]
+    return commit
 
-    with pytest.raises(NotSaved) as excinfo:
-        user_manager.verify(user, code)
-    assert excinfo.value.obj is user
-    user_manager.engine.save.assert_called_once_with(user, atomic=True)
 
+def test_verify_already_verified(user_manager, first_canceled):
+    user_id, code = uuid.uuid4(), uuid.uuid4()
 
-def test_verify_wrong_code(user_manager):
-    wrong_code = uuid.uuid4()
-    user = User(user_id=uuid.uuid4(), verification_code=uuid.uuid4())
+    # user has no verification_code attr after loading
+    user_manager.verify(user_id, code, valid_username)
+    user_manager.engine.load.assert_called_once_with(User(user_id=user_id))
+    assert first_canceled.call_count == 1
+
+
+def test_verify_unknown_user(user_manager, first_canceled):
+    user_id, code = uuid.uuid4(), uuid.uuid4()
+    user_manager.engine.load.side_effect = bloop.MissingObjects("load", objects=[object()])
+
+    with pytest.raises(NotFound):
+        user_manager.verify(user_id, code, valid_username)
+
+
+def test_verify_wrong_code(user_manager, first_canceled):
+    user_id, code = uuid.uuid4(), uuid.uuid4()
+
+    def load(user):
+        user.verification_code = uuid.uuid4()
+    user_manager.engine.load.side_effect = load
 
     with pytest.raises(NotSaved) as excinfo:
-        user_manager.verify(user, wrong_code)
-    assert excinfo.value.obj is user
-    user_manager.engine.assert_not_called()
+        user_manager.verify(user_id, code, valid_username)
+    assert excinfo.value.obj.user_id == user_id
+    assert first_canceled.call_count == 1
+
+
+def test_verify_legacy_string_code(user_manager, first_canceled):
+    """Codes still stored as strings fail the binary condition, but match once loaded"""
+    user_id, code = uuid.uuid4(), uuid.uuid4()
+    tx = user_manager.engine.transaction.return_value
+
+    def load(user):
+        user.verification_code = code
+    user_manager.engine.load.side_effect = load
+
+    user_manager.verify(user_id, code, valid_username)
+    assert first_canceled.call_count == 2
+    assert tx.save.call_args_list[2:] == [
+        call(User(user_id=user_id, verification_code=None), condition=User.verification_code.is_not(None)),
+        call(UserName(username=valid_username, verified=True), condition=UserName.user_id == user_id),
+    ]
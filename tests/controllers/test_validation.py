@@ -104,6 +104,19 @@ def test_invalid_email(invalid_email):
     assert "email" == excinfo.value.parameter_name
 
 
+def test_valid_key_cursor():
+    key_id = uuid.uuid4()
+    cursor = base64.urlsafe_b64encode(key_id.bytes).rstrip(b"=").decode("utf-8")
+    assert validate("key_cursor", cursor) == key_id
+
+
+@pytest.mark.parametrize("invalid_cursor", [None, "", "not a cursor", "c2hvcnQ", str(uuid.uuid4())])
+def test_invalid_key_cursor(invalid_cursor):
+    with pytest.raises(InvalidParameter) as excinfo:
+        validate("key_cursor", invalid_cursor)
+    assert excinfo.value.parameter_name == "key_cursor"
+
+
 @pytest.mark.parametrize("valid_username", valid_usernames)
 def test_valid_username(valid_username):
     assert validate("username", valid_username) == valid_username
@@ -161,7 +174,8 @@ def test_invalid_public_key(rsa_pub):
         encoded_bytes,
         encoded_bytes.decode("utf-8"),  # as string
         "",
-        b""
+        b"",
+        {"kty": "RSA", "e": "AQAB"},  # missing "n"
     ]
 
     for invalid_key in invalid_keys:
@@ -190,3 +204,38 @@ def test_invalid_password_hash():
         with pytest.raises(InvalidParameter) as excinfo:
             validate("password_hash", invalid_hash)
         assert "password_hash" == excinfo.value.parameter_name
+
+
+def test_valid_public_keys(generate_key):
+    publics = [generate_key().public_key() for _ in range(2)]
+    jwk_set = {"keys": [
+        {"kty": "RSA", "e": i2b64(public.public_numbers().e), "n": i2b64(public.public_numbers().n)}
+        for public in publics
+    ]}
+    pem_list = [
+        public.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        ).decode("utf-8")
+        for public in publics
+    ]
+    for valid_keys in [jwk_set, jwk_set["keys"], pem_list]:
+        validated = validate("public_keys", valid_keys)
+        assert [as_der(key) for key in validated] == [as_der(key) for key in publics]
+
+
+@pytest.mark.parametrize("invalid_keys, message", [
+    (None, "Must be a JWK Set or a non-empty list of public keys"),
+    ([], "Must be a JWK Set or a non-empty list of public keys"),
+    ({"keys": []}, "Must be a JWK Set or a non-empty list of public keys"),
+    ("not a list", "Must be a JWK Set or a non-empty list of public keys"),
+    (["not a key"], "Malformed public key at index 0"),
+    ([{"kty": "EC", "crv": "P-256", "x": "AAAA", "y": "AAAA"}], "Malformed public key at index 0"),
+    ({"keys": [{"kty": "RSA", "n": "AQAB"}]}, "Malformed public key at index 0"),
+    (["not a key"] * 26, "Must contain at most 25 public keys"),
+])
+def test_invalid_public_keys(invalid_keys, message):
+    with pytest.raises(InvalidParameter) as excinfo:
+        validate("public_keys", invalid_keys)
+    assert "public_keys" == excinfo.value.parameter_name
+    assert message == excinfo.value.message
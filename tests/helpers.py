@@ -3,6 +3,7 @@ import json
 import sys
 from typing import Dict, List, Optional, Union
 
+import botocore.exceptions
 import falcon
 import falcon.testing
 import falcon.testing.resource
@@ -115,3 +116,27 @@ def as_der(public_key: RSAPublicKey) -> bytes:
         encoding=serialization.Encoding.DER,
         format=serialization.PublicFormat.SubjectPublicKeyInfo
     )
+
+
+def client_error(code: str, status: int=400, operation: str="GetItem") -> botocore.exceptions.ClientError:
+    return botocore.exceptions.ClientError(
+        {"Error": {"Code": code, "Message": code}, "ResponseMetadata": {"HTTPStatusCode": status}}, operation)
+
+
+class ThrottlingDynamoDB:
+    """Local stand-in for a DynamoDB client that throttles the next `throttles` calls to any operation.
+
+    Calls that aren't throttled return a copy of `response`.  Every call's operation name is kept in `calls`."""
+    def __init__(self, throttles: int=0, response: Optional[Dict]=None):
+        self.throttles = throttles
+        self.response = response or {}
+        self.calls = []
+
+    def __getattr__(self, name: str):
+        def operation(**request):
+            self.calls.append(name)
+            if self.throttles:
+                self.throttles -= 1
+                raise client_error("ProvisionedThroughputExceededException", operation=name)
+            return dict(self.response)
+        return operation
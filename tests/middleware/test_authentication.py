@@ -16,9 +16,10 @@ from moldyboot.middleware.authentication import (
     authenticate_password,
     authenticate_signature,
 )
-from moldyboot.models import Key, User, UserName
+from moldyboot.models import Key, User
 from moldyboot.security import passwords
 from moldyboot.security.passwords import hash
+from moldyboot.security.principals import KeyPrincipal, UserPrincipal
 from moldyboot.security.signatures import sign
 
 
@@ -172,41 +173,24 @@ def test_authenticate_signature_success(rsa_pub, valid_request, mock_key_manager
 def test_authenticate_password_invalid_username(mock_user_manager):
     username = "0abc"
     password = "hunter2"
-    mock_user_manager.get_username.side_effect = InvalidParameter("username", "0abc", "test message")
+    mock_user_manager.get_login.side_effect = InvalidParameter("username", "0abc", "test message")
 
     with pytest.raises(falcon.HTTPUnauthorized) as excinfo:
         authenticate_password(username, password, mock_user_manager)
     assert "Invalid username/password" in excinfo.value.description
-    mock_user_manager.get_username.assert_called_once_with(username)
-    mock_user_manager.get_user.assert_not_called()
+    mock_user_manager.get_login.assert_called_once_with(username)
 
 
 def test_authenticate_password_username_missing(mock_user_manager):
     username = "abc"
     password = "hunter2"
 
-    mock_user_manager.get_username.side_effect = NotFound
-
-    with pytest.raises(falcon.HTTPUnauthorized) as excinfo:
-        authenticate_password(username, password, mock_user_manager)
-    assert "Invalid username/password" in excinfo.value.description
-    mock_user_manager.get_username.assert_called_once_with(username)
-    mock_user_manager.get_user.assert_not_called()
-
-
-def test_authenticate_password_user_missing(mock_user_manager):
-    username = "abc"
-    user_id = uuid.uuid4()
-    password = "hunter2"
-
-    mock_user_manager.get_username.return_value = UserName(username=username, user_id=user_id)
-    mock_user_manager.get_user.side_effect = NotFound
+    mock_user_manager.get_login.side_effect = NotFound
 
     with pytest.raises(falcon.HTTPUnauthorized) as excinfo:
         authenticate_password(username, password, mock_user_manager)
     assert "Invalid username/password" in excinfo.value.description
-    mock_user_manager.get_username.assert_called_once_with(username)
-    mock_user_manager.get_user.assert_called_once_with(user_id)
+    mock_user_manager.get_login.assert_called_once_with(username)
 
 
 def test_authenticate_password_wrong_password(mock_user_manager):
@@ -215,14 +199,14 @@ def test_authenticate_password_wrong_password(mock_user_manager):
     password = "hunter2"
     wrong_hash = hash(password="*******", rounds=12)
 
-    mock_user_manager.get_username.return_value = UserName(username=username, user_id=user_id)
-    mock_user_manager.get_user.return_value = User(user_id=user_id, password_hash=wrong_hash)
+    mock_user_manager.get_login.return_value = User(user_id=user_id, password_hash=wrong_hash)
 
     with pytest.raises(falcon.HTTPUnauthorized) as excinfo:
         authenticate_password(username, password, mock_user_manager)
     assert "Invalid username/password" in excinfo.value.description
-    mock_user_manager.get_username.assert_called_once_with(username)
-    mock_user_manager.get_user.assert_called_once_with(user_id)
+    mock_user_manager.get_login.assert_called_once_with(username)
+    # A wrong password never writes
+    mock_user_manager.sync_login.assert_not_called()
 
 
 def test_authenticate_password_success(mock_user_manager):
@@ -232,13 +216,12 @@ def test_authenticate_password_success(mock_user_manager):
     correct_hash = hash(password=password, rounds=12)
     user = User(user_id=user_id, password_hash=correct_hash)
 
-    mock_user_manager.get_username.return_value = UserName(username=username, user_id=user_id)
-    mock_user_manager.get_user.return_value = User(user_id=user_id, password_hash=correct_hash)
+    mock_user_manager.get_login.return_value = User(user_id=user_id, password_hash=correct_hash)
 
     actual_user = authenticate_password(username, password, mock_user_manager)
     assert actual_user == user
-    mock_user_manager.get_username.assert_called_once_with(username)
-    mock_user_manager.get_user.assert_called_once_with(user_id)
+    mock_user_manager.get_login.assert_called_once_with(username)
+    mock_user_manager.sync_login.assert_called_once_with(username, user)
 
 
 # Middleware tests start here ========================================================================================
@@ -263,14 +246,13 @@ def test_authentication_middleware_basic_success(mock_key_manager, mock_user_man
     resp, resource = response(), resource_with("authentication-basic")
     middleware = Authentication(mock_key_manager, mock_user_manager)
 
-    mock_user_manager.get_username.return_value = UserName(username=username, user_id=user_id)
-    mock_user_manager.get_user.return_value = user
+    mock_user_manager.get_login.return_value = user
 
     middleware.process_resource(req, resp, resource, {})
 
-    assert req.context["authentication"] == {"user": user}
-    mock_user_manager.get_username.assert_called_once_with(username)
-    mock_user_manager.get_user.assert_called_once_with(user_id)
+    principal = UserPrincipal(user_id=user_id, is_verified=True, is_deleted=False)
+    assert req.context["authentication"] == {"user": principal}
+    mock_user_manager.get_login.assert_called_once_with(username)
 
 
 def test_authentication_middleware_unverified(mock_key_manager, mock_user_manager):
@@ -283,15 +265,13 @@ def test_authentication_middleware_unverified(mock_key_manager, mock_user_manage
     resp, resource = response(), resource_with("authentication-basic")
     middleware = Authentication(mock_key_manager, mock_user_manager)
 
-    mock_user_manager.get_username.return_value = UserName(username=username, user_id=user_id)
-    mock_user_manager.get_user.return_value = user
+    mock_user_manager.get_login.return_value = user
 
     with pytest.raises(falcon.HTTPUnauthorized) as excinfo:
         middleware.process_resource(req, resp, resource, {})
     assert excinfo.value.description == "Account not verified"
 
-    mock_user_manager.get_username.assert_called_once_with(username)
-    mock_user_manager.get_user.assert_called_once_with(user_id)
+    mock_user_manager.get_login.assert_called_once_with(username)
 
 
 def test_authentication_middleware_deleted(mock_key_manager, mock_user_manager):
@@ -304,15 +284,13 @@ def test_authentication_middleware_deleted(mock_key_manager, mock_user_manager):
     resp, resource = response(), resource_with("authentication-basic")
     middleware = Authentication(mock_key_manager, mock_user_manager)
 
-    mock_user_manager.get_username.return_value = UserName(username=username, user_id=user_id)
-    mock_user_manager.get_user.return_value = user
+    mock_user_manager.get_login.return_value = user
 
     with pytest.raises(falcon.HTTPUnauthorized) as excinfo:
         middleware.process_resource(req, resp, resource, {})
     assert excinfo.value.description == "Account was deleted"
 
-    mock_user_manager.get_username.assert_called_once_with(username)
-    mock_user_manager.get_user.assert_called_once_with(user_id)
+    mock_user_manager.get_login.assert_called_once_with(username)
 
 
 def test_authentication_middleware_basic_no_username(mock_key_manager, mock_user_manager):
@@ -324,8 +302,7 @@ def test_authentication_middleware_basic_no_username(mock_key_manager, mock_user
         middleware.process_resource(req, resp, resource, {})
     assert excinfo.value.description == "username is missing"
 
-    mock_user_manager.get_username.assert_not_called()
-    mock_user_manager.get_user.assert_not_called()
+    mock_user_manager.get_login.assert_not_called()
     mock_key_manager.get_key.assert_not_called()
 
 
@@ -338,8 +315,7 @@ def test_authentication_middleware_basic_no_password(mock_key_manager, mock_user
         middleware.process_resource(req, resp, resource, {})
     assert excinfo.value.description == "password is missing"
 
-    mock_user_manager.get_username.assert_not_called()
-    mock_user_manager.get_user.assert_not_called()
+    mock_user_manager.get_login.assert_not_called()
     mock_key_manager.get_key.assert_not_called()
 
 
@@ -352,7 +328,7 @@ def test_authentication_middleware_signature_success(rsa_priv, rsa_pub, mock_key
     # resource w/o tags defaults to signature-based auth
     resp, resource = response(), resource_with()
 
-    key = Key(user_id=user_id, key_id=key_id, public=rsa_pub)
+    key = Key(user_id=user_id, key_id=key_id, public=rsa_pub, until=1500000000, fingerprint="fingerprint")
     mock_key_manager.get_key.return_value = key
     user = User(user_id=user_id)
     mock_user_manager.get_user.return_value = user
@@ -360,9 +336,12 @@ def test_authentication_middleware_signature_success(rsa_priv, rsa_pub, mock_key
     middleware = Authentication(mock_key_manager, mock_user_manager)
     middleware.process_resource(req, resp, resource, {})
 
-    mock_user_manager.get_user.assert_called_once_with(user_id)
+    mock_user_manager.get_user.assert_called_once_with(user_id, projection=["verification_code", "deleted"])
     mock_key_manager.get_key.assert_called_once_with(str(user_id), str(key_id))
-    assert req.context["authentication"] == {"key": key, "user": user}
+    assert req.context["authentication"] == {
+        "key": KeyPrincipal(
+            user_id=user_id, key_id=key_id, der=key.der, fingerprint="fingerprint", until=key.until),
+        "user": UserPrincipal(user_id=user_id, is_verified=True, is_deleted=False)}
 
 
 def test_authentication_middleware_signature_unknown_user(rsa_priv, rsa_pub, mock_key_manager, mock_user_manager):
@@ -383,7 +362,7 @@ def test_authentication_middleware_signature_unknown_user(rsa_priv, rsa_pub, moc
     with pytest.raises(falcon.HTTPUnauthorized) as excinfo:
         middleware.process_resource(req, resp, resource, {})
     assert excinfo.value.description == "Unknown user"
-    mock_user_manager.get_user.assert_called_once_with(user_id)
+    mock_user_manager.get_user.assert_called_once_with(user_id, projection=["verification_code", "deleted"])
     mock_key_manager.get_key.assert_called_once_with(str(user_id), str(key_id))
 
 
@@ -404,3 +383,51 @@ def test_authentication_middleware_signature_failure(mock_key_manager, mock_user
 
     mock_user_manager.get_user.assert_not_called()
     mock_key_manager.get_key.assert_not_called()
+
+
+def test_authenticate_password_cached(mock_user_manager):
+    username = "abc"
+    user_id = uuid.uuid4()
+    password = "hunter2"
+    correct_hash = hash(password=password, rounds=12)
+    cache = Mock(spec=passwords.CheckCache)
+
+    mock_user_manager.get_login.return_value = User(user_id=user_id, password_hash=correct_hash)
+
+    authenticate_password(username, password, mock_user_manager, cache)
+    cache.check.assert_called_once_with(user_id=user_id, password=password, expected_hash=correct_hash)
+    cache.invalidate.assert_not_called()
+
+
+def test_authenticate_password_cached_deleted(mock_user_manager):
+    """Deleted users are dropped from the cache and always pay for a full check"""
+    username = "abc"
+    user_id = uuid.uuid4()
+    password = "hunter2"
+    correct_hash = hash(password=password, rounds=12)
+    cache = Mock(spec=passwords.CheckCache)
+
+    mock_user_manager.get_login.return_value = User(user_id=user_id, password_hash=correct_hash, deleted=True)
+
+    authenticate_password(username, password, mock_user_manager, cache)
+    cache.check.assert_not_called()
+    cache.invalidate.assert_called_once_with(user_id)
+
+
+def test_authentication_middleware_login_cache(mock_key_manager, mock_user_manager, monkeypatch):
+    """Repeated basic auth with the same credentials only runs bcrypt once"""
+    username, user_id, password = "abcUser", uuid.uuid4(), "|-|unterZ"
+    correct_hash = passwords.hash(password=password, rounds=12)
+    checks = []
+    real_check = passwords.check
+    monkeypatch.setattr(passwords, "check", lambda **kwargs: checks.append(kwargs) or real_check(**kwargs))
+    cache = passwords.CheckCache()
+    middleware = Authentication(mock_key_manager, mock_user_manager, login_cache=cache)
+
+    mock_user_manager.get_login.return_value = User(user_id=user_id, password_hash=correct_hash)
+
+    for _ in range(2):
+        req = request(body={"username": username, "password": password})
+        middleware.process_resource(req, response(), resource_with("authentication-basic"), {})
+        assert req.context["authentication"]["user"].user_id == user_id
+    assert len(checks) == 1
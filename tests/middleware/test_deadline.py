@@ -0,0 +1,16 @@
+from tests.helpers import request, response
+
+from moldyboot.controllers import Deadline
+from moldyboot.middleware import RequestDeadline
+
+
+def test_scopes_deadline():
+    deadline = Deadline()
+    middleware = RequestDeadline(5, deadline)
+    req, resp = request(), response()
+
+    middleware.process_request(req, resp)
+    assert 4 < deadline.remaining() <= 5
+
+    middleware.process_response(req, resp, None)
+    assert deadline.remaining() is None
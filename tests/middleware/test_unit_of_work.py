@@ -0,0 +1,37 @@
+import uuid
+
+from tests.helpers import request, response
+
+from moldyboot.clock import Clock
+from moldyboot.controllers import IdentityMap
+from moldyboot.middleware import UnitOfWork
+from moldyboot.models import User
+
+
+def test_scopes_identity_map():
+    identity_map = IdentityMap()
+    middleware = UnitOfWork(identity_map)
+    req, resp = request(), response()
+
+    middleware.process_request(req, resp)
+    assert identity_map.active
+    user = User(user_id=uuid.uuid4())
+    identity_map.put(user)
+
+    middleware.process_response(req, resp, None)
+    assert not identity_map.active
+    assert identity_map.get(User, user_id=user.user_id) is None
+
+
+def test_scopes_clock():
+    """Every read of the clock during a request sees the same time"""
+    times = iter([100.5, 200.5])
+    clock = Clock(source=lambda: next(times))
+    middleware = UnitOfWork(IdentityMap(), clock)
+    req, resp = request(), response()
+
+    middleware.process_request(req, resp)
+    assert clock.now() == clock.now() == 100
+
+    middleware.process_response(req, resp, None)
+    assert clock.now() == 200
@@ -0,0 +1,126 @@
+import base64
+import uuid
+
+import bloop
+import pendulum
+import pytest
+from bloop.conditions import get_marked
+from bloop.models import unpack_from_dynamodb
+from tests.helpers import as_der
+
+from moldyboot.models import FastEngine, Key, User, UserName, compile_codec
+
+
+def bloop_load(engine, model, attrs):
+    return unpack_from_dynamodb(model=model, attrs=attrs, expected=model.Meta.columns, engine=engine)
+
+
+def values(obj):
+    return {column.name: getattr(obj, column.name) for column in obj.Meta.columns}
+
+
+def assert_same(engine, model, attrs):
+    """The codec loads and dumps exactly what bloop does"""
+    codec = compile_codec(model)
+    expected = bloop_load(engine, model, attrs)
+    actual = codec.load(attrs)
+
+    assert values(actual) == values(expected)
+    for column in model.Meta.columns:
+        assert getattr(actual, column.name).__class__ is getattr(expected, column.name).__class__
+    assert {c.name for c in get_marked(actual)} == {c.name for c in get_marked(expected)}
+    assert codec.dump(actual) == model._dump(expected, context={"engine": engine})
+    return actual
+
+
+def test_key(engine, rsa_pub):
+    key = Key(user_id=uuid.uuid4(), key_id=uuid.uuid4(), public=rsa_pub, until=1500000000)
+    attrs = Key._dump(key, context={"engine": engine})
+    assert assert_same(engine, Key, attrs).until == 1500000000
+
+
+def test_key_not_parsed(engine, rsa_pub):
+    attrs = Key._dump(Key(user_id=uuid.uuid4(), key_id=uuid.uuid4(), public=rsa_pub), context={"engine": engine})
+    key = compile_codec(Key).load(attrs)
+    assert "_public" not in key.__dict__
+    assert key.public.public_numbers() == rsa_pub.public_numbers()
+
+
+@pytest.mark.parametrize("verification_code", [
+    {"B": "9LJ1hV3ARxCqM3wH9w0rIw=="},
+    {"S": "f4b27585-5dc0-4710-aa33-7c07f70d2b23"},
+    None,
+])
+def test_user(engine, verification_code):
+    attrs = {
+        "u": {"S": str(uuid.uuid4())},
+        "p": {"B": "aGFzaA=="},
+        "e": {"S": "user@example.com"},
+        "d": {"BOOL": False},
+    }
+    if verification_code:
+        attrs["v"] = verification_code
+    assert_same(engine, User, attrs)
+
+
+def test_user_sparse(engine):
+    assert_same(engine, User, {"u": {"S": str(uuid.uuid4())}})
+
+
+def test_username(engine):
+    username = UserName(
+        username="user", user_id=uuid.uuid4(), created=pendulum.now(),
+        password_hash=b"hash", verified=True, deleted=False)
+    assert_same(engine, UserName, UserName._dump(username, context={"engine": engine}))
+
+
+def test_integer_exponent(engine, rsa_pub):
+    """Numbers that aren't plain ints are parsed the way bloop does"""
+    attrs = {
+        "u": {"S": str(uuid.uuid4())},
+        "k": {"S": str(uuid.uuid4())},
+        "p": {"B": base64.b64encode(as_der(rsa_pub)).decode("utf-8")},
+        "e": {"N": "1.5E+9"},
+    }
+    assert assert_same(engine, Key, attrs).until == 1500000000
+
+
+def test_dump_empty():
+    assert compile_codec(User).dump(User()) is None
+
+
+# FastEngine ========================================================================================== FastEngine
+
+@pytest.fixture
+def fast_engine(dynamodb):
+    return FastEngine(dynamodb=dynamodb, dynamodbstreams=object(), table_name_template="mb.{table_name}")
+
+
+def test_fast_engine_load(fast_engine, dynamodb, engine):
+    user_id = uuid.uuid4()
+    item = {"u": {"S": str(user_id)}, "e": {"S": "user@example.com"}, "d": {"BOOL": True}}
+    dynamodb.batch_get_item.return_value = {"Responses": {"mb.users": [item]}, "UnprocessedKeys": {}}
+
+    user = User(user_id=user_id)
+    fast_engine.load(user, consistent=True)
+    dynamodb.batch_get_item.assert_called_once_with(
+        RequestItems={"mb.users": {"Keys": [{"u": {"S": str(user_id)}}], "ConsistentRead": True}})
+    assert values(user) == values(bloop_load(engine, User, item))
+
+
+def test_fast_engine_missing(fast_engine, dynamodb):
+    dynamodb.batch_get_item.return_value = {"Responses": {}, "UnprocessedKeys": {}}
+    user = User(user_id=uuid.uuid4())
+    with pytest.raises(bloop.MissingObjects) as excinfo:
+        fast_engine.load(user)
+    assert list(excinfo.value.objects) == [user]
+
+
+def test_fast_engine_many(fast_engine, dynamodb):
+    """Loading several objects at once goes through bloop"""
+    users = [User(user_id=uuid.uuid4()) for _ in range(2)]
+    dynamodb.batch_get_item.return_value = {
+        "Responses": {"mb.users": [{"u": {"S": str(user.user_id)}, "e": {"S": "e"}} for user in users]},
+        "UnprocessedKeys": {}}
+    fast_engine.load(*users)
+    assert [user.email for user in users] == ["e", "e"]
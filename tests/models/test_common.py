@@ -0,0 +1,24 @@
+import base64
+import uuid
+
+from moldyboot.models.common import CompactUUID
+
+
+def test_compact_uuid_dump():
+    value = uuid.uuid4()
+    typedef = CompactUUID()
+    assert typedef._dump(value, context=None) == {"B": base64.b64encode(value.bytes).decode("utf-8")}
+    assert typedef._dump(None, context=None) is None
+
+
+def test_compact_uuid_load():
+    value = uuid.uuid4()
+    typedef = CompactUUID()
+    assert typedef._load({"B": base64.b64encode(value.bytes).decode("utf-8")}, context=None) == value
+    assert typedef._load(None, context=None) is None
+
+
+def test_compact_uuid_load_string():
+    """Values written by bloop.UUID still load"""
+    value = uuid.uuid4()
+    assert CompactUUID()._load({"S": str(value)}, context=None) == value
@@ -1,20 +1,19 @@
-import base64
 import uuid
 
-import pendulum
+from cryptography.hazmat.primitives import serialization
 from tests.helpers import as_der
 
-from moldyboot.models.key import Key, PublicKeyType
+from moldyboot.models.key import Key, as_bytes, der_to_pem
 
 
 def test_eq(generate_key):
-    key = Key(user_id=uuid.uuid4(), key_id=uuid.uuid4(), public=generate_key().public_key(), until=pendulum.now())
+    key = Key(user_id=uuid.uuid4(), key_id=uuid.uuid4(), public=generate_key().public_key(), until=1500000000)
     other = Key(user_id=key.user_id, key_id=key.key_id, public=key.public, until=key.until)
 
     assert key != object()
     assert key == other
     # missing an attribute
-    for attr in ["user_id", "key_id", "public", "until"]:
+    for attr in ["user_id", "key_id", "der", "until"]:
         delattr(other, attr)
         assert key != other
         # reset the attribute
@@ -24,23 +23,42 @@ def test_eq(generate_key):
     assert key != other
 
 
-def test_key_type(rsa_pub):
-    pub_bytes = as_der(rsa_pub)
-    serialized_public = base64.b64encode(pub_bytes)
+def test_public_lazy(rsa_pub):
+    """The DER is only parsed when public is used, then reused"""
+    der = as_der(rsa_pub)
+    key = Key(der=der)
+    assert "_public" not in key.__dict__
+    assert key.public.public_numbers() == rsa_pub.public_numbers()
+    assert key.public is key.public
 
-    key_type = PublicKeyType()
-    assert key_type.dynamo_dump(rsa_pub) == serialized_public.decode("utf-8")
-    loaded = key_type.dynamo_load(serialized_public)
-    assert loaded.public_numbers() == rsa_pub.public_numbers()
+    # Replacing the stored bytes drops the parsed key
+    parsed = key.public
+    key.der = bytes(bytearray(der))
+    assert key.public is not parsed
 
 
-def test_is_expired():
-    now = pendulum.now()
+def test_public_setter(rsa_pub):
+    key = Key(public=rsa_pub)
+    assert key.der == as_der(rsa_pub)
+    assert key.public is rsa_pub
+
+
+def test_der_to_pem(rsa_pub):
+    assert der_to_pem(as_der(rsa_pub)) == as_bytes(rsa_pub, serialization.Encoding.PEM)
 
-    # key was valid until 5 seconds in the past
-    key = Key(until=now.subtract(seconds=5))
-    assert key.is_expired
 
+def test_fingerprint_without_parsing(rsa_pub):
+    key = Key(der=as_der(rsa_pub))
+    expected = Key(public=rsa_pub).compute_fingerprint()
+    assert key.compute_fingerprint() == expected
+    assert "_public" not in key.__dict__
+
+
+def test_is_expired_at():
+    now = 1500000000
+    # key was valid until 5 seconds in the past
+    assert Key(until=now - 5).is_expired_at(now)
     # key is valid until 5 seconds from now
-    key = Key(until=now.add(seconds=5))
-    assert not key.is_expired
+    assert not Key(until=now + 5).is_expired_at(now)
+    # still valid at the second it expires
+    assert not Key(until=now).is_expired_at(now)
@@ -0,0 +1,18 @@
+import falcon
+import pytest
+from tests.helpers import request, response
+
+from moldyboot.controllers import DeadlineExceeded, Unavailable
+from moldyboot.resources import handle_deadline_exceeded, handle_unavailable
+
+
+def test_handle_unavailable():
+    with pytest.raises(falcon.HTTPServiceUnavailable) as excinfo:
+        handle_unavailable(Unavailable(3), request(), response(), {})
+    assert excinfo.value.headers["Retry-After"] == "3"
+
+
+def test_handle_deadline_exceeded():
+    with pytest.raises(falcon.HTTPError) as excinfo:
+        handle_deadline_exceeded(DeadlineExceeded("get_item"), request(), response(), {})
+    assert excinfo.value.status == falcon.HTTP_504
@@ -6,27 +6,30 @@ import pytest
 from cryptography.hazmat.primitives import serialization
 from tests.helpers import request, response
 
-from moldyboot.controllers import InvalidParameter, NotSaved
+from moldyboot.controllers import InvalidParameter, NotFound, NotSaved
 from moldyboot.models import Key, User
-from moldyboot.resources.keys import Keys
+from moldyboot.resources.keys import KeyList, Keys
+from moldyboot.resources.limits import RateLimit
+from moldyboot.security.principals import KeyPrincipal, UserPrincipal
 
 
 def basic_auth_request(user, **kwargs):
     req = request(**kwargs)
-    req.context["authentication"] = {"user": user}
+    req.context["authentication"] = {"user": UserPrincipal.from_user(user)}
     return req
 
 
 def signed_auth_request(key, user, **kwargs):
     req = request(**kwargs)
-    req.context["authentication"] = {"key": key, "user": user}
+    req.context["authentication"] = {"key": KeyPrincipal.from_key(key), "user": UserPrincipal.from_user(user)}
     return req
 
 
 def test_on_get(mock_key_manager, rsa_pub):
     """Echoes the authenticated public key back at the user"""
-    expiry = pendulum.now().in_timezone("utc").add(hours=1)
-    key = Key(key_id=uuid.uuid4(), user_id=uuid.uuid4(), public=rsa_pub, until=expiry)
+    # Stored (and returned) in whole seconds
+    expiry = pendulum.now("UTC").add(hours=1).replace(microsecond=0)
+    key = Key(key_id=uuid.uuid4(), user_id=uuid.uuid4(), public=rsa_pub, until=expiry.int_timestamp)
     user = User(user_id=key.user_id)
     req, resp = signed_auth_request(key, user), response()
 
@@ -41,19 +44,43 @@ def test_on_get(mock_key_manager, rsa_pub):
     mock_key_manager.assert_not_called()
 
 
+def test_on_get_stored_fingerprint(mock_key_manager, rsa_pub):
+    """The stored fingerprint is returned as-is"""
+    key = Key(key_id=uuid.uuid4(), user_id=uuid.uuid4(), public=rsa_pub, until=1500000000, fingerprint="stored")
+    req, resp = signed_auth_request(key, User(user_id=key.user_id)), response()
+
+    Keys(mock_key_manager).on_get(req, resp)
+
+    assert req.context["response"]["fingerprint"] == "stored"
+
+
 def test_on_delete(mock_key_manager, rsa_pub):
     """Manually revoke a key"""
-    key = Key(user_id=uuid.uuid4(), public=rsa_pub)
-    req, resp = signed_auth_request(key, None), response()
+    key = Key(user_id=uuid.uuid4(), key_id=uuid.uuid4(), public=rsa_pub, until=pendulum.now().int_timestamp)
+    req, resp = signed_auth_request(key, User(user_id=key.user_id)), response()
+    # The full model is loaded to revoke it
+    mock_key_manager.get_key.return_value = key
 
     resource = Keys(mock_key_manager)
     resource.on_delete(req, resp)
 
     assert "response" not in req.context
     assert resp.status == falcon.HTTP_200
+    mock_key_manager.get_key.assert_called_once_with(key.user_id, key.key_id)
     mock_key_manager.revoke.assert_called_once_with(key)
 
 
+def test_on_delete_already_revoked(mock_key_manager, rsa_pub):
+    """The key was revoked after authentication"""
+    key = Key(user_id=uuid.uuid4(), key_id=uuid.uuid4(), public=rsa_pub, until=pendulum.now().int_timestamp)
+    req, resp = signed_auth_request(key, User(user_id=key.user_id)), response()
+    mock_key_manager.get_key.side_effect = NotFound
+
+    with pytest.raises(falcon.HTTPUnauthorized):
+        Keys(mock_key_manager).on_delete(req, resp)
+    mock_key_manager.revoke.assert_not_called()
+
+
 def test_on_post_no_public_key(mock_key_manager):
     """Upload a new key without a public_key in the body fails"""
     user = User(user_id=uuid.uuid4())
@@ -115,9 +142,10 @@ def test_on_post(mock_key_manager, rsa_pub):
     ).decode("utf-8")
     req, resp = basic_auth_request(user, body={"public_key": public_key}), response()
 
-    expiry = pendulum.now().in_timezone("utc").add(hours=1)
+    # Stored (and returned) in whole seconds
+    expiry = pendulum.now("UTC").add(hours=1).replace(microsecond=0)
     resource = Keys(mock_key_manager)
-    mock_key_manager.new.return_value = Key(user_id=user.user_id, key_id=key_id, until=expiry)
+    mock_key_manager.new.return_value = Key(user_id=user.user_id, key_id=key_id, until=expiry.int_timestamp)
 
     resource.on_post(req, resp)
 
@@ -127,3 +155,169 @@ def test_on_post(mock_key_manager, rsa_pub):
     }
     assert resp.status == falcon.HTTP_200
     mock_key_manager.new.assert_called_once_with(user.user_id, public_key)
+
+
+def renew_request(rsa_pub, **body):
+    key = Key(user_id=uuid.uuid4(), key_id=uuid.uuid4(), public=rsa_pub, until=pendulum.now().int_timestamp)
+    user = User(user_id=key.user_id)
+    return signed_auth_request(key, user, body=body), response()
+
+
+def test_on_put_rate_limited(mock_key_manager, rsa_pub):
+    req, resp = renew_request(rsa_pub, public_key="some key")
+    resource = Keys(mock_key_manager, renew_limit=RateLimit(rate=0, burst=0))
+
+    with pytest.raises(falcon.HTTPTooManyRequests):
+        resource.on_put(req, resp)
+    mock_key_manager.renew.assert_not_called()
+
+
+def test_on_put_no_public_key(mock_key_manager, rsa_pub):
+    req, resp = renew_request(rsa_pub)
+    resource = Keys(mock_key_manager)
+
+    with pytest.raises(falcon.HTTPBadRequest) as excinfo:
+        resource.on_put(req, resp)
+    assert excinfo.value.description == "Must provide a public key."
+    mock_key_manager.renew.assert_not_called()
+
+
+def test_on_put_malformed_public_key(mock_key_manager, rsa_pub):
+    req, resp = renew_request(rsa_pub, public_key="not in pem format")
+    resource = Keys(mock_key_manager)
+    mock_key_manager.renew.side_effect = InvalidParameter("public_key", "not in pem format", "test message")
+
+    with pytest.raises(falcon.HTTPBadRequest) as excinfo:
+        resource.on_put(req, resp)
+    assert excinfo.value.description == "Expected public key in PEM format."
+
+
+def test_on_put_fail_to_save(mock_key_manager, rsa_pub):
+    req, resp = renew_request(rsa_pub, public_key="some key")
+    resource = Keys(mock_key_manager)
+    mock_key_manager.renew.side_effect = NotSaved(object())
+
+    with pytest.raises(falcon.HTTPInternalServerError) as excinfo:
+        resource.on_put(req, resp)
+    assert excinfo.value.description == "Failed to store public key"
+
+
+@pytest.mark.parametrize("revoke", [None, False, True, "true"])
+def test_on_put(mock_key_manager, rsa_pub, revoke):
+    """Renew with the signing key, returning the new user_id@key_id"""
+    body = {"public_key": "some key"}
+    if revoke is not None:
+        body["revoke"] = revoke
+    req, resp = renew_request(rsa_pub, **body)
+    principal = req.context["authentication"]["key"]
+    key = Key(user_id=principal.user_id, key_id=principal.key_id, der=principal.der, until=principal.until)
+    mock_key_manager.get_key.return_value = key
+    new_key_id = uuid.uuid4()
+    # Stored (and returned) in whole seconds
+    expiry = pendulum.now("UTC").add(hours=1).replace(microsecond=0)
+    mock_key_manager.renew.return_value = Key(user_id=key.user_id, key_id=new_key_id, until=expiry.int_timestamp)
+
+    resource = Keys(mock_key_manager)
+    resource.on_put(req, resp)
+
+    assert req.context["response"] == {
+        "key_id": "{}@{}".format(key.user_id, new_key_id),
+        "until": expiry.isoformat()
+    }
+    assert resp.status == falcon.HTTP_200
+    # Only an explicit true revokes the signing key
+    mock_key_manager.renew.assert_called_once_with(key, "some key", revoke=revoke is True)
+
+
+def test_on_post_many_invalid(mock_key_manager):
+    user = User(user_id=uuid.uuid4())
+    req, resp = basic_auth_request(user, body={"public_keys": []}), response()
+    mock_key_manager.new_many.side_effect = InvalidParameter("public_keys", [], "test message")
+
+    with pytest.raises(falcon.HTTPBadRequest) as excinfo:
+        Keys(mock_key_manager).on_post(req, resp)
+    assert excinfo.value.description == "test message"
+    mock_key_manager.new.assert_not_called()
+
+
+def test_on_post_many_fail_to_save(mock_key_manager):
+    user = User(user_id=uuid.uuid4())
+    req, resp = basic_auth_request(user, body={"public_keys": ["a", "b"]}), response()
+    mock_key_manager.new_many.side_effect = NotSaved([object(), object()])
+
+    with pytest.raises(falcon.HTTPInternalServerError) as excinfo:
+        Keys(mock_key_manager).on_post(req, resp)
+    assert excinfo.value.description == "Failed to store 2 public keys"
+
+
+def test_on_post_many(mock_key_manager):
+    """Upload a JWK Set, returning each user_id@key_id"""
+    user = User(user_id=uuid.uuid4())
+    jwk_set = {"keys": [{"kty": "RSA", "e": "AQAB", "n": "some-n"}]}
+    req, resp = basic_auth_request(user, body={"public_keys": jwk_set}), response()
+    # Stored (and returned) in whole seconds
+    expiry = pendulum.now("UTC").add(hours=1).replace(microsecond=0)
+    key_ids = [uuid.uuid4(), uuid.uuid4()]
+    mock_key_manager.new_many.return_value = [
+        Key(user_id=user.user_id, key_id=key_id, until=expiry.int_timestamp) for key_id in key_ids]
+
+    Keys(mock_key_manager).on_post(req, resp)
+
+    assert req.context["response"] == {
+        "key_ids": ["{}@{}".format(user.user_id, key_id) for key_id in key_ids],
+        "until": expiry.isoformat()
+    }
+    assert resp.status == falcon.HTTP_200
+    mock_key_manager.new_many.assert_called_once_with(user.user_id, jwk_set)
+    mock_key_manager.new.assert_not_called()
+
+
+# KeyList ================================================================================================== KeyList
+
+def test_key_list(mock_key_manager):
+    user = User(user_id=uuid.uuid4())
+    req, resp = basic_auth_request(user, uri="/keys/list?limit=2&cursor=abc"), response()
+    until = pendulum.now("UTC").replace(microsecond=0)
+    keys = [
+        Key(user_id=user.user_id, key_id=uuid.uuid4(), until=until.int_timestamp, fingerprint="fp"),
+        Key(user_id=user.user_id, key_id=uuid.uuid4(), until=until.int_timestamp, fingerprint=""),
+    ]
+    mock_key_manager.list_keys_page.return_value = keys, "next"
+
+    KeyList(mock_key_manager).on_get(req, resp)
+
+    mock_key_manager.list_keys_page.assert_called_once_with(user.user_id, cursor="abc", limit=2)
+    assert req.context["response"] == {
+        "keys": [
+            {"key_id": "{}@{}".format(user.user_id, keys[0].key_id), "until": until.isoformat(), "fingerprint": "fp"},
+            {"key_id": "{}@{}".format(user.user_id, keys[1].key_id), "until": until.isoformat(), "fingerprint": None},
+        ],
+        "cursor": "next"}
+    assert resp.status == falcon.HTTP_200
+
+
+def test_key_list_defaults(mock_key_manager):
+    user = User(user_id=uuid.uuid4())
+    req, resp = basic_auth_request(user, uri="/keys/list"), response()
+    mock_key_manager.list_keys_page.return_value = [], None
+
+    KeyList(mock_key_manager, max_limit=50).on_get(req, resp)
+
+    mock_key_manager.list_keys_page.assert_called_once_with(user.user_id, cursor=None, limit=50)
+    assert req.context["response"] == {"keys": [], "cursor": None}
+
+
+@pytest.mark.parametrize("limit", ["0", "101", "ten"])
+def test_key_list_invalid_limit(mock_key_manager, limit):
+    req, resp = basic_auth_request(User(user_id=uuid.uuid4()), uri="/keys/list?limit=" + limit), response()
+    with pytest.raises(falcon.HTTPBadRequest):
+        KeyList(mock_key_manager).on_get(req, resp)
+    mock_key_manager.list_keys_page.assert_not_called()
+
+
+def test_key_list_invalid_cursor(mock_key_manager):
+    req, resp = basic_auth_request(User(user_id=uuid.uuid4()), uri="/keys/list?cursor=bad"), response()
+    mock_key_manager.list_keys_page.side_effect = InvalidParameter("key_cursor", "bad", "test message")
+    with pytest.raises(falcon.HTTPBadRequest) as excinfo:
+        KeyList(mock_key_manager).on_get(req, resp)
+    assert excinfo.value.description == "cursor test message"
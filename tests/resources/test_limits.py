@@ -0,0 +1,61 @@
+import collections
+import threading
+import time
+
+from moldyboot.resources.limits import RateLimit
+
+
+def test_burst_then_deny():
+    limit = RateLimit(rate=0, burst=2)
+    assert limit.allow("user")
+    assert limit.allow("user")
+    assert not limit.allow("user")
+    # Other keys have their own bucket
+    assert limit.allow("other")
+
+
+def test_refill(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    limit = RateLimit(rate=0.5, burst=1)
+    assert limit.allow("user")
+    assert not limit.allow("user")
+
+    now[0] += 2
+    assert limit.allow("user")
+    assert not limit.allow("user")
+
+
+def test_max_keys():
+    limit = RateLimit(rate=0, burst=1, max_keys=2)
+    for key in ["first", "second", "third"]:
+        assert limit.allow(key)
+    # "first" was dropped, so it starts over with a full bucket
+    assert list(limit._buckets) == ["second", "third"]
+    assert limit.allow("first")
+
+
+class SlowBuckets(collections.OrderedDict):
+    """Gives other threads a chance to run between reading a bucket and writing it back"""
+    def pop(self, *args):
+        value = super().pop(*args)
+        time.sleep(0.001)
+        return value
+
+
+def test_concurrent():
+    """Threads sharing a key can't each start from a full bucket"""
+    limit = RateLimit(rate=0, burst=10)
+    limit._buckets = SlowBuckets()
+    allowed = []
+
+    def work():
+        for _ in range(5):
+            allowed.append(limit.allow("user"))
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(allowed) == 10
@@ -7,7 +7,7 @@ from tests.helpers import request, response
 from moldyboot.controllers import AlreadyExists
 from moldyboot.models import User
 from moldyboot.resources.signup import Signup
-from moldyboot.security import passwords
+from moldyboot.security import challenges, passwords
 
 
 def valid_post_body():
@@ -81,3 +81,99 @@ def test_on_post_success(mock_user_manager, mock_async_tasks, monkeypatch):
     assert resp.status == falcon.HTTP_200
     mock_async_tasks.send_verification.assert_called_once_with("user")
     mock_user_manager.new.assert_called_once_with(body["username"], body["email"], "some hash")
+
+
+# challenges ============================================================================================== challenges
+
+SECRET = b"some-secret"
+
+
+def challenge_resource(mock_user_manager, mock_async_tasks):
+    return Signup(mock_user_manager, mock_async_tasks,
+                  challenge_secret=SECRET, difficulty=challenges.Difficulty(minimum=4, maximum=4))
+
+
+def test_on_get_challenges_disabled(mock_user_manager, mock_async_tasks):
+    resource = Signup(mock_user_manager, mock_async_tasks)
+    req, resp = request(), response()
+    with pytest.raises(falcon.HTTPNotFound):
+        resource.on_get(req, resp)
+
+
+def test_on_get_challenge(mock_user_manager, mock_async_tasks):
+    resource = challenge_resource(mock_user_manager, mock_async_tasks)
+    req, resp = request(), response()
+    resource.on_get(req, resp)
+
+    challenge = req.context["response"]["challenge"]
+    assert req.context["response"]["difficulty"] == 4
+    assert resp.status == falcon.HTTP_200
+    solution = challenges.solve(challenge, "user")
+    challenges.verify(secret=SECRET, challenge=challenge, solution=solution, username="user")
+
+
+def test_on_post_missing_challenge(mock_user_manager, mock_async_tasks):
+    resource = challenge_resource(mock_user_manager, mock_async_tasks)
+    req, resp = request(body=valid_post_body()), response()
+    with pytest.raises(falcon.HTTPBadRequest) as excinfo:
+        resource.on_post(req, resp)
+    assert excinfo.value.title == "Missing required parameter"
+    assert excinfo.value.description == "Must provide a challenge and solution"
+    mock_user_manager.new.assert_not_called()
+
+
+def test_on_post_bad_solution(mock_user_manager, mock_async_tasks, monkeypatch):
+    resource = challenge_resource(mock_user_manager, mock_async_tasks)
+    body = valid_post_body()
+    body["challenge"] = challenges.issue(secret=SECRET, difficulty=32)
+    body["solution"] = "not-a-solution"
+
+    def fail_hash(**kwargs):
+        raise AssertionError("bcrypt ran before the challenge was checked")
+    monkeypatch.setattr(passwords, "hash", fail_hash)
+
+    req, resp = request(body=body), response()
+    with pytest.raises(falcon.HTTPBadRequest) as excinfo:
+        resource.on_post(req, resp)
+    assert excinfo.value.title == "Invalid parameter"
+    assert excinfo.value.description == "Challenge failed: Solution does not satisfy the challenge"
+    mock_user_manager.new.assert_not_called()
+    assert resource.difficulty.current == 4
+    assert not resource.difficulty._events
+
+
+def test_on_post_solved_challenge(mock_user_manager, mock_async_tasks, monkeypatch):
+    resource = challenge_resource(mock_user_manager, mock_async_tasks)
+    body = valid_post_body()
+    body["challenge"] = challenges.issue(secret=SECRET, difficulty=4)
+    body["solution"] = challenges.solve(body["challenge"], body["username"])
+
+    mock_user_manager.new.return_value = User(user_id=uuid.uuid4())
+    monkeypatch.setattr(passwords, "hash", lambda **kwargs: "some hash")
+
+    req, resp = request(body=body), response()
+    resource.on_post(req, resp)
+    assert resp.status == falcon.HTTP_200
+    mock_user_manager.new.assert_called_once_with(body["username"], body["email"], "some hash")
+    assert len(resource.difficulty._events) == 1
+
+
+def test_on_post_replayed_challenge(mock_user_manager, mock_async_tasks, monkeypatch):
+    """A solved challenge can't be resubmitted for another signup"""
+    resource = challenge_resource(mock_user_manager, mock_async_tasks)
+    body = valid_post_body()
+    body["challenge"] = challenges.issue(secret=SECRET, difficulty=4)
+    body["solution"] = challenges.solve(body["challenge"], body["username"])
+    mock_user_manager.new.return_value = User(user_id=uuid.uuid4())
+    monkeypatch.setattr(passwords, "hash", lambda **kwargs: "some hash")
+    resource.on_post(request(body=body), response())
+
+    hashes = []
+    monkeypatch.setattr(passwords, "hash", lambda **kwargs: hashes.append(kwargs))
+    with pytest.raises(falcon.HTTPBadRequest) as excinfo:
+        resource.on_post(request(body=body), response())
+    assert excinfo.value.description == "Challenge failed: Challenge was already used"
+    assert not hashes
+    mock_user_manager.new.assert_called_once_with(body["username"], body["email"], "some hash")
+    # Only the first signup counts towards load
+    assert len(resource.difficulty._events) == 1
@@ -0,0 +1,157 @@
+import pendulum
+import pytest
+
+from unittest.mock import Mock
+
+from moldyboot.security.challenges import (
+    BadChallenge,
+    Difficulty,
+    RedisSpentChallenges,
+    SpentChallenges,
+    issue,
+    solve,
+    verify,
+)
+
+
+SECRET = b"some-secret"
+USERNAME = "user"
+# Low difficulty keeps solve() fast
+DIFFICULTY = 4
+
+
+def test_issue_solve_verify():
+    challenge = issue(secret=SECRET, difficulty=DIFFICULTY)
+    assert challenge.startswith("{}.".format(DIFFICULTY))
+    solution = solve(challenge, USERNAME)
+    verify(secret=SECRET, challenge=challenge, solution=solution, username=USERNAME)
+
+
+def test_issue_unique():
+    assert issue(secret=SECRET, difficulty=DIFFICULTY) != issue(secret=SECRET, difficulty=DIFFICULTY)
+
+
+@pytest.mark.parametrize("challenge", [None, "", "a.b.c.d", "1.2.3", "1.2.3.4.5"])
+def test_verify_malformed(challenge):
+    with pytest.raises(BadChallenge) as excinfo:
+        verify(secret=SECRET, challenge=challenge, solution="0", username=USERNAME)
+    assert excinfo.value.args[0] == "Malformed challenge"
+
+
+def test_verify_wrong_secret():
+    challenge = issue(secret=b"other-secret", difficulty=DIFFICULTY)
+    with pytest.raises(BadChallenge) as excinfo:
+        verify(secret=SECRET, challenge=challenge, solution=solve(challenge, USERNAME), username=USERNAME)
+    assert excinfo.value.args[0] == "Challenge was not issued by this server"
+
+
+def test_verify_tampered_difficulty():
+    """Lowering the difficulty invalidates the mac"""
+    challenge = issue(secret=SECRET, difficulty=DIFFICULTY)
+    tampered = "0" + challenge[len(str(DIFFICULTY)):]
+    with pytest.raises(BadChallenge) as excinfo:
+        verify(secret=SECRET, challenge=tampered, solution="0", username=USERNAME)
+    assert excinfo.value.args[0] == "Challenge was not issued by this server"
+
+
+def test_verify_expired():
+    challenge = issue(secret=SECRET, difficulty=DIFFICULTY, ttl=-1)
+    with pytest.raises(BadChallenge) as excinfo:
+        verify(secret=SECRET, challenge=challenge, solution=solve(challenge, USERNAME), username=USERNAME)
+    assert excinfo.value.args[0] == "Challenge expired"
+
+
+def test_verify_wrong_solution():
+    # At 32 bits a random guess is effectively never correct
+    challenge = issue(secret=SECRET, difficulty=32)
+    for solution in ["not-a-solution", None]:
+        with pytest.raises(BadChallenge) as excinfo:
+            verify(secret=SECRET, challenge=challenge, solution=solution, username=USERNAME)
+        assert excinfo.value.args[0] == "Solution does not satisfy the challenge"
+
+
+def test_verify_other_username():
+    """A solution only signs up the username it was solved for"""
+    # At 16 bits the solution also holding for "other" is a 1 in 65536 chance
+    challenge = issue(secret=SECRET, difficulty=16)
+    solution = solve(challenge, USERNAME)
+    with pytest.raises(BadChallenge) as excinfo:
+        verify(secret=SECRET, challenge=challenge, solution=solution, username="other")
+    assert excinfo.value.args[0] == "Solution does not satisfy the challenge"
+
+
+def test_verify_replayed():
+    spent = SpentChallenges()
+    challenge = issue(secret=SECRET, difficulty=DIFFICULTY)
+    solution = solve(challenge, USERNAME)
+    verify(secret=SECRET, challenge=challenge, solution=solution, username=USERNAME, spent=spent)
+    with pytest.raises(BadChallenge) as excinfo:
+        verify(secret=SECRET, challenge=challenge, solution=solution, username=USERNAME, spent=spent)
+    assert excinfo.value.args[0] == "Challenge was already used"
+
+
+def test_verify_failure_not_spent():
+    """A wrong solution doesn't use up the challenge"""
+    spent = SpentChallenges()
+    challenge = issue(secret=SECRET, difficulty=DIFFICULTY)
+    with pytest.raises(BadChallenge):
+        verify(secret=SECRET, challenge=challenge, solution=None, username=USERNAME, spent=spent)
+    verify(secret=SECRET, challenge=challenge, solution=solve(challenge, USERNAME), username=USERNAME, spent=spent)
+
+
+def test_spent_challenges_expire():
+    spent = SpentChallenges()
+    now = pendulum.now().int_timestamp
+    assert spent.spend("old", now - 1)
+    assert spent.spend("new", now + 60)
+    assert not spent.spend("new", now + 60)
+    # Expired entries are dropped
+    assert list(spent._spent) == ["new"]
+
+
+def test_redis_spent_challenges():
+    connection = Mock()
+    connection.set.side_effect = [True, None]
+    spent = RedisSpentChallenges(connection)
+    expires = pendulum.now().int_timestamp + 60
+
+    assert spent.spend("nonce", expires)
+    assert not spent.spend("nonce", expires)
+    (key, value), kwargs = connection.set.call_args
+    assert key == "challenge:nonce"
+    assert kwargs["nx"] and 0 < kwargs["ex"] <= 60
+
+
+def test_difficulty_scales_with_load():
+    difficulty = Difficulty(minimum=10, maximum=13, threshold=2)
+    assert difficulty.current == 10
+
+    # At the threshold
+    for _ in range(2):
+        difficulty.record()
+    assert difficulty.current == 10
+
+    # 1.5x, 2x the threshold
+    difficulty.record()
+    assert difficulty.current == 11
+    difficulty.record()
+    assert difficulty.current == 11
+
+    # 4x the threshold
+    for _ in range(4):
+        difficulty.record()
+    assert difficulty.current == 12
+
+    # Capped at maximum
+    for _ in range(100):
+        difficulty.record()
+    assert difficulty.current == 13
+
+
+def test_difficulty_window():
+    """Events outside the trailing window don't count towards load"""
+    difficulty = Difficulty(minimum=10, maximum=13, threshold=1, window=60)
+    stale = pendulum.now().timestamp() - 61
+    difficulty._events.extend([stale] * 10)
+    assert difficulty.current == 10
+    assert not difficulty._events
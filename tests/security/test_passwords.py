@@ -1,7 +1,12 @@
+import hashlib
+import threading
+import uuid
+
 import bcrypt
 import pytest
 
-from moldyboot.security.passwords import BadPassword, check, hash
+from moldyboot.security import passwords
+from moldyboot.security.passwords import BadPassword, CheckCache, check, hash
 
 
 def test_hash_small_rounds():
@@ -40,3 +45,119 @@ def test_check_hash_and_check():
     password = "hunter2"
     hashed = hash(password=password, rounds=12)
     check(password=password, expected_hash=hashed)
+
+
+# CheckCache ============================================================================================== CheckCache
+
+@pytest.fixture
+def bcrypt_calls(monkeypatch):
+    """Count the number of times the cache falls through to passwords.check"""
+    calls = []
+    real_check = passwords.check
+
+    def counting_check(**kwargs):
+        calls.append(kwargs)
+        real_check(**kwargs)
+    monkeypatch.setattr(passwords, "check", counting_check)
+    return calls
+
+
+@pytest.fixture(scope="module")
+def hashed():
+    # Intentionally low rounds for speed
+    return bcrypt.hashpw(b"hunter2", bcrypt.gensalt(4))
+
+
+def test_cache_skips_repeat(bcrypt_calls, hashed):
+    cache, user_id = CheckCache(), uuid.uuid4()
+    cache.check(user_id=user_id, password="hunter2", expected_hash=hashed)
+    cache.check(user_id=user_id, password=b"hunter2", expected_hash=hashed.decode("utf-8"))
+    assert len(bcrypt_calls) == 1
+
+
+def test_cache_never_stores_plaintext(hashed):
+    cache = CheckCache()
+    cache.check(user_id=uuid.uuid4(), password="hunter2", expected_hash=hashed)
+    (_, mac), = cache._entries.keys()
+    assert b"hunter2" not in mac
+    # keyed, so it can't be precomputed from a plain digest
+    assert mac != hashlib.sha256(b"hunter2").digest()
+
+
+def test_cache_wrong_password(bcrypt_calls, hashed):
+    cache, user_id = CheckCache(), uuid.uuid4()
+    cache.check(user_id=user_id, password="hunter2", expected_hash=hashed)
+    with pytest.raises(BadPassword):
+        cache.check(user_id=user_id, password="*******", expected_hash=hashed)
+    # Failures are never cached
+    with pytest.raises(BadPassword):
+        cache.check(user_id=user_id, password="*******", expected_hash=hashed)
+    assert len(bcrypt_calls) == 3
+
+
+def test_cache_other_user(bcrypt_calls, hashed):
+    cache = CheckCache()
+    cache.check(user_id=uuid.uuid4(), password="hunter2", expected_hash=hashed)
+    cache.check(user_id=uuid.uuid4(), password="hunter2", expected_hash=hashed)
+    assert len(bcrypt_calls) == 2
+
+
+def test_cache_expired(bcrypt_calls, hashed):
+    cache, user_id = CheckCache(ttl=-1), uuid.uuid4()
+    cache.check(user_id=user_id, password="hunter2", expected_hash=hashed)
+    cache.check(user_id=user_id, password="hunter2", expected_hash=hashed)
+    assert len(bcrypt_calls) == 2
+
+
+def test_cache_password_changed(bcrypt_calls, hashed):
+    """An entry is only valid for the hash it was checked against"""
+    cache, user_id = CheckCache(), uuid.uuid4()
+    cache.check(user_id=user_id, password="hunter2", expected_hash=hashed)
+    new_hash = bcrypt.hashpw(b"correct horse", bcrypt.gensalt(4))
+    with pytest.raises(BadPassword):
+        cache.check(user_id=user_id, password="hunter2", expected_hash=new_hash)
+    assert len(bcrypt_calls) == 2
+    assert not cache._entries
+
+
+def test_cache_invalidate(bcrypt_calls, hashed):
+    cache, user_id, other_id = CheckCache(), uuid.uuid4(), uuid.uuid4()
+    cache.check(user_id=user_id, password="hunter2", expected_hash=hashed)
+    cache.check(user_id=other_id, password="hunter2", expected_hash=hashed)
+    cache.invalidate(user_id)
+    assert [key[0] for key in cache._entries] == [other_id]
+    cache.check(user_id=user_id, password="hunter2", expected_hash=hashed)
+    assert len(bcrypt_calls) == 3
+
+
+def test_cache_max_size(hashed):
+    cache = CheckCache(max_size=2)
+    user_ids = [uuid.uuid4() for _ in range(3)]
+    for user_id in user_ids:
+        cache.check(user_id=user_id, password="hunter2", expected_hash=hashed)
+    # Oldest entry was evicted
+    assert [key[0] for key in cache._entries] == user_ids[1:]
+
+
+def test_cache_concurrent(monkeypatch):
+    """check and invalidate from many threads never see the entries mid-mutation"""
+    monkeypatch.setattr(passwords, "check", lambda **kwargs: None)
+    cache, user_ids = CheckCache(max_size=16), [uuid.uuid4() for _ in range(32)]
+    errors = []
+
+    def work(index):
+        try:
+            for i in range(500):
+                user_id = user_ids[(index + i) % len(user_ids)]
+                cache.check(user_id=user_id, password="hunter2", expected_hash=b"hash")
+                cache.invalidate(user_ids[(index * i) % len(user_ids)])
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=work, args=(index,)) for index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert len(cache._entries) <= 16
@@ -0,0 +1,58 @@
+import sys
+import uuid
+
+import pytest
+
+from moldyboot.models import Key, User
+from moldyboot.security.principals import KeyPrincipal, UserPrincipal
+
+
+def test_key_principal_from_key(rsa_pub):
+    key = Key(user_id=uuid.uuid4(), key_id=uuid.uuid4(), public=rsa_pub, until=1500000000, fingerprint="f")
+    principal = KeyPrincipal.from_key(key)
+    assert (principal.user_id, principal.key_id, principal.der, principal.fingerprint, principal.until) == (
+        key.user_id, key.key_id, key.der, "f", key.until)
+
+
+def test_key_principal_computes_missing_fingerprint(rsa_pub):
+    """Keys that the backfill hasn't reached load with an empty fingerprint"""
+    key = Key(user_id=uuid.uuid4(), key_id=uuid.uuid4(), public=rsa_pub, until=1500000000, fingerprint="")
+    assert KeyPrincipal.from_key(key).fingerprint == key.compute_fingerprint()
+
+
+@pytest.mark.parametrize("attrs, verified, deleted", [
+    ({}, True, False),
+    ({"verification_code": uuid.uuid4()}, False, False),
+    ({"deleted": True}, True, True),
+])
+def test_user_principal_from_user(attrs, verified, deleted):
+    user = User(user_id=uuid.uuid4(), **attrs)
+    assert UserPrincipal.from_user(user) == UserPrincipal(
+        user_id=user.user_id, is_verified=verified, is_deleted=deleted)
+
+
+def test_principal_immutable():
+    principal = UserPrincipal(user_id=uuid.uuid4(), is_verified=True, is_deleted=False)
+    with pytest.raises(AttributeError):
+        principal.is_deleted = True
+    with pytest.raises(AttributeError):
+        del principal.user_id
+    with pytest.raises(AttributeError):
+        principal.extra = "no __dict__"
+    assert not hasattr(principal, "__dict__")
+
+
+def test_principal_equality():
+    user_id = uuid.uuid4()
+    same = [UserPrincipal(user_id=user_id, is_verified=True, is_deleted=False) for _ in range(2)]
+    other = UserPrincipal(user_id=user_id, is_verified=True, is_deleted=True)
+    assert same[0] == same[1] and hash(same[0]) == hash(same[1])
+    assert same[0] != other
+    assert same[0] != User(user_id=user_id)
+
+
+def test_principal_smaller_than_model(rsa_pub):
+    key = Key(user_id=uuid.uuid4(), key_id=uuid.uuid4(), public=rsa_pub, until=1500000000, fingerprint="f")
+    principal = KeyPrincipal.from_key(key)
+    model_size = sys.getsizeof(key) + sys.getsizeof(key.__dict__)
+    assert sys.getsizeof(principal) < model_size
@@ -7,6 +7,7 @@ import pytest
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 
+from moldyboot.clock import Clock
 from moldyboot.security.signatures import BadSignature, sign, verify
 
 
@@ -170,6 +171,28 @@ def test_verify_fails_expired_date(rsa_pub):
     assert "x-date not within 5 minutes of current time" in str(excinfo.value)
 
 
+def test_verify_date_uses_clock(rsa_pub):
+    """The date is checked against the clock passed in, not the system time"""
+    date = pendulum.now("UTC")
+    headers = {
+        "content-length": "0",
+        "x-content-sha256": sha256(""),
+        "x-date": date.isoformat()}
+    clock = Clock(source=lambda: date.add(minutes=6).timestamp())
+    with pytest.raises(BadSignature) as excinfo:
+        verify(
+            method="get",
+            path=PATH,
+            headers=headers,
+            body=None,
+            public_key=rsa_pub,
+            signature=sha256(""),
+            signed_headers=MINIMUM_SIGNED_HEADERS,
+            clock=clock
+        )
+    assert "x-date not within 5 minutes of current time" in str(excinfo.value)
+
+
 def test_verify_fails_invalid_date(rsa_pub):
     method = "get"
     headers = {
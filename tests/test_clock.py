@@ -0,0 +1,31 @@
+import threading
+
+from moldyboot.clock import Clock
+
+
+def test_now_whole_seconds():
+    clock = Clock(source=lambda: 1500000000.9)
+    assert clock.now() == 1500000000
+
+
+def test_now_unfrozen_reads_source():
+    times = iter([1, 2])
+    clock = Clock(source=lambda: next(times))
+    assert [clock.now(), clock.now()] == [1, 2]
+
+
+def test_frozen_per_thread():
+    times = iter([1, 2, 3])
+    clock = Clock(source=lambda: next(times))
+    clock.begin()
+    assert clock.now() == clock.now() == 1
+
+    # Another thread isn't in this request
+    other = []
+    thread = threading.Thread(target=lambda: other.append(clock.now()))
+    thread.start()
+    thread.join()
+    assert other == [2]
+
+    clock.end()
+    assert clock.now() == 3
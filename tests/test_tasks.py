@@ -6,14 +6,16 @@ import pytest
 import rq
 
 from moldyboot import templates
-from moldyboot.controllers import InvalidParameter, NotFound, NotSaved
+from moldyboot.controllers import Deadline, DeadlineExceeded, InvalidParameter, NotFound, NotSaved
 from moldyboot.models import Key, User, UserName
 from moldyboot.tasks import (
     AsyncTasks,
     RedisContext,
     Result,
+    _backfill_fingerprints,
     _delete_user,
     _send_verification,
+    _sweep_expired_keys,
 )
 
 
@@ -112,6 +114,28 @@ def test_async_delete_user(async_tasks, queue):
     queue.enqueue.assert_called_with(_delete_user, username)
 
 
+def test_async_sweep_expired_keys(async_tasks, queue):
+    """Ensure the request to sweep expired keys is sent to the queue"""
+    async_tasks.sweep_expired_keys()
+    queue.enqueue.assert_called_with(_sweep_expired_keys)
+
+
+def test_async_backfill_fingerprints(async_tasks, queue):
+    """Ensure the request to backfill fingerprints is sent to the queue"""
+    async_tasks.backfill_fingerprints()
+    queue.enqueue.assert_called_with(_backfill_fingerprints)
+
+
+def test_async_deadline_exceeded(queue):
+    """Nothing is enqueued once the request is out of time"""
+    deadline = Deadline()
+    async_tasks = AsyncTasks(queue, deadline)
+    deadline.begin(0)
+    with pytest.raises(DeadlineExceeded):
+        async_tasks.send_verification("user")
+    queue.enqueue.assert_not_called()
+
+
 # send verification ================================================================================ send verification
 
 def test_email_username_invalid(ses, mock_user_manager):
@@ -194,8 +218,7 @@ def test_delete_user_invalid_username(mock_user_manager, mock_key_manager):
 
     mock_user_manager.get_username.assert_called_once_with(username)
     mock_user_manager.delete_user.assert_not_called()
-    mock_key_manager.list_keys.assert_not_called()
-    mock_key_manager.revoke.assert_not_called()
+    mock_key_manager.revoke_all.assert_not_called()
 
 
 def test_delete_user_unknown_username(mock_user_manager, mock_key_manager):
@@ -206,8 +229,7 @@ def test_delete_user_unknown_username(mock_user_manager, mock_key_manager):
 
     mock_user_manager.get_username.assert_called_once_with(username)
     mock_user_manager.delete_user.assert_not_called()
-    mock_key_manager.list_keys.assert_not_called()
-    mock_key_manager.revoke.assert_not_called()
+    mock_key_manager.revoke_all.assert_not_called()
 
 
 def test_delete_user_not_exists(mock_user_manager, mock_key_manager):
@@ -219,27 +241,43 @@ def test_delete_user_not_exists(mock_user_manager, mock_key_manager):
     _delete_user(username)
 
     mock_user_manager.get_username.assert_called_once_with(username)
-    mock_user_manager.delete_user.assert_called_once_with(user_id)
-    mock_key_manager.list_keys.assert_not_called()
-    mock_key_manager.revoke.assert_not_called()
+    mock_user_manager.delete_user.assert_called_once_with(user_id, username)
+    mock_key_manager.revoke_all.assert_not_called()
 
 
 def test_delete_user_keys(mock_user_manager, mock_key_manager):
     username = "user"
     user_id = uuid.uuid4()
-    first_key_id = uuid.uuid4()
-    second_key_id = uuid.uuid4()
-    keys = [
-        Key(user_id=user_id, key_id=first_key_id),
-        Key(user_id=user_id, key_id=second_key_id)
-    ]
+    failed_key_id = uuid.uuid4()
     mock_user_manager.get_username.return_value = UserName(username=username, user_id=user_id)
-    mock_key_manager.list_keys.return_value = keys
-    mock_key_manager.revoke.side_effect = [NotSaved(keys[0]), keys[1]]
+    mock_key_manager.revoke_all.return_value = [Key(user_id=user_id, key_id=failed_key_id)]
 
-    _delete_user(username)
+    result = _delete_user(username)
 
     mock_user_manager.get_username.assert_called_once_with(username)
-    mock_user_manager.delete_user.assert_called_once_with(user_id)
-    mock_key_manager.list_keys.assert_called_once_with(user_id)
-    assert mock_key_manager.revoke.call_count == 2
+    mock_user_manager.delete_user.assert_called_once_with(user_id, username)
+    mock_key_manager.revoke_all.assert_called_once_with(user_id)
+    assert result.value == {"username": username, "user_id": user_id, "failed_key_ids": [str(failed_key_id)]}
+
+
+# sweep expired keys ============================================================================== sweep expired keys
+
+def test_sweep_expired_keys(mock_key_manager):
+    failed = Key(user_id=uuid.uuid4(), key_id=uuid.uuid4())
+    mock_key_manager.sweep_expired.return_value = [failed]
+
+    result = _sweep_expired_keys()
+
+    mock_key_manager.sweep_expired.assert_called_once_with()
+    assert result.value == {"failed_key_ids": ["{}@{}".format(failed.user_id, failed.key_id)]}
+
+
+# backfill fingerprints ======================================================================== backfill fingerprints
+
+def test_backfill_fingerprints(mock_key_manager):
+    mock_key_manager.backfill_fingerprints.return_value = (3, 1)
+
+    result = _backfill_fingerprints()
+
+    mock_key_manager.backfill_fingerprints.assert_called_once_with()
+    assert result.value == {"written": 3, "skipped": 1}